@@ -401,6 +401,12 @@ private:
   void flush()
   {
     uint8_t const is_binary = m_chunks[0].data[0] & XH_BINARY;
+#ifdef COBS_ENCODING
+    if (is_binary) {
+      flush_cobs();
+      return;
+    }
+#endif
     char enc_buff[MAX_ENCODED_CHUNK_LEN];
     uart_begin();
 #ifndef SIMPLE_LINK
@@ -422,6 +428,30 @@ private:
     reset();
   }
 
+#ifdef COBS_ENCODING
+  // COBS encoding is applied to the whole frame so the chunks are gathered first
+  void flush_cobs()
+  {
+    static uint8_t frame_buff[MAX_FRAME];
+    static char enc_buff[MAX_COBS_ENCODED_LEN(MAX_FRAME)];
+    size_t len = 0;
+    for (int i = 0; i <= m_last_chunk; ++i) {
+      size_t const chunk_len = m_chunks[i].len - XHDR_SIZE - CHKSUM_SIZE;
+      memcpy(frame_buff + len, m_chunks[i].data + XHDR_SIZE, chunk_len);
+      len += chunk_len;
+    }
+    len = cobs_encode(frame_buff, len, enc_buff);
+    uart_begin();
+#ifndef SIMPLE_LINK
+    uart_print(m_tag);
+#endif
+    uart_print(COBS_DATA_START_TAG);
+    uart_write(enc_buff, len);
+    uart_end();
+    reset();
+  }
+#endif
+
   char const m_tag;
   uint8_t    m_next_sn;
   int        m_last_chunk;
@@ -459,6 +489,15 @@ static bool transmit_frame(
     }
     len = decode(data + 1, len - 1, tx_data = tx_buff);
   }
+#ifdef COBS_ENCODING
+  else if (len && (binary = (data[0] == COBS_DATA_START_TAG))) {
+    if (len > 1 + MAX_COBS_ENCODED_LEN(MAX_FRAME)) {
+      debug_msg("-encoded data size exceeds limit");
+      return true;
+    }
+    len = cobs_decode(data + 1, len - 1, tx_data = tx_buff);
+  }
+#endif
 #endif
 
   if (!len) {
@@ -542,7 +581,12 @@ static void uart_print_data(uint8_t const* data, size_t len, char tag)
 #ifdef BINARY_DATA_SUPPORT
   char enc_buff[1+MAX_ENCODED_CHUNK_LEN] = {ENCODED_DATA_START_TAG};
   if (is_data_binary(data, len)) {
+#ifdef COBS_ENCODING
+    enc_buff[0] = COBS_DATA_START_TAG;
+    len = 1 + cobs_encode(data, len, enc_buff + 1);
+#else
     len = 1 + encode(data, len, enc_buff + 1);
+#endif
     out_data = enc_buff;
   }
 #endif
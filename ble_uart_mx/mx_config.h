@@ -111,6 +111,16 @@
 #endif
 #endif
 
+// If COBS_ENCODING is defined in the user configuration the binary data is output to UART
+// with consistent overhead byte stuffing (COBS) instead of base64 encoding. The encoded data
+// are at most one byte per 126 data bytes plus one byte larger (about 0.8% in the worst case).
+// Implies binary data support. The host may send binary data using either encoding.
+#ifdef COBS_ENCODING
+#ifndef BINARY_DATA_SUPPORT
+#define BINARY_DATA_SUPPORT
+#endif
+#endif
+
 #define UART_RX_BUFFER_SZ ((1+(MAX_FRAME*MAX_BURST+2048)/4096)*4096)
 #define UART_TX_BUFFER_SZ (4*UART_RX_BUFFER_SZ)
 
@@ -187,4 +197,10 @@
 #define _UTIME ""
 #endif
 
-#define VARIANT _XDATA _MODE _ADVERT _RDONLY _ECHO _UTIME
+#ifdef COBS_ENCODING
+#define _COBS "s"
+#else
+#define _COBS ""
+#endif
+
+#define VARIANT _XDATA _MODE _ADVERT _RDONLY _ECHO _UTIME _COBS
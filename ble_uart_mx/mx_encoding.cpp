@@ -136,3 +136,111 @@ size_t decode(const char * asc_data, size_t len, uint8_t bin_data[MAX_FRAME])
   }
   return out_len;
 }
+
+#ifdef COBS_ENCODING
+
+#include <string.h>
+
+// The data is split onto runs of literal bytes. Every run is preceded by the code byte
+// telling its length and what follows it. The codes from 0 to COBS_MAX_RUN-1 are followed
+// by that number of literals and the COBS_RESERVED0 symbol, the next COBS_MAX_RUN codes
+// are followed by literals and the COBS_RESERVED1 symbol. The last two codes represent
+// runs of COBS_MAX_RUN and 2*COBS_MAX_RUN literals not followed by the reserved symbol.
+// The code bytes themselves skip both reserved symbols. The encoder appends implicit
+// COBS_RESERVED0 symbol to the data so the last run always ends with it.
+
+#define COBS_CODE_R1    COBS_MAX_RUN
+#define COBS_CODE_RUN   (2*COBS_MAX_RUN)
+#define COBS_CODE_RUN2  (2*COBS_MAX_RUN+1)
+
+#define COBS_RESERVED_LO ((uint8_t)COBS_RESERVED0 < (uint8_t)COBS_RESERVED1 ? (uint8_t)COBS_RESERVED0 : (uint8_t)COBS_RESERVED1)
+#define COBS_RESERVED_HI ((uint8_t)COBS_RESERVED0 < (uint8_t)COBS_RESERVED1 ? (uint8_t)COBS_RESERVED1 : (uint8_t)COBS_RESERVED0)
+
+// Transforms code to symbol
+static inline char cobs_symbol(unsigned code)
+{
+  if (code >= COBS_RESERVED_LO)
+    ++code;
+  if (code >= COBS_RESERVED_HI)
+    ++code;
+  return code;
+}
+
+// Transforms symbol to code
+static inline unsigned cobs_code(uint8_t symbol)
+{
+  if (symbol == COBS_RESERVED_LO || symbol == COBS_RESERVED_HI)
+    return INVALID;
+  return symbol - (symbol > COBS_RESERVED_LO) - (symbol > COBS_RESERVED_HI);
+}
+
+static inline bool is_reserved(uint8_t b)
+{
+  return b == (uint8_t)COBS_RESERVED0 || b == (uint8_t)COBS_RESERVED1;
+}
+
+// Encode binary data with consistent overhead byte stuffing, returns encoded data length
+size_t cobs_encode(uint8_t const * bin_data, size_t len, char* enc_data)
+{
+  char* const enc_start = enc_data;
+  uint8_t const * run = bin_data;
+  for (size_t i = 0; i <= len; ++i) {
+    bool const last = (i == len);
+    if (!last && !is_reserved(bin_data[i]))
+      continue;
+    size_t run_len = bin_data + i - run;
+    while (run_len >= COBS_MAX_RUN) {
+      size_t const n = run_len >= 2*COBS_MAX_RUN ? 2*COBS_MAX_RUN : COBS_MAX_RUN;
+      *enc_data++ = cobs_symbol(n == COBS_MAX_RUN ? COBS_CODE_RUN : COBS_CODE_RUN2);
+      memcpy(enc_data, run, n);
+      enc_data += n;
+      run += n;
+      run_len -= n;
+    }
+    *enc_data++ = cobs_symbol(last || bin_data[i] == (uint8_t)COBS_RESERVED0 ? run_len : COBS_CODE_R1 + run_len);
+    memcpy(enc_data, run, run_len);
+    enc_data += run_len;
+    run += run_len + 1;
+  }
+  return enc_data - enc_start;
+}
+
+// Decode COBS encoded data, returns decoded data length or 0 in case of decoding error
+size_t cobs_decode(const char * enc_data, size_t len, uint8_t bin_data[MAX_FRAME])
+{
+  size_t out_len = 0;
+  int pending = -1; // the reserved symbol to be output before the next run
+  while (len) {
+    unsigned const code = cobs_code(*enc_data++);
+    --len;
+    if (code == INVALID)
+      return 0;
+    size_t n;
+    int term;
+    if (code < COBS_CODE_R1) {
+      n = code;
+      term = (uint8_t)COBS_RESERVED0;
+    } else if (code < COBS_CODE_RUN) {
+      n = code - COBS_CODE_R1;
+      term = (uint8_t)COBS_RESERVED1;
+    } else {
+      n = code == COBS_CODE_RUN ? COBS_MAX_RUN : 2*COBS_MAX_RUN;
+      term = -1;
+    }
+    if (n > len || out_len + (pending >= 0) + n > MAX_FRAME)
+      return 0;
+    if (pending >= 0)
+      bin_data[out_len++] = pending;
+    memcpy(bin_data + out_len, enc_data, n);
+    out_len  += n;
+    enc_data += n;
+    len -= n;
+    pending = term;
+  }
+  // The last run should be terminated by implicit reserved symbol
+  if (pending != (uint8_t)COBS_RESERVED0)
+    return 0;
+  return out_len;
+}
+
+#endif
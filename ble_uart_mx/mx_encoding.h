@@ -14,6 +14,25 @@
 #define MAX_ENCODED_FRAME_LEN MAX_BASE64_ENCODED_LEN(MAX_FRAME)
 #define MAX_ENCODED_CHUNK_LEN MAX_BASE64_ENCODED_LEN(MAX_CHUNK)
 
+#ifdef COBS_ENCODING
+// Starts the data encoded with consistent overhead byte stuffing that follows
+#define COBS_DATA_START_TAG '\3'
+
+// The encoded data avoids two reserved symbols - the frame end and start ones
+#define COBS_RESERVED0 UART_END
+#ifdef UART_BEGIN
+#define COBS_RESERVED1 UART_BEGIN
+#else
+#define COBS_RESERVED1 (UART_END ? '\0' : '\1')
+#endif
+
+// Max number of literal bytes preceding the reserved symbol encoded by single code
+#define COBS_MAX_RUN 126
+
+// Get the max length of the COBS encoded data
+#define MAX_COBS_ENCODED_LEN(raw_len) ((raw_len) + (raw_len)/COBS_MAX_RUN + 1)
+#endif
+
 static inline bool is_data_binary(uint8_t const * data, size_t len) {
   for (size_t i = 0; i < len; ++i)
     switch (data[i]) {
@@ -22,6 +41,9 @@ static inline bool is_data_binary(uint8_t const * data, size_t len) {
     case UART_BEGIN:
 #endif
     case ENCODED_DATA_START_TAG:
+#ifdef COBS_ENCODING
+    case COBS_DATA_START_TAG:
+#endif
       return true;
     }
   return false;
@@ -32,3 +54,11 @@ size_t encode(uint8_t const * bin_data, size_t len, char asc_data[MAX_ENCODED_CH
 
 // Decode base64 encoded data (with padding or not), returns decoded data length or 0 in case of decoding error
 size_t decode(const char * asc_data, size_t len, uint8_t bin_data[MAX_FRAME]);
+
+#ifdef COBS_ENCODING
+// Encode binary data with consistent overhead byte stuffing, returns encoded data length
+size_t cobs_encode(uint8_t const * bin_data, size_t len, char* enc_data);
+
+// Decode COBS encoded data, returns decoded data length or 0 in case of decoding error
+size_t cobs_decode(const char * enc_data, size_t len, uint8_t bin_data[MAX_FRAME]);
+#endif
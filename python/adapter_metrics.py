@@ -0,0 +1,259 @@
+"""
+BLE multi adapter (ble_uart_mx) metrics exporters.
+The adapter statistics returned by get_stats() may be served in Prometheus text format
+over HTTP or periodically written to the file as JSON lines. Both exporters run in the
+dedicated thread and may be used with any adapter class including threaded and asyncio ones.
+
+Expects serial port name as a parameter followed by the peer device addresses to connect to
+if started as script. The script echo all data received from peers back to them while serving
+metrics at the port given by --http option (9108 by default) and / or writing them to the file
+given by --json option.
+"""
+
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, CENTRAL
+
+metrics_prefix = 'ble_mx_'
+
+# Statistics counters exported as Prometheus counters (metric name, help)
+counter_metrics = {
+	'rx_bytes'      : ('rx_bytes',      'Bytes received from adapter'),
+	'tx_bytes'      : ('tx_bytes',      'Bytes written to adapter'),
+	'rx_frames'     : ('rx_frames',     'Frames received from adapter'),
+	'tx_frames'     : ('tx_frames',     'Frames written to adapter'),
+	'parse_errors'  : ('parse_errors',  'Malformed frames received from adapter'),
+	'lost_frames'   : ('lost_frames',   'Frames lost as detected by stream tags'),
+	'decode_errors' : ('decode_errors', 'Binary data decoding errors'),
+	'stall_cnt'     : ('stalls',        'Number of times adapter stalled'),
+	'stall_time'    : ('stall_seconds', 'Total time adapter was stalled'),
+	'aggr_tx'       : ('aggregated_tx_messages', 'Messages packed into aggregated frames'),
+	'aggr_rx'       : ('aggregated_rx_messages', 'Messages unpacked from aggregated frames'),
+	'compr_in'      : ('compression_in_bytes',  'Bytes submitted to compression'),
+	'compr_out'     : ('compression_out_bytes', 'Bytes sent after compression'),
+	'compr_skipped' : ('compression_skipped',   'Messages sent uncompressed since compression does not make them shorter'),
+	'compr_time'    : ('compression_cpu_seconds',   'CPU time spent on compression'),
+	'decompr_time'  : ('decompression_cpu_seconds', 'CPU time spent on decompression'),
+	'offload_batches' : ('offload_batches', 'Batches of received messages submitted to the process pool'),
+	'offload_msgs'    : ('offload_messages', 'Received messages submitted to the process pool'),
+	'offload_drops'   : ('offload_drops',    'Received messages dropped while the process pool is saturated'),
+}
+
+# Statistics values exported as Prometheus gauges
+gauge_metrics = {
+	'rx_bytes_rate'  : 'Receive rate in bytes per second',
+	'tx_bytes_rate'  : 'Transmit rate in bytes per second',
+	'rx_frames_rate' : 'Receive rate in frames per second',
+	'tx_frames_rate' : 'Transmit rate in frames per second',
+	'tx_queued'      : 'Messages in transmit queue',
+	'tx_submitted'   : 'Messages submitted but not yet queued',
+	'stalled'        : 'Adapter is stalled',
+	'compr_ratio'    : 'Ratio of the data size to their size after compression',
+	'offload_pending'  : 'Received messages waiting for the process pool',
+	'offload_inflight' : 'Batches being processed by the process pool',
+}
+
+# Statistics dicts exported with label (metric type, label name, help)
+labeled_metrics = {
+	'peer_rx'       : ('counter', 'peer',   'Messages received per peer'),
+	'peer_tx'       : ('counter', 'peer',   'Messages sent per peer'),
+	'tx_drops'      : ('counter', 'policy', 'Messages dropped on transmit queue overflow'),
+	'tx_pending'    : ('gauge',   'peer',   'Messages queued per peer'),
+	'tx_rate_limit' : ('gauge',   'peer',   'Send rate limit per peer in bytes per second'),
+}
+
+# Latency histograms exported as Prometheus summaries
+latency_metrics = {
+	'queue_wait' : 'Time messages spent in transmit queue',
+	'write_time' : 'Time of writing messages to the port',
+}
+
+latency_quantiles = (('0.5', 'p50'), ('0.99', 'p99'), ('0.999', 'p999'))
+
+def peer_label(idx):
+	return 'central' if idx == CENTRAL else str(idx)
+
+def metric_name(name, kind):
+	return metrics_prefix + name + ('_total' if kind == 'counter' else '')
+
+def prometheus_text(adapters):
+	"""Returns adapters statistics in Prometheus text exposition format"""
+	samples = {} # metric family name -> (kind, help, [lines])
+	def add(name, kind, help, labels, value, suffix=''):
+		# the _sum and _count samples of the summary belong to its family
+		if name not in samples:
+			samples[name] = (kind, help, [])
+		samples[name][2].append('%s{%s} %s' % (
+			name + suffix, ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels), float(value)
+		))
+	for ad in adapters:
+		stats = ad.get_stats()
+		port = [('port', stats['port'])]
+		for key, (name, help) in counter_metrics.items():
+			if key in stats:
+				add(metric_name(name, 'counter'), 'counter', help, port, stats[key])
+		for key, help in gauge_metrics.items():
+			if key in stats:
+				add(metric_name(key, 'gauge'), 'gauge', help, port, stats[key])
+		for key, (kind, label, help) in labeled_metrics.items():
+			for k, v in stats.get(key, {}).items():
+				add(metric_name(key, kind), kind, help, port + [(label, peer_label(k) if label == 'peer' else k)], v)
+		for key, hists in (stats.get('latency') or {}).items():
+			name, help = metric_name(key + '_seconds', 'summary'), latency_metrics[key]
+			for idx, summary in hists.items():
+				labels = port + [('peer', peer_label(idx))]
+				if summary['count']:
+					for q, p in latency_quantiles:
+						add(name, 'summary', help, labels + [('quantile', q)], summary[p])
+				add(name, 'summary', help, labels, summary['mean'] * summary['count'] if summary['count'] else 0, '_sum')
+				add(name, 'summary', help, labels, summary['count'], '_count')
+		if stats['tag_gaps']:
+			add(metric_name('last_tag_gap_timestamp', 'gauge'), 'gauge', 'Time of the last stream tag gap', port, stats['tag_gaps'][-1][0])
+	lines = []
+	for name, (kind, help, values) in samples.items():
+		lines.append('# HELP %s %s' % (name, help))
+		lines.append('# TYPE %s %s' % (name, kind))
+		lines.extend(values)
+	return '\n'.join(lines) + '\n'
+
+class PrometheusExporter:
+	"""Serves adapters statistics in Prometheus text format at /metrics on the given local port"""
+	def __init__(self, adapters, port=9108, host='127.0.0.1'):
+		self.adapters = adapters
+		self.addr = (host, port)
+		self.server = None
+		self.thread = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.stop()
+
+	def start(self):
+		assert self.server is None
+		exporter = self
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] not in ('/', '/metrics'):
+					self.send_error(404)
+					return
+				body = prometheus_text(exporter.adapters).encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = ThreadingHTTPServer(self.addr, Handler)
+		self.thread = threading.Thread(target=self.server.serve_forever, name='metrics http', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+			self.thread.join()
+			self.server = self.thread = None
+
+class JsonLinesExporter:
+	"""Writes adapters statistics to the file as JSON lines (one line per adapter) at the given interval"""
+	def __init__(self, adapters, file, interval=10):
+		self.adapters = adapters
+		self.file = file
+		self.interval = interval
+		self.thread = None
+		self.stopping = threading.Event()
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.stop()
+
+	def write(self):
+		"""Write current statistics of all adapters"""
+		ts = time.time()
+		for ad in self.adapters:
+			self.file.write(json.dumps({'ts': ts, **ad.get_stats()}) + '\n')
+		self.file.flush()
+
+	def worker(self):
+		while not self.stopping.wait(self.interval):
+			self.write()
+
+	def start(self):
+		assert self.thread is None
+		self.stopping.clear()
+		self.thread = threading.Thread(target=self.worker, name='metrics json', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""Stop writing statistics. The last statistics are written before return."""
+		if self.thread:
+			self.stopping.set()
+			self.thread.join()
+			self.thread = None
+			self.write()
+
+class Echo(MutliAdapter):
+	def __init__(self, port, peers):
+		super().__init__(port)
+		self.peers = peers
+
+	def on_idle(self, hidden, version):
+		print('Idle, version ' + version.decode())
+		if self.peers:
+			self.connect(self.peers)
+
+	def on_debug_msg(self, msg):
+		print('    ' + msg.decode())
+
+	def on_central_msg(self, msg):
+		if msg:
+			self.send_data(msg)
+
+	def on_peer_msg(self, idx, msg):
+		if msg:
+			self.send_data_to(idx, msg)
+
+def get_opt(name, conv=str, default=None):
+	if name not in sys.argv:
+		return default
+	i = sys.argv.index(name)
+	val = conv(sys.argv[i+1])
+	del sys.argv[i:i+2]
+	return val
+
+if __name__ == '__main__':
+	json_file = get_opt('--json')
+	http_port = get_opt('--http', int, None if json_file else 9108)
+	port  = sys.argv[1]
+	peers = [addr.encode() for addr in sys.argv[2:]]
+	with Echo(port, peers) as ad:
+		exporters = []
+		if http_port:
+			exporters.append(PrometheusExporter([ad], http_port))
+			print('Serving metrics at http://127.0.0.1:%u/metrics' % http_port)
+		if json_file:
+			exporters.append(JsonLinesExporter([ad], open(json_file, 'a')))
+		for e in exporters:
+			e.start()
+		ad.use_latency_stats()
+		ad.reset()
+		try:
+			ad.run()
+		except KeyboardInterrupt:
+			pass
+		for e in exporters:
+			e.stop()
@@ -0,0 +1,485 @@
+"""
+BLE multi adapter host interface benchmark.
+Feeds synthetic adapter output through the hot functions of the host protocol stack using
+in-memory serial port and reports frames and bytes per second for every one of them.
+The stream cases are named as size/binary fraction followed by the stream options.
+
+Options:
+ -h, --help       print this help and exit
+ --save FILE      save results as JSON baseline
+ --compare FILE   compare results with the baseline saved before
+ --legacy         report parsing throughput of the current implementation versus the legacy one,
+                  the frame size / serial read size pairs are reported as size/chunk
+ --stress         report parsing throughput on garbage heavy streams for the two stream sizes verifying
+                  it scales linearly and the parser resynchronizes, exits with error if it does not
+ --codec          report base64 versus COBS binary data encoding throughput and size overhead
+                  verifying that both decode encoded data back, exits with error if they do not
+"""
+
+import sys
+import json
+import time
+import base64
+import random
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, CobsCodec, STREAM_TAGS_MOD
+
+# The amount of data parsed in one benchmark run
+bench_bytes = 256*1024
+
+# The number of runs, the best one is reported
+bench_repeat = 15
+
+# The frame sizes used in stream benchmarks
+bench_sizes = (32, 244, 2160)
+
+# Stream options: binary frames fraction, stream tags, new line terminator, garbage probability
+bench_streams = (
+	(0,  True,  False, 0),
+	(1,  True,  False, 0),
+	(.5, False, False, 0),
+	(.5, True,  True,  0),
+	(.5, True,  False, .01),
+)
+
+# Regression is reported if result is worse than baseline by more than this fraction
+regress_thr = .1
+
+# The parsing time per byte on the long stream may exceed that on the short one at most that many times
+stress_scaling_thr = 2
+
+class FakeSerial:
+	"""In-memory serial port replaying prepared data stream in chunks"""
+	def __init__(self, rx_data=b'', chunk=4096):
+		self.rx_data = rx_data
+		self.rx_pos = 0
+		self.chunk = chunk
+		self.tx_data = bytearray()
+
+	def rewind(self):
+		self.rx_pos = 0
+		del self.tx_data[:]
+
+	def read(self, size):
+		size = min(size, self.chunk)
+		data = self.rx_data[self.rx_pos:self.rx_pos + size]
+		self.rx_pos += len(data)
+		return data
+
+	def write(self, data):
+		self.tx_data += data
+		return len(data)
+
+	def close(self):
+		pass
+
+class BenchAdapter(MutliAdapter):
+	"""Adapter counting received data messages"""
+	def __init__(self, com):
+		super().__init__('bench')
+		self.com = com
+		self.msg_cnt = 0
+
+	def on_central_msg(self, msg):
+		self.msg_cnt += 1
+
+	def on_peer_msg(self, idx, msg):
+		self.msg_cnt += 1
+
+class LegacyAdapter(BenchAdapter):
+	"""Adapter using receive path implementation copying the buffer on every read and every frame"""
+	def __init__(self, com):
+		super().__init__(com)
+		self.rx_buff = b''
+
+	def receive(self):
+		while rx_bytes := self.com.read(4096):
+			self.process_rx(rx_bytes)
+
+	def process_rx(self, rx_bytes):
+		self.rx_buff += rx_bytes
+		tail = 0
+		begin = self.rx_buff.find(self.start_tag, 0) if self.start_tag else 0
+		while 0 <= begin < len(self.rx_buff):
+			end = self.rx_buff.find(self.end_tag, begin + 1)
+			if end < 0:
+				break
+			if self.start_tag:
+				while True:
+					next_begin = self.rx_buff.find(self.start_tag, begin + 1)
+					if 0 <= next_begin < end:
+						begin = next_begin + 1
+						self.parse_errors += 1
+					else:
+						break
+				if begin != tail:
+					self.parse_errors += 1
+				begin += 1
+			self.process_frame(self.rx_buff[begin:end])
+			tail = end + 1
+			begin = next_begin if self.start_tag else tail
+		self.rx_buff = self.rx_buff[tail:]
+
+	def process_frame(self, msg):
+		if not self.use_tags and not self.opt_tags:
+			self.process_msg(msg)
+			return
+		if not msg or not self.is_stream_tag(topen := msg[0]):
+			if self.opt_tags:
+				self.process_msg(msg)
+				return
+			else:
+				self.parse_errors += 1
+				return
+		if len(msg) < 2:
+			self.parse_errors += 1
+			return
+		if msg[-1] != self.get_closing_tag(topen, len(msg) - 2):
+			self.parse_errors += 1
+			return
+		if self.last_rx_tag:
+			next_rx_tag = self.get_next_tag_(self.last_rx_tag)
+			if topen != next_rx_tag:
+				self.lost_frames += topen - next_rx_tag if topen > next_rx_tag else \
+									topen + STREAM_TAGS_MOD - next_rx_tag
+		self.last_rx_tag = topen
+		self.process_msg(msg[1:-1])
+
+def mk_stream(nframes, size, binary=True, nl_term=False, use_tags=True, garbage=0):
+	"""Build adapter output stream with the given number of peer data frames.
+	The binary parameter is the fraction of frames carrying binary data,
+	the garbage is the probability of random bytes being inserted before the frame.
+	"""
+	com = FakeSerial()
+	ad = BenchAdapter(com)
+	if nl_term:
+		ad.selt_nl_terminator()
+	ad.use_stream_tags(use_tags)
+	for i in range(nframes):
+		if garbage and random.random() < garbage:
+			com.write(random.randbytes(random.randrange(1, 16)))
+		if is_binary := random.random() < binary:
+			data = random.randbytes(size)
+		else:
+			data = b'%u#' % i * (size // 4)
+		ad.write_msg(b'%u' % (i % 4) + (ad.encode_binary(data) if is_binary else data))
+	return bytes(com.tx_data)
+
+def rx_runner(ad_class, stream, chunk, nl_term=False):
+	"""Returns the function parsing the whole stream once"""
+	com = FakeSerial(stream, chunk)
+	ad = ad_class(com)
+	if nl_term:
+		ad.selt_nl_terminator()
+	def run():
+		ad.last_rx_tag = 0
+		com.rewind()
+		while com.rx_pos < len(stream):
+			ad.receive()
+		assert not ad.parse_errors and not ad.lost_frames
+	return run
+
+def new_adapter(nl_term, use_tags):
+	ad = BenchAdapter(FakeSerial())
+	if nl_term:
+		ad.selt_nl_terminator()
+	ad.use_stream_tags(use_tags)
+	return ad
+
+def received_msgs(stream, nl_term, use_tags):
+	"""Returns the list of messages received from the stream"""
+	ad = new_adapter(nl_term, use_tags)
+	msgs = []
+	ad.process_payload = lambda buff, begin, end: msgs.append(bytes(buff[begin:end]))
+	ad.process_rx(stream)
+	return msgs
+
+def process_rx_runner(stream, nl_term, use_tags):
+	"""Returns the function feeding the whole stream to process_rx once"""
+	ad = new_adapter(nl_term, use_tags)
+	def run():
+		ad.last_rx_tag = ad.msg_cnt = 0
+		ad.process_rx(stream)
+		return len(stream), ad.msg_cnt
+	return run
+
+def process_rx_views_runner(stream, nl_term, use_tags):
+	"""Returns the function feeding the whole stream to process_rx once passing data to callbacks as memoryview"""
+	ad = new_adapter(nl_term, use_tags)
+	ad.use_msg_views()
+	def run():
+		ad.last_rx_tag = ad.msg_cnt = 0
+		ad.process_rx(stream)
+		return len(stream), ad.msg_cnt
+	return run
+
+def process_frame_runner(stream, nl_term, use_tags):
+	"""Returns the function calling process_frame_at for every frame of the stream placed to the receive buffer"""
+	ad = new_adapter(nl_term, use_tags)
+	frames = []
+	ad.process_frame_at = lambda buff, begin, end: frames.append((begin, end))
+	ad.process_rx(stream)
+	del ad.process_frame_at
+	nbytes = sum(end - begin for begin, end in frames)
+	rx_view = memoryview(stream)
+	def run():
+		ad.last_rx_tag = 0
+		process_frame = ad.process_frame_at
+		for begin, end in frames:
+			process_frame(rx_view, begin, end)
+		return nbytes, len(frames)
+	return run
+
+def closing_tag_runner(stream, nl_term, use_tags):
+	"""Returns the function calculating closing tags for every frame of the stream"""
+	ad = new_adapter(nl_term, use_tags)
+	frames = [(ad.get_next_tag(), len(msg)) for msg in received_msgs(stream, nl_term, use_tags)]
+	nbytes = sum(msg_len for _, msg_len in frames)
+	def run():
+		get_closing_tag = ad.get_closing_tag
+		for topen, msg_len in frames:
+			get_closing_tag(topen, msg_len)
+		return nbytes, len(frames)
+	return run
+
+def write_msg_runner(stream, nl_term, use_tags):
+	"""Returns the function writing all messages received from the stream"""
+	ad = new_adapter(nl_term, use_tags)
+	msgs = received_msgs(stream, nl_term, use_tags)
+	def run():
+		ad.com.rewind()
+		write_msg = ad.write_msg
+		for msg in msgs:
+			write_msg(msg)
+		return len(ad.com.tx_data), len(msgs)
+	return run
+
+def encode_binary_runner(stream, nl_term, use_tags):
+	"""Returns the function encoding all binary data received from the stream"""
+	ad = new_adapter(nl_term, use_tags)
+	data = [ad.decode_data(msg[1:]) for msg in received_msgs(stream, nl_term, use_tags) if msg[1:2] == ad.b64_tag]
+	data = [d for d in data if d is not None]
+	nbytes = sum(len(d) for d in data)
+	def run():
+		encode_binary = ad.encode_binary
+		for d in data:
+			encode_binary(d)
+		return nbytes, len(data)
+	return run
+
+def decode_data_runner(stream, nl_term, use_tags):
+	"""Returns the function decoding data of all messages received from the stream"""
+	ad = new_adapter(nl_term, use_tags)
+	msgs = [msg[1:] for msg in received_msgs(stream, nl_term, use_tags)]
+	nbytes = sum(len(msg) for msg in msgs)
+	def run():
+		decode_data = ad.decode_data
+		for msg in msgs:
+			decode_data(msg)
+		return nbytes, len(msgs)
+	return run
+
+def process_msg_runner(stream, nl_term, use_tags):
+	"""Returns the function dispatching messages received from the stream mixed with status, debug and central ones"""
+	ad = new_adapter(nl_term, use_tags)
+	msgs = []
+	for i, msg in enumerate(received_msgs(stream, nl_term, use_tags)):
+		msgs.append(msg)
+		if i % 4 == 0:
+			msgs.append((b':D', b'-debug message', b'<' + msg[1:], b':C1')[i // 4 % 4])
+	nbytes = sum(len(msg) for msg in msgs)
+	def run():
+		process_msg = ad.process_msg
+		for msg in msgs:
+			process_msg(msg)
+		return nbytes, len(msgs)
+	return run
+
+# The benchmarked functions and the functions creating benchmark runners for the given stream
+stream_runners = (
+	('process_rx',      process_rx_runner),
+	('process_rx_views', process_rx_views_runner),
+	('process_frame',   process_frame_runner),
+	('get_closing_tag', closing_tag_runner),
+	('write_msg',       write_msg_runner),
+	('encode_binary',   encode_binary_runner),
+	('decode_data',     decode_data_runner),
+	('process_msg',     process_msg_runner),
+)
+
+def best_time(runners):
+	"""Run given functions interleaved, returns the best time for every one along with its last result"""
+	best = [None] * len(runners)
+	res  = [None] * len(runners)
+	for _ in range(bench_repeat):
+		for i, run in enumerate(runners):
+			start = time.perf_counter()
+			res[i] = run()
+			elapsed = time.perf_counter() - start
+			if best[i] is None or elapsed < best[i]:
+				best[i] = elapsed
+	return best, res
+
+def bench(runners, nbytes):
+	"""Run given functions interleaved, returns the best bytes per second figure for every one"""
+	return [nbytes / t for t in best_time(runners)[0]]
+
+def stream_name(size, binary, use_tags, nl_term, garbage):
+	return '%u/%g%s%s%s' % (size, binary, '' if use_tags else ' notags', ' nl' if nl_term else '', ' garbage' if garbage else '')
+
+def run_suite():
+	"""Run all benchmarks, returns the results dictionary"""
+	random.seed(1)
+	results = {}
+	print('%-44s %12s %12s' % ('test', 'frames/s', 'B/s'))
+	for size in bench_sizes:
+		for binary, use_tags, nl_term, garbage in bench_streams:
+			stream = mk_stream(max(16, bench_bytes // size), size, binary, nl_term, use_tags, garbage)
+			name = stream_name(size, binary, use_tags, nl_term, garbage)
+			times, res = best_time([mk_runner(stream, nl_term, use_tags) for _, mk_runner in stream_runners])
+			for (func, _), t, (nbytes, nframes) in zip(stream_runners, times, res):
+				if not nframes:
+					continue
+				test = '%s %s' % (func, name)
+				results[test] = {'fps': nframes / t, 'bps': nbytes / t}
+				print('%-44s %12u %12u' % (test, nframes / t, nbytes / t))
+	return results
+
+def compare(results, baseline):
+	"""Print results relative to the baseline, returns the number of regressions"""
+	regressions = 0
+	print('%-44s %12s %12s %8s' % ('test', 'base fr/s', 'frames/s', 'ratio'))
+	for test, res in results.items():
+		if not (base := baseline.get(test)):
+			continue
+		ratio = res['fps'] / base['fps']
+		if regress := ratio < 1 - regress_thr:
+			regressions += 1
+		print('%-44s %12u %12u %7.2fx%s' % (test, base['fps'], res['fps'], ratio, ' <<' if regress else ''))
+	print('%u regression(s)' % regressions)
+	return regressions
+
+def run_legacy():
+	random.seed(1)
+	print('%-36s %12s %12s %8s' % ('test', 'legacy B/s', 'B/s', 'speedup'))
+	for chunk in (256, 4096):
+		for size in (32, 244, 2160, 20000):
+			for binary in (False, True):
+				for nl_term in (False, True):
+					stream = mk_stream(max(16, bench_bytes // size), size, binary, nl_term)
+					legacy, current = bench((
+							rx_runner(LegacyAdapter, stream, chunk, nl_term),
+							rx_runner(BenchAdapter, stream, chunk, nl_term)
+						), len(stream))
+					name = '%u/%u %s %s' % (size, chunk, 'binary' if binary else 'text', 'nl' if nl_term else 'start/end')
+					print('%-36s %12u %12u %7.2fx' % (name, legacy, current, current / legacy))
+
+# Garbage heavy streams used in stress test (name, function building the stream of the given size)
+stress_streams = (
+	('no start tags', lambda nbytes: random.randbytes(nbytes).replace(b'\1', b'\2')),
+	('unterminated',  lambda nbytes: random.randbytes(nbytes).replace(b'\0', b'\2')),
+	('start floods',  lambda nbytes: mk_stream(nbytes // 128, 32, .5).replace(b'\1', b'\1' * 64)),
+	('garbage',       lambda nbytes: mk_stream(nbytes // 48, 32, .5, garbage=1)),
+)
+
+def run_stress():
+	"""Run stress test, returns the number of failures"""
+	random.seed(1)
+	failures = 0
+	tail_frames = 16
+	tail = mk_stream(tail_frames, 32, 0)
+	print('%-24s %12s %12s %8s' % ('test', 'B/s', 'long B/s', 'scaling'))
+	for name, mk_garbage in stress_streams:
+		for chunk in (256, 4096):
+			rates = []
+			for nbytes in (bench_bytes, 8 * bench_bytes):
+				stream = mk_garbage(nbytes) + tail
+				com = FakeSerial(stream, chunk)
+				ad = BenchAdapter(com)
+				best = None
+				for _ in range(3):
+					com.rewind()
+					ad.msg_cnt = 0
+					ad.last_rx_tag = 0
+					start = time.perf_counter()
+					while com.rx_pos < len(stream):
+						ad.receive()
+					elapsed = time.perf_counter() - start
+					best = elapsed if best is None else min(best, elapsed)
+				rates.append(len(stream) / best)
+				if ad.msg_cnt < tail_frames:
+					# the frames following garbage are lost
+					failures += 1
+					print('%s/%u: only %u messages received after garbage' % (name, chunk, ad.msg_cnt))
+			scaling = rates[0] / rates[1]
+			if scaling > stress_scaling_thr:
+				failures += 1
+			print('%-24s %12u %12u %7.2fx%s' % ('%s/%u' % (name, chunk), rates[0], rates[1], scaling, ' <<' if scaling > stress_scaling_thr else ''))
+	print('%u failure(s)' % failures)
+	return failures
+
+# The binary data used in codec benchmark: random, text with rare reserved symbols, COBS worst case
+codec_data = (
+	('random', lambda size: random.randbytes(size)),
+	('text',   lambda size: bytes(random.choice(b'\0\1') if random.random() < .01 else random.randrange(32, 127) for _ in range(size))),
+	('worst',  lambda size: ((b'x' * CobsCodec.max_run + b'\0') * (size // CobsCodec.max_run + 1))[:size]),
+)
+
+def run_codec():
+	"""Compare codecs, returns the number of data items not decoded back"""
+	random.seed(1)
+	cobs = CobsCodec.for_tags(b'\1', b'\0')
+	codecs = (
+		('base64', base64.b64encode, base64.b64decode),
+		('cobs',   cobs.encode,      cobs.decode),
+	)
+	failures = 0
+	print('%-16s %-7s %12s %12s %9s' % ('test', 'codec', 'enc B/s', 'dec B/s', 'overhead'))
+	for size in bench_sizes:
+		for kind, mk_data in codec_data:
+			data = [mk_data(size) for _ in range(max(16, bench_bytes // size))]
+			nbytes = sum(len(d) for d in data)
+			for name, encode, decode in codecs:
+				encoded = [encode(d) for d in data]
+				failures += sum(decode(e) != d for d, e in zip(data, encoded))
+				def run_encode():
+					for d in data:
+						encode(d)
+				def run_decode():
+					for e in encoded:
+						decode(e)
+				enc, dec = bench((run_encode, run_decode), nbytes)
+				overhead = sum(len(e) for e in encoded) / nbytes - 1
+				print('%-16s %-7s %12u %12u %8.2f%%' % ('%u/%s' % (size, kind), name, enc, dec, 100 * overhead))
+	print('%u decoding failure(s)' % failures)
+	return failures
+
+def get_opt(name):
+	if name not in sys.argv:
+		return None
+	i = sys.argv.index(name)
+	val = sys.argv[i+1]
+	del sys.argv[i:i+2]
+	return val
+
+if __name__ == '__main__':
+	if '-h' in sys.argv or '--help' in sys.argv:
+		print(__doc__)
+		sys.exit(0)
+	if '--legacy' in sys.argv:
+		run_legacy()
+		sys.exit(0)
+	if '--stress' in sys.argv:
+		sys.exit(1 if run_stress() else 0)
+	if '--codec' in sys.argv:
+		sys.exit(1 if run_codec() else 0)
+	save_file = get_opt('--save')
+	base_file = get_opt('--compare')
+	results = run_suite()
+	if save_file:
+		with open(save_file, 'w') as f:
+			json.dump(results, f, indent=1)
+	if base_file:
+		with open(base_file) as f:
+			sys.exit(1 if compare(results, json.load(f)) else 0)
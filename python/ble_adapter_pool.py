@@ -0,0 +1,266 @@
+"""
+The pool of BLE multi adapters (ble_uart_mx) driven by the single selector loop.
+Every adapter may be connected to at most 4 peripherals so the pool spreads peers
+across adapters and lets the application send and receive data by peer address.
+If some adapter stalls or resets on its own its peers are moved to other adapters.
+Since it relies on selecting on serial port file descriptors it works on POSIX platforms only.
+
+Expects comma separated list of serial port names as a parameter followed by the peer device
+addresses to connect to if started as script. The script echo all data received from any peer back to it.
+"""
+
+import sys
+import time
+import selectors
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter
+
+class PoolAdapter(MutliAdapter):
+	"""Adapter being the member of the pool. Keeps the list of peer addresses assigned to it."""
+	timeout = 0 # non-blocking reads
+
+	def __init__(self, port, pool):
+		super().__init__(port)
+		self.pool = pool
+		self.peers = []
+		self.connect_sent = False
+		self.connect_ts = 0
+		self.active = False
+		self.reset_ts = time.monotonic()
+
+	def reset(self):
+		super().reset()
+		self.connect_sent = False
+		self.active = False
+		self.reset_ts = time.monotonic()
+
+	def down_time(self, now):
+		"""Returns the time passed since the adapter stalled or was reset or 0 if it is running"""
+		if not self.is_stall:
+			return 0
+		return now - (self.stall_ts or self.reset_ts)
+
+	def on_idle(self, hidden, version):
+		self.pool.on_adapter_idle(self, version)
+
+	def on_connecting(self, idx):
+		self.active = True
+		if idx < len(self.peers):
+			self.pool.on_connecting(self.peers[idx])
+
+	def on_connected(self, hidden):
+		self.active = True
+		self.pool.on_connected(self.port)
+
+	def on_debug_msg(self, msg):
+		self.pool.on_debug_msg(self.port, msg)
+
+	def on_peer_msg(self, idx, msg):
+		if idx < len(self.peers):
+			self.pool.on_peer_msg(self.peers[idx], msg)
+
+class AdapterPool:
+	"""The pool of multi adapters connected to the given serial ports.
+	The peers are addressed by their MAC addresses given as bytes.
+	"""
+	max_peers    = 4   # max peers per adapter
+	rehome_tout  = 5   # sec, move peers from adapter being down for that long
+	connect_tout = 2   # sec, repeat connect command if adapter is still idle after that time
+
+	def __init__(self, ports, peers=()):
+		self.adapters = [PoolAdapter(port, self) for port in ports]
+		self.selector = None
+		self.pending = []
+		self.route = {}
+		self.rehome_cnt = 0
+		self.add_peers(peers)
+
+	def __enter__(self):
+		self.open()
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.close()
+
+	def open(self):
+		"""Open all adapters and reset them"""
+		self.selector = selectors.DefaultSelector()
+		for ad in self.adapters:
+			ad.open()
+			self.selector.register(ad.com.fileno(), selectors.EVENT_READ, ad)
+			ad.reset()
+
+	def close(self):
+		if self.selector:
+			self.selector.close()
+			self.selector = None
+		for ad in self.adapters:
+			ad.close()
+
+	def add_peers(self, peers):
+		"""Add peer addresses to connect to. They are spread across adapters with free connection slots."""
+		for addr in peers:
+			if addr not in self.route and addr not in self.pending:
+				self.pending.append(addr)
+		self.place_pending()
+
+	def get_adapter(self, addr):
+		"""Returns the (adapter, idx) tuple for the given peer address or None if it is not assigned to any adapter"""
+		return self.route.get(addr)
+
+	def update_route(self, ad):
+		for idx, addr in enumerate(ad.peers):
+			self.route[addr] = (ad, idx)
+
+	def place_pending(self, exclude=None):
+		"""Assign pending peers to the adapters with free slots. The adapters that have not sent connect command yet
+		are preferred, then the least loaded ones. The adapter that have already sent connect command is reset once
+		the peers are placed so it will reconnect with the new peer list dropping its current connections.
+		"""
+		changed = set()
+		now = time.monotonic()
+		while self.pending:
+			free = [ad for ad in self.adapters if ad is not exclude and len(ad.peers) < self.max_peers and \
+				not ad.down_time(now) > self.rehome_tout]
+			if not free:
+				break
+			ad = min(free, key=lambda ad: (ad.connect_sent, len(ad.peers)))
+			ad.peers.append(self.pending.pop(0))
+			self.update_route(ad)
+			changed.add(ad)
+		for ad in changed:
+			if ad.connect_sent:
+				ad.reset()
+
+	def rehome(self, ad):
+		"""Move peers of the failed adapter to other adapters"""
+		if not ad.peers:
+			return
+		self.rehome_cnt += 1
+		for addr in ad.peers:
+			del self.route[addr]
+		self.pending.extend(ad.peers)
+		moved = ad.peers
+		ad.peers = []
+		self.place_pending(exclude=ad)
+		for addr in moved:
+			if (r := self.route.get(addr)):
+				self.on_rehomed(addr, ad.port, r[0].port)
+
+	def on_adapter_idle(self, ad, version):
+		if ad.active:
+			# adapter was reset unexpectedly
+			self.rehome(ad)
+			ad.connect_sent = ad.active = False
+		elif ad.connect_sent and time.monotonic() < ad.connect_ts + self.connect_tout:
+			# connect command is not processed yet
+			return
+		if len(ad.peers) < self.max_peers and self.pending:
+			free = self.max_peers - len(ad.peers)
+			ad.peers.extend(self.pending[:free])
+			del self.pending[:free]
+			self.update_route(ad)
+		if ad.peers:
+			ad.connect(ad.peers)
+			ad.connect_sent = True
+			ad.connect_ts = time.monotonic()
+		self.on_idle(ad.port, version)
+
+	def chk_adapters(self):
+		"""Move peers from adapters being down for too long and try to reset them"""
+		now = time.monotonic()
+		for ad in self.adapters:
+			if ad.down_time(now) > self.rehome_tout:
+				self.rehome(ad)
+				ad.reset()
+
+	def next_timeout(self):
+		"""Returns the max time to wait for input or None to wait forever"""
+		now = time.monotonic()
+		timeouts = [t for ad in self.adapters if (t := ad.next_timeout()) is not None]
+		timeouts += [max(0, self.rehome_tout - t) for ad in self.adapters if (t := ad.down_time(now))]
+		return min(timeouts, default=None)
+
+	def poll(self, timeout=None):
+		"""Wait for data from any adapter up to the given timeout and communicate with all of them"""
+		if any(ad.has_work() for ad in self.adapters):
+			timeout = 0
+		elif (t := self.next_timeout()) is not None:
+			timeout = t if timeout is None else min(timeout, t)
+		self.selector.select(timeout)
+		for ad in self.adapters:
+			ad.communicate()
+		self.chk_adapters()
+
+	def run(self):
+		"""Communicate with adapters forever"""
+		while True:
+			self.poll()
+
+	def send_to(self, addr, data, binary=False, key=None):
+		"""Send data to peer given its address. Returns False if the peer is not assigned to any adapter."""
+		if not (r := self.route.get(addr)):
+			return False
+		ad, idx = r
+		ad.send_data_to(idx, data, binary, key)
+		return True
+
+	def is_congested(self, addr=None):
+		"""Client should avoid submitting new data to the peer with given address if it is congested.
+		If address is not given returns True if any adapter is congested.
+		"""
+		if addr is None:
+			return any(ad.is_congested() for ad in self.adapters)
+		if not (r := self.route.get(addr)):
+			return True
+		ad, idx = r
+		return ad.is_congested(idx)
+
+	def on_idle(self, port, version):
+		pass
+
+	def on_connecting(self, addr):
+		pass
+
+	def on_connected(self, port):
+		pass
+
+	def on_rehomed(self, addr, from_port, to_port):
+		pass
+
+	def on_debug_msg(self, port, msg):
+		pass
+
+	def on_peer_msg(self, addr, msg):
+		pass
+
+class EchoPool(AdapterPool):
+	def on_idle(self, port, version):
+		print('%s idle, version %s' % (port, version.decode()))
+
+	def on_connecting(self, addr):
+		print('Connecting to %s' % addr.decode())
+
+	def on_connected(self, port):
+		print('%s connected' % port)
+
+	def on_rehomed(self, addr, from_port, to_port):
+		print('%s moved from %s to %s' % (addr.decode(), from_port, to_port))
+
+	def on_debug_msg(self, port, msg):
+		print('    %s: %s' % (port, msg.decode()))
+
+	def on_peer_msg(self, addr, msg):
+		print('[%s] %r' % (addr.decode(), msg))
+		if msg:
+			self.send_to(addr, msg)
+
+if __name__ == '__main__':
+	ports = sys.argv[1].split(',')
+	peers = [addr.encode() for addr in sys.argv[2:]]
+	with EchoPool(ports, peers) as pool:
+		try:
+			pool.run()
+		except KeyboardInterrupt:
+			pass
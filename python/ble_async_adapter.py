@@ -0,0 +1,249 @@
+"""
+BLE multi adapter (ble_uart_mx) asyncio host interface.
+The serial port is read and written by the event loop callbacks so no polling thread is required.
+Since it relies on the event loop file descriptor watching it works on POSIX platforms only.
+
+Expects serial port name as a parameter followed by the peer device addresses to connect to
+if started as script. The script echo all data received from any connected peer back to it.
+"""
+
+import os
+import sys
+import time
+import asyncio
+from time import perf_counter
+from collections import deque
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, CENTRAL
+
+class AsyncMutliAdapter(MutliAdapter):
+	"""BLE multi-adapter interface class driven by asyncio event loop.
+	The received status messages are put to status_queue as tuples ('idle', hidden, version),
+	('connecting', idx) or ('connected', hidden). The data received from peers are put to
+	peer_queue as (idx, data) tuples, the data received from central are put to central_queue.
+	"""
+	timeout = 0 # non-blocking reads
+	min_wait = .01 # min time to wait for the rate controller
+
+	def __init__(self, port):
+		super().__init__(port)
+		self.loop = None
+		self.tx_out = bytearray()
+		self.tx_marks = deque()
+		self.tx_total = 0
+		self.tx_written = 0
+		self.tx_waiting = False
+		self.tx_timer = None
+		self.tx_ready = asyncio.Event()
+		self.status_queue  = asyncio.Queue()
+		self.peer_queue    = asyncio.Queue()
+		self.central_queue = asyncio.Queue()
+
+	async def __aenter__(self):
+		self.open()
+		return self
+
+	async def __aexit__(self, ex_type, ex_value, traceback):
+		self.close()
+
+	def open(self):
+		super().open()
+		self.loop = asyncio.get_running_loop()
+		self.loop.add_reader(self.com.fileno(), self.on_readable)
+
+	def close(self):
+		if self.com:
+			self.loop.remove_reader(self.com.fileno())
+			if self.tx_waiting:
+				self.loop.remove_writer(self.com.fileno())
+				self.tx_waiting = False
+			if self.stall_timer:
+				self.stall_timer.cancel()
+				self.stall_timer = None
+			if self.tx_timer:
+				self.tx_timer.cancel()
+				self.tx_timer = None
+			self.cancel_tx()
+		super().close()
+
+	def cancel_tx(self):
+		"""Cancel all pending transmissions"""
+		for _, fut in self.tx_queue:
+			fut.cancel()
+		for _, fut, _, _ in self.tx_marks:
+			if fut:
+				fut.cancel()
+		self.tx_queue.clear()
+		self.tx_marks.clear()
+		self.tx_total -= len(self.tx_out)
+		del self.tx_out[:]
+
+	def reset(self):
+		"""Reset adapter. All pending transmissions are cancelled."""
+		self.cancel_tx()
+		super().reset()
+		self.update_ready()
+
+	def is_congested(self, idx=None):
+		"""Client should avoid submitting new data if adapter is congested"""
+		return len(self.tx_out) > self.tx_buf_size or super().is_congested(idx)
+
+	def update_ready(self):
+		if self.is_congested():
+			self.tx_ready.clear()
+		else:
+			self.tx_ready.set()
+
+	async def wait_ready(self, idx=None):
+		"""Wait while adapter is congested. The peer index or CENTRAL may be given to wait for the rate controller."""
+		while self.is_congested(idx):
+			if self.is_congested():
+				self.tx_ready.clear()
+				await self.tx_ready.wait()
+			else:
+				# the send delay may be zero while the controller is still congested
+				await asyncio.sleep(max(self.get_rate_ctl(idx).send_delay(), self.min_wait))
+
+	def submit_msg(self, msg, key=None):
+		"""Queue message for transmission. Returns future to be completed with True once the message is written to the port.
+		The futures of messages dropped due to transmit queue overflow are completed with False.
+		"""
+		fut = self.loop.create_future()
+		for _, dropped in self.tx_queue.append(msg, self.tx_dest(msg), fut, key):
+			if not dropped.done():
+				dropped.set_result(False)
+		self.transmit()
+		return fut
+
+	def write_msg(self, msg, fut=None, ts=None):
+		"""Write message to the adapter bypassing transmit queue.
+		The ts is the time the message was queued used to collect latency statistics.
+		"""
+		wire_msg = self.encode_msg(msg)
+		if self.capture:
+			self.capture.tx(wire_msg)
+		self.tx_out += wire_msg
+		self.tx_total += len(wire_msg)
+		if self.latency_stats and ts is not None:
+			# the write time is accounted once the message is actually written to the port
+			self.tx_marks.append((self.tx_total, fut, self.tx_dest(msg), (ts, perf_counter())))
+		else:
+			self.tx_marks.append((self.tx_total, fut, None, None))
+		self.stats.tx_bytes += len(wire_msg)
+		self.stats.tx_frames += 1
+		self.flush()
+
+	def transmit(self):
+		"""Write queued messages to the port while adapter is able to accept them"""
+		while self.tx_queue and self.can_transmit() and (item := self.pop_tx()):
+			self.write_msg(*item)
+		if self.tx_queue and self.can_transmit() and not self.tx_timer and (delay := self.tx_timeout()) is not None:
+			# the messages left are held back by the rate controller
+			self.tx_timer = self.loop.call_later(delay, self.on_tx_timer)
+		self.update_ready()
+
+	def on_tx_timer(self):
+		self.tx_timer = None
+		self.transmit()
+
+	def flush(self):
+		"""Write pending data without blocking. The rest is written once the port is ready to accept them."""
+		if self.tx_out:
+			try:
+				written = os.write(self.com.fileno(), self.tx_out)
+			except BlockingIOError:
+				written = 0
+			del self.tx_out[:written]
+			self.tx_written += written
+			while self.tx_marks and self.tx_marks[0][0] <= self.tx_written:
+				_, fut, dest, ts = self.tx_marks.popleft()
+				if fut and not fut.done():
+					fut.set_result(True)
+				if ts and self.latency_stats:
+					self.latency_stats.on_written(dest, *ts, perf_counter())
+		if self.tx_out and not self.tx_waiting:
+			self.loop.add_writer(self.com.fileno(), self.on_writable)
+			self.tx_waiting = True
+		elif not self.tx_out and self.tx_waiting:
+			self.loop.remove_writer(self.com.fileno())
+			self.tx_waiting = False
+
+	def on_writable(self):
+		self.flush()
+		self.update_ready()
+
+	def on_readable(self):
+		self.receive()
+		self.transmit()
+
+	def call_at(self, deadline, callback):
+		"""Schedule callback on the event loop at the given time of the monotonic clock"""
+		return self.loop.call_at(self.loop.time() + deadline - time.monotonic(), callback)
+
+	def call_later(self, delay, callback):
+		return self.loop.call_later(delay, callback)
+
+	def on_stall_timer(self):
+		super().on_stall_timer()
+		self.update_ready()
+
+	def use_msg_views(self, use = True):
+		"""Not supported since the messages are passed to the queues"""
+		raise NotImplementedError()
+
+	def use_aggregation(self, use = True, max_frame = None, delay = None):
+		"""Not supported since every message is awaited until written to the port"""
+		raise NotImplementedError()
+
+	def use_offload(self, offload = None):
+		"""Not supported, loop.run_in_executor may be used by the consumers of the queues instead"""
+		raise NotImplementedError()
+
+	async def send_data(self, data, binary=False, key=None):
+		"""Send data to connected central. Returns True once data are written to the port or False if they were dropped."""
+		await self.wait_ready(CENTRAL)
+		return await super().send_data(data, binary, key)
+
+	async def send_data_to(self, idx, data, binary=False, key=None):
+		"""Send data to peer given its index. Returns True once data are written to the port or False if they were dropped."""
+		await self.wait_ready(idx)
+		return await super().send_data_to(idx, data, binary, key)
+
+	def on_idle(self, hidden, version):
+		self.status_queue.put_nowait(('idle', hidden, version))
+
+	def on_connecting(self, idx):
+		self.status_queue.put_nowait(('connecting', idx))
+
+	def on_connected(self, hidden):
+		self.status_queue.put_nowait(('connected', hidden))
+
+	def on_central_msg(self, msg):
+		self.central_queue.put_nowait(msg)
+
+	def on_peer_msg(self, idx, msg):
+		self.peer_queue.put_nowait((idx, msg))
+
+async def echo(port, peers):
+	async with AsyncMutliAdapter(port) as ad:
+		async def echo_peers():
+			while True:
+				idx, msg = await ad.peer_queue.get()
+				print(('[%d] ' % idx) + msg.decode())
+				if msg:
+					await ad.send_data_to(idx, msg)
+		echo_task = asyncio.create_task(echo_peers())
+		ad.reset()
+		while True:
+			status = await ad.status_queue.get()
+			if status[0] == 'idle':
+				print('Idle, version ' + status[2].decode())
+				await ad.connect(peers)
+			elif status[0] == 'connecting':
+				print('Connecting to #%d' % status[1])
+
+if __name__ == '__main__':
+	port  = sys.argv[1]
+	peers = [addr.encode() for addr in sys.argv[2:]]
+	asyncio.run(echo(port, peers))
@@ -4,15 +4,608 @@ BLE multi adapter (ble_uart_mx) host interface
 Author: Oleg Volkov
 """
 
+import os
 import sys
 import time
+import select
+import heapq
+from time import perf_counter
 import base64
 import binascii
+import zlib
+from functools import partial
+from collections import deque, defaultdict, namedtuple
 from serial import Serial, PARITY_NONE, PARITY_EVEN
 
 STREAM_TAG_FIRST = ord('@')
 STREAM_TAGS_MOD = 191
 
+# Single byte objects for every possible tag value
+TAG_BYTES = [bytes((t,)) for t in range(256)]
+
+# The destination index used for connected central
+CENTRAL = -1
+
+# Starts the frame with aggregated messages
+AGGR_TAG = b'\x1d'
+
+# Starts the compressed message and the compression offer
+COMPR_TAG = b'\x1e'
+COMPR_OFFER_TAG = b'\x1f'
+
+# The record of the event received from adapter. The kind is one of 'idle', 'connecting', 'connected',
+# 'debug', 'central', 'peer', 'data' for simple adapter or 'result' for the offload handler result.
+# The idx is the peer index (CENTRAL for central), the data is the message received, the version for 'idle',
+# the debug message for 'debug' and the value returned by the handler for 'result' events.
+# The ts is the time the data were received by the monotonic clock.
+AdapterEvent = namedtuple('AdapterEvent', ('kind', 'idx', 'data', 'ts', 'hidden'), defaults=(False,))
+
+# Transmit queue overflow policies
+DROP_OLDEST = 'drop-oldest' # drop the oldest queued message
+DROP_NEWEST = 'drop-newest' # drop the message being queued
+REJECT      = 'reject'      # raise TxQueueFull
+COALESCE    = 'coalesce'    # replace queued message with the same key, drop the oldest one on overflow
+
+class TxQueueFull(Exception):
+	"""Raised on queueing message to the full transmit queue with REJECT policy"""
+	pass
+
+class TxScheduler:
+	"""Transmit queues per destination served in deficit round robin order so every destination
+	gets its fair share of the link. The control messages have their own queue served first.
+	The queued items are (msg, ctx) pairs where ctx is an arbitrary object supplied by the caller.
+	The items are timestamped on queueing so the pop method returns (msg, ctx, timestamp) tuples.
+	The number of messages and the amount of data queued per destination may be limited,
+	in such case the policy determines what happens on overflow.
+	"""
+	quantum   = 1024 # bytes
+	max_len   = None # max messages queued per destination
+	max_bytes = None # max bytes queued per destination
+	policy    = DROP_OLDEST
+
+	def __init__(self):
+		self.ctl_queue = deque()
+		self.queues  = {}
+		self.deficit = {}
+		self.nbytes  = {}
+		self.keyed   = {}
+		self.active  = deque()
+		self.size    = 0
+		self.drop_cnt  = {DROP_OLDEST: 0, DROP_NEWEST: 0, REJECT: 0, COALESCE: 0}
+		self.dest_drops = {}
+
+	def __len__(self):
+		return self.size
+
+	def __iter__(self):
+		"""Iterate over all queued (msg, ctx) items"""
+		for msg, ctx, _ in self.ctl_queue:
+			yield msg, ctx
+		for q in self.queues.values():
+			for msg, ctx, _, _ in q:
+				yield msg, ctx
+
+	def set_limits(self, max_len=None, max_bytes=None, policy=DROP_OLDEST):
+		"""Limit the number of messages and the amount of data queued per destination"""
+		self.max_len, self.max_bytes, self.policy = max_len, max_bytes, policy
+
+	def depth(self, dest):
+		"""Returns the number of messages queued for the given destination"""
+		q = self.queues.get(dest)
+		return len(q) if q else 0
+
+	def is_full(self, dest, size):
+		"""Check if adding size bytes to the given destination queue would exceed limits"""
+		return (self.max_len is not None and self.depth(dest) >= self.max_len) or \
+			(self.max_bytes is not None and self.nbytes.get(dest, 0) + size > self.max_bytes)
+
+	def count_drop(self, reason, dest):
+		self.drop_cnt[reason] += 1
+		self.dest_drops[dest] = self.dest_drops.get(dest, 0) + 1
+
+	def append(self, msg, dest, ctx=None, key=None):
+		"""Queue message for the given destination. The None destination is used for control messages.
+		With COALESCE policy the message replaces the queued one with the same key if any.
+		Returns the list of dropped (msg, ctx) items.
+		"""
+		ts = perf_counter()
+		if dest is None:
+			self.size += 1
+			self.ctl_queue.append((msg, ctx, ts))
+			return []
+		if key is not None and self.policy == COALESCE and (item := self.keyed.get((dest, key))):
+			# keep the queue position of the replaced message
+			self.count_drop(COALESCE, dest)
+			self.nbytes[dest] += len(msg) - len(item[0])
+			dropped = [(item[0], item[1])]
+			item[0], item[1], item[3] = msg, ctx, ts
+			while self.max_bytes is not None and self.nbytes[dest] > self.max_bytes:
+				# the bigger message does not fit, the replaced one may be dropped as well
+				self.count_drop(DROP_OLDEST, dest)
+				dropped.append(self.drop_from(dest))
+			return dropped
+		dropped = []
+		while self.is_full(dest, len(msg)):
+			# the message not fitting into the empty queue is rejected as well
+			if self.policy == REJECT:
+				self.count_drop(REJECT, dest)
+				raise TxQueueFull()
+			if self.policy == DROP_NEWEST or not self.depth(dest):
+				self.count_drop(DROP_NEWEST, dest)
+				return [(msg, ctx)]
+			self.count_drop(DROP_OLDEST, dest)
+			dropped.append(self.drop_from(dest))
+		if not (q := self.queues.get(dest)):
+			if q is None:
+				q = self.queues[dest] = deque()
+				self.nbytes[dest] = 0
+			self.active.append(dest)
+			self.deficit[dest] = 0
+		item = [msg, ctx, key, ts]
+		if key is not None:
+			self.keyed[(dest, key)] = item
+		q.append(item)
+		self.nbytes[dest] += len(msg)
+		self.size += 1
+		return dropped
+
+	def drop_from(self, dest):
+		"""Drop the first message from the given destination queue. Returns the (msg, ctx) item."""
+		return self.pop_from(dest, False)[:2]
+
+	def pop_from(self, dest, sent=True):
+		"""Remove the first message from the given destination queue. The message dropped
+		rather than sent does not use up the destination share of the link.
+		"""
+		q = self.queues[dest]
+		item = q.popleft()
+		msg, ctx, key, ts = item
+		self.size -= 1
+		self.nbytes[dest] -= len(msg)
+		if key is not None and self.keyed.get((dest, key)) is item:
+			del self.keyed[(dest, key)]
+		if q:
+			if sent and self.active[0] == dest:
+				self.deficit[dest] -= len(msg)
+		else:
+			if self.active[0] == dest:
+				self.active.popleft()
+				if self.active:
+					self.deficit[self.active[0]] += self.quantum
+			else:
+				self.active.remove(dest)
+		return msg, ctx, ts
+
+	def pop(self, ready=None):
+		"""Returns the next (msg, ctx, timestamp) item to be sent or None if there are none.
+		The destinations for which ready(dest) predicate returns False are skipped if it is given.
+		"""
+		if self.ctl_queue:
+			self.size -= 1
+			return self.ctl_queue.popleft()
+		active, queues, deficit = self.active, self.queues, self.deficit
+		skipped = 0
+		while active:
+			dest = active[0]
+			if ready and not ready(dest):
+				# the destination does not accumulate its share while waiting
+				deficit[dest] = 0
+				if (skipped := skipped + 1) >= len(active):
+					return None
+			elif len(queues[dest][0][0]) <= deficit[dest]:
+				return self.pop_from(dest)
+			else:
+				skipped = 0
+			# the destination used its share, pass turn to the next one
+			active.rotate(-1)
+			deficit[active[0]] += self.quantum
+		return None
+
+	def has_ready(self, ready=None):
+		"""Check if there are messages to be sent. The ready(dest) predicate is applied to destinations if given."""
+		if self.ctl_queue or (self.size and not ready):
+			return True
+		return any(ready(dest) for dest in self.active) if ready else False
+
+	def clear(self):
+		self.ctl_queue.clear()
+		self.queues.clear()
+		self.deficit.clear()
+		self.nbytes.clear()
+		self.keyed.clear()
+		self.active.clear()
+		self.size = 0
+
+class Timer:
+	"""The handle of the callback scheduled at the given deadline of the monotonic clock"""
+	__slots__ = ('deadline', 'callback', 'cancelled')
+
+	def __init__(self, deadline, callback):
+		self.deadline = deadline
+		self.callback = callback
+		self.cancelled = False
+
+	def __lt__(self, other):
+		return self.deadline < other.deadline
+
+	def cancel(self):
+		self.cancelled = True
+
+class TimerScheduler:
+	"""The heap of timers ordered by deadline. The cancelled timers are dropped once they reach the heap top."""
+	def __init__(self):
+		self.heap = []
+
+	def __len__(self):
+		return len(self.heap)
+
+	def call_at(self, deadline, callback):
+		timer = Timer(deadline, callback)
+		heapq.heappush(self.heap, timer)
+		return timer
+
+	def call_later(self, delay, callback):
+		return self.call_at(time.monotonic() + delay, callback)
+
+	def next_deadline(self):
+		"""Returns the deadline of the first timer or None if there are no one"""
+		heap = self.heap
+		while heap and heap[0].cancelled:
+			heapq.heappop(heap)
+		return heap[0].deadline if heap else None
+
+	def timeout(self):
+		"""Returns the time till the first deadline or None if there are no timers"""
+		if (deadline := self.next_deadline()) is None:
+			return None
+		return max(0, deadline - time.monotonic())
+
+	def run(self):
+		"""Call callbacks of the timers that are due. The callbacks may schedule new timers."""
+		heap = self.heap
+		if not heap:
+			return
+		now = time.monotonic()
+		while heap and heap[0].deadline <= now:
+			timer = heapq.heappop(heap)
+			if not timer.cancelled:
+				timer.callback()
+
+	def clear(self):
+		self.heap.clear()
+
+class AdapterStats:
+	"""Adapter communication statistics. The counters are updated by the adapter while the rates
+	are calculated on request over the sliding window of samples taken by the adapter at most once per second.
+	The sampling times are taken from the monotonic clock.
+	"""
+	window       = 10   # sec, rates averaging window
+	max_gaps     = 64   # max stream tag gaps to keep
+	rate_counters = ('rx_bytes', 'tx_bytes', 'rx_frames', 'tx_frames')
+
+	def __init__(self):
+		self.rx_bytes = 0
+		self.tx_bytes = 0
+		self.rx_frames = 0
+		self.tx_frames = 0
+		self.decode_errors = 0
+		self.stall_cnt = 0
+		self.aggr_tx = 0 # messages packed into aggregated frames
+		self.aggr_rx = 0 # messages unpacked from aggregated frames
+		self.compr_in = 0 # bytes submitted to compression
+		self.compr_out = 0 # bytes sent after compression including the ones sent as is
+		self.compr_skipped = 0 # messages sent as is since compression does not make them shorter
+		self.compr_time = 0 # sec, CPU time spent on compression
+		self.decompr_time = 0 # sec, CPU time spent on decompression
+		self.peer_rx = defaultdict(int) # messages received per peer index or CENTRAL
+		self.peer_tx = defaultdict(int) # messages sent per peer index or CENTRAL
+		self.tag_gaps = deque(maxlen=self.max_gaps) # (timestamp, expected tag, received tag) tuples
+		self.samples = deque()
+		self.sample_ts = 0
+
+	def counters(self):
+		return tuple(getattr(self, name) for name in self.rate_counters)
+
+	def sample(self, now):
+		"""Take the sample of counters used to calculate rates. Called by the adapter periodically."""
+		if now < self.sample_ts + 1:
+			return
+		self.sample_ts = now
+		self.samples.append((now, self.counters()))
+		while self.samples[0][0] < now - self.window:
+			self.samples.popleft()
+
+	def rates(self, now):
+		"""Returns the dict with rates per second of the counters over the window ending now.
+		May be called from any thread.
+		"""
+		samples, start = list(self.samples), now - self.window
+		# no samples are taken while the adapter is stalled so all of them may be older than the window,
+		# the rates are counted since the last one then so they drop to zero if nothing is transferred
+		ts, first = next((s for s in samples if s[0] >= start), samples[-1] if samples else (now, self.counters()))
+		dt = now - ts
+		return {name + '_rate': (v - v0) / dt if dt > 0 else 0.
+			for name, v, v0 in zip(self.rate_counters, self.counters(), first)}
+
+	def as_dict(self, now):
+		return {
+			'rx_bytes': self.rx_bytes, 'tx_bytes': self.tx_bytes,
+			'rx_frames': self.rx_frames, 'tx_frames': self.tx_frames,
+			'decode_errors': self.decode_errors, 'stall_cnt': self.stall_cnt,
+			'aggr_tx': self.aggr_tx, 'aggr_rx': self.aggr_rx,
+			'compr_in': self.compr_in, 'compr_out': self.compr_out, 'compr_skipped': self.compr_skipped,
+			'compr_ratio': self.compr_in / self.compr_out if self.compr_out else 1.,
+			'compr_time': self.compr_time, 'decompr_time': self.decompr_time,
+			'peer_rx': dict(self.peer_rx), 'peer_tx': dict(self.peer_tx),
+			'tag_gaps': list(self.tag_gaps),
+			**self.rates(now)
+		}
+
+class LatencyHistogram:
+	"""Compact log-linear (HDR style) histogram of latencies. The values are recorded in seconds with
+	microsecond resolution and about 3% precision. The bucket counts are kept in the list growing on demand.
+	"""
+	sub_bits = 6 # every power of 2 range is split onto 2**(sub_bits-1) buckets
+
+	def __init__(self):
+		self.counts = []
+		self.total = 0
+		self.sum = 0.
+		self.min = None
+		self.max = None
+
+	def bucket(self, usec):
+		if (bits := usec.bit_length()) <= self.sub_bits:
+			return usec
+		shift = bits - self.sub_bits
+		return (shift << (self.sub_bits - 1)) + (usec >> shift)
+
+	def bucket_value(self, idx):
+		"""Returns the middle of the value range of the given bucket in microseconds"""
+		half = 1 << (self.sub_bits - 1)
+		if idx < 2 * half:
+			return idx
+		shift = idx // half - 1
+		return ((idx - shift * half) << shift) + (1 << (shift - 1))
+
+	def record(self, value):
+		"""Record value given in seconds"""
+		usec = int(value * 1e6) if value > 0 else 0
+		if (idx := self.bucket(usec)) >= len(self.counts):
+			self.counts.extend([0] * (idx + 1 - len(self.counts)))
+		self.counts[idx] += 1
+		self.total += 1
+		self.sum += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def merge(self, other):
+		"""Add counts of other histogram to this one"""
+		if len(other.counts) > len(self.counts):
+			self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+		for idx, cnt in enumerate(other.counts):
+			self.counts[idx] += cnt
+		self.total += other.total
+		self.sum += other.sum
+		if other.min is not None and (self.min is None or other.min < self.min):
+			self.min = other.min
+		if other.max is not None and (self.max is None or other.max > self.max):
+			self.max = other.max
+
+	def percentile(self, p):
+		"""Returns the value in seconds below which the given percent of recorded values fall"""
+		if not self.total:
+			return None
+		thr, cnt = self.total * p / 100, 0
+		for idx, c in enumerate(self.counts):
+			cnt += c
+			if cnt >= thr:
+				return min(max(self.bucket_value(idx) / 1e6, self.min), self.max)
+		return self.max
+
+	def summary(self):
+		"""Returns dict with count, min, mean, p50, p99, p999 and max values in seconds"""
+		return {
+			'count': self.total, 'min': self.min, 'mean': self.sum / self.total if self.total else None,
+			'p50': self.percentile(50), 'p99': self.percentile(99), 'p999': self.percentile(99.9), 'max': self.max
+		}
+
+class LatencyStats:
+	"""The histograms of the time messages spent in transmit queue and the time taken by writing
+	them to the port per destination
+	"""
+	def __init__(self):
+		self.queue_wait = defaultdict(LatencyHistogram)
+		self.write_time = defaultdict(LatencyHistogram)
+
+	def on_written(self, dest, submit_ts, write_ts, done_ts):
+		self.queue_wait[dest].record(write_ts - submit_ts)
+		self.write_time[dest].record(done_ts - write_ts)
+
+	def summary(self):
+		return {
+			'queue_wait': {dest: h.summary() for dest, h in list(self.queue_wait.items())},
+			'write_time': {dest: h.summary() for dest, h in list(self.write_time.items())},
+		}
+
+def varint_size(n):
+	"""Returns the number of bytes in varint representation of the given number"""
+	size = 1
+	while n >= 0x80:
+		n >>= 7
+		size += 1
+	return size
+
+def encode_varint(n, out):
+	"""Append varint (7 bits per byte starting from the least significant ones) representation of the number"""
+	while n >= 0x80:
+		out.append(n & 0x7f | 0x80)
+		n >>= 7
+	out.append(n)
+
+def unpack_aggregated(frame):
+	"""Returns the list of messages packed into the frame by Aggregator, raises ValueError if it is malformed"""
+	msgs, pos, end = [], len(AGGR_TAG), len(frame)
+	while pos < end:
+		size = shift = 0
+		while True:
+			if pos >= end or shift > 28:
+				raise ValueError('bad message length')
+			b = frame[pos]
+			pos += 1
+			size |= (b & 0x7f) << shift
+			shift += 7
+			if b < 0x80:
+				break
+		if pos + size > end:
+			raise ValueError('truncated message')
+		msgs.append(frame[pos:pos + size])
+		pos += size
+	return msgs
+
+class Aggregator:
+	"""Packs small messages into single frame. The frame starts with AGGR_TAG followed by
+	the messages each one preceded by its length encoded as varint.
+	"""
+	def __init__(self):
+		self.buff = bytearray()
+		self.ts = None # the time the first message was packed
+
+	def __len__(self):
+		return len(self.buff)
+
+	def add(self, data, now):
+		if not self.buff:
+			self.buff += AGGR_TAG
+			self.ts = now
+		encode_varint(len(data), self.buff)
+		self.buff += data
+
+	def flush(self):
+		"""Returns the frame and clears the buffer"""
+		frame = bytes(self.buff)
+		del self.buff[:]
+		self.ts = None
+		return frame
+
+class CobsCodec:
+	"""Consistent overhead byte stuffing avoiding two reserved symbols - the message end and start tags.
+	The data is split onto runs of literal bytes, each one preceded by the code byte telling its length
+	and what follows it. The codes below max_run are followed by that number of literals and the first
+	reserved symbol, the next max_run codes by literals and the second reserved symbol. The last two codes
+	stand for runs of max_run and 2*max_run literals without reserved symbol following. The code bytes
+	themselves skip both reserved symbols. The first reserved symbol is implicitly appended to the data
+	so the last run always ends with it. The encoded data is at most len/max_run + 1 bytes longer
+	so the overhead is about 0.8% in the worst case.
+	"""
+	max_run  = 126
+	code_r1  = max_run
+	code_run = 2*max_run
+	code_run2 = 2*max_run + 1
+
+	def __init__(self, r0, r1):
+		self.r0, self.r1 = r0, r1
+		lo, hi = sorted((r0[0], r1[0]))
+		self.symbols = [c + (c >= lo) + (c + (c >= lo) >= hi) for c in range(2*self.max_run + 2)]
+		self.codes = [None] * 256
+		for c, b in enumerate(self.symbols):
+			self.codes[b] = c
+		# maps the second reserved symbol to the first one so the data may be split at both
+		self.merge = bytes.maketrans(r1, r0)
+
+	@staticmethod
+	def for_tags(start_tag, end_tag):
+		"""Returns codec avoiding given message start and end tags"""
+		return CobsCodec(end_tag, start_tag or (b'\1' if end_tag == b'\0' else b'\0'))
+
+	def encode(self, data):
+		out, symbols, r0, max_run = bytearray(), self.symbols, self.r0[0], self.max_run
+		runs = data.translate(self.merge).split(self.r0)
+		pos, last = 0, len(runs) - 1
+		for i, run in enumerate(runs):
+			n, off = len(run), 0
+			while n - off >= max_run:
+				k = 2*max_run if n - off >= 2*max_run else max_run
+				out.append(symbols[self.code_run2 if k > max_run else self.code_run])
+				out += run[off:off + k]
+				off += k
+			pos += n
+			out.append(symbols[n - off if i == last or data[pos] == r0 else self.code_r1 + n - off])
+			out += run[off:] if off else run
+			pos += 1
+		return bytes(out)
+
+	def decode(self, data):
+		"""Decode data, raises ValueError if it is malformed"""
+		out, codes, pos, end = bytearray(), self.codes, 0, len(data)
+		max_run, term = self.max_run, None
+		while pos < end:
+			if (code := codes[data[pos]]) is None:
+				raise ValueError('invalid code')
+			if term is not None:
+				out.append(term)
+			if code < self.code_r1:
+				n, term = code, self.r0[0]
+			elif code < self.code_run:
+				n, term = code - self.code_r1, self.r1[0]
+			else:
+				n, term = max_run if code == self.code_run else 2*max_run, None
+			if pos + 1 + n > end:
+				raise ValueError('truncated data')
+			out += data[pos + 1:pos + 1 + n]
+			pos += 1 + n
+		if term != self.r0[0]:
+			raise ValueError('unterminated data')
+		return bytes(out)
+
+class Compressor:
+	"""Compresses messages with zlib primed with the preset dictionary. Every message is compressed
+	independently so it may be decompressed regardless of the other messages being lost or reordered.
+	The dictionary should contain the strings the messages are likely to have, the most common ones
+	at its end. The peers agree to compress messages by exchanging offers with the dictionary checksum.
+	"""
+	wbits    = 12 # 4KB window, the dictionary should not be longer
+	mem_level = 4
+	max_size = 64*1024 # decompressed message size limit
+
+	def __init__(self, zdict=b'', level=6):
+		self.zdict = zdict
+		self.level = level
+		self.dict_id = zlib.crc32(zdict)
+
+	def compress(self, data):
+		c = zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits, self.mem_level, zdict=self.zdict)
+		return c.compress(data) + c.flush()
+
+	def store(self, data):
+		"""Returns data packed into the stored (not compressed) block which does not depend on the dictionary"""
+		c = zlib.compressobj(0, zlib.DEFLATED, -self.wbits)
+		return c.compress(data) + c.flush()
+
+	def decompress(self, data):
+		"""Decompress data, raises ValueError if they are malformed"""
+		d = zlib.decompressobj(-self.wbits, zdict=self.zdict)
+		try:
+			out = d.decompress(data, self.max_size)
+		except zlib.error as e:
+			raise ValueError(str(e))
+		if not d.eof or d.unconsumed_tail or d.unused_data:
+			raise ValueError('bad compressed data')
+		return out
+
+	def offer(self, ack):
+		"""Returns the offer message. The ack tells if the offer from the peer was received."""
+		return COMPR_OFFER_TAG + self.dict_id.to_bytes(4, byteorder='big') + (b'\1' if ack else b'\0')
+
+class ComprPeer:
+	"""Compression negotiation state of the particular peer"""
+	def __init__(self):
+		self.enabled = False # the peer offered compression with the same dictionary
+		self.acked = False   # the peer received our offer
+		self.offer_ts = None # the time our offer was sent last time
+
 class AdapterConnection:
 	"""BLE multi-adapter core communication interface class"""
 	baud_rate   = 115200
@@ -21,23 +614,51 @@ class AdapterConnection:
 	start_tag   = b'\1'
 	end_tag     = b'\0'
 	b64_tag     = b'\2'
+	cobs_tag    = b'\3'
+	cobs_encoding = False # Encode binary data with COBS rather than base64
 	use_tags    = True
 	opt_tags    = True
 	rtscts      = True
 	timeout     = .01
 	rx_buf_size = 4*4096
 	tx_buf_size = 4096
+	rx_chunk    = 4096
+	rx_max_frame = 64*1024 # unterminated data longer than that are dropped
 	congest_thr = 16
+	tx_batch    = False # Write all queued messages at once
+	aggregate   = False # Pack small messages into larger frames
+	aggr_delay  = .02   # sec, max time the message may wait for others to be packed with it
+	compr_offer_interval = 1 # sec, min interval between compression offers
+	msg_views   = False # Pass received data to callbacks as memoryview objects
 
 	def __init__(self, port):
-		self.port    = port
-		self.com     = None
-		self.rx_buff = b''
+		self.port     = port
+		self.com      = None
+		self.rx_buff  = bytearray()
+		self.rx_scan  = 0
+		self.rx_begin = -1
 		self.parse_errors = 0
 		self.lost_frames = 0
-		self.tx_queue = []
+		self.stats = AdapterStats()
+		self.latency_stats = None
+		self.cobs_codec = None
+		self.aggr = {}
+		self.aggr_frame = None
+		self.compressor = None
+		self.compr_peers = {}
+		self.capture = None
+		self.offload = None
+		self.timers = TimerScheduler()
+		self.rx_events = None
+		self.rx_ts = 0
+		self.tx_queue = TxScheduler()
+		self.tx_buff  = bytearray()
 		self.last_tx_tag = STREAM_TAG_FIRST - 1
 		self.last_rx_tag = 0
+		self.wake_r = self.wake_w = None
+		self.waiting = False
+		self.running = False
+		self.nowait  = False
 
 	def __enter__(self):
 		self.open()
@@ -54,20 +675,32 @@ class AdapterConnection:
 			rtscts=self.rtscts,
 			timeout=self.timeout
 		)
-		self.com.set_buffer_size(
-			rx_size = self.rx_buf_size,
-			tx_size = self.tx_buf_size
-		)
+		if hasattr(self.com, 'set_buffer_size'):
+			# Only supported on Windows
+			self.com.set_buffer_size(
+				rx_size = self.rx_buf_size,
+				tx_size = self.tx_buf_size
+			)
+		if os.name == 'posix':
+			# The pipe used to wake up wait_io
+			self.wake_r, self.wake_w = os.pipe()
+			os.set_blocking(self.wake_r, False)
+			os.set_blocking(self.wake_w, False)
 
 	def close(self):
 		if self.com:
 			self.com.close()
 			self.com = None
+		if self.wake_r is not None:
+			os.close(self.wake_r)
+			os.close(self.wake_w)
+			self.wake_r = self.wake_w = None
 
 	def set_start_end_tags(self, tstart, tend):
 		"""Set non default start / end tags"""
 		self.start_tag = tstart
 		self.end_tag   = tend
+		self.cobs_codec = None
 
 	def set_terminator(self, tend):
 		"""Set end tag while not using start tag"""
@@ -80,6 +713,261 @@ class AdapterConnection:
 	def use_stream_tags(self, use = True):
 		self.use_tags = use
 
+	def use_msg_views(self, use = True):
+		"""Pass data received to the callbacks as memoryview objects rather than bytes so they may be parsed
+		without copying. The view may refer to the receive buffer so it is valid only until the callback returns.
+		The callback should copy the data it keeps.
+		"""
+		self.msg_views = use
+
+	def use_cobs_encoding(self, use = True):
+		"""Encode binary data with consistent overhead byte stuffing rather than base64.
+		The adapter should be built with COBS_ENCODING option.
+		"""
+		self.cobs_encoding = use
+
+	def get_cobs_codec(self):
+		if self.cobs_codec is None:
+			self.cobs_codec = CobsCodec.for_tags(self.start_tag, self.end_tag)
+		return self.cobs_codec
+
+	def use_aggregation(self, use = True, max_frame = None, delay = None):
+		"""Pack data messages sent without key into frames up to max_frame bytes. The frame is sent once
+		the next message does not fit or after delay seconds since the first message was packed. The frames
+		received are unpacked if aggregation is enabled so the other side should enable it as well.
+		The max_frame defaults to the maximum frame size reported by the multi adapter.
+		"""
+		self.aggregate = use
+		self.aggr_frame = max_frame
+		if delay is not None:
+			self.aggr_delay = delay
+		if not use:
+			self.flush_aggregated()
+
+	def aggr_limit(self):
+		"""Returns the max size of aggregated frame or None if it is not known"""
+		return self.aggr_frame
+
+	def aggr_add(self, idx, data, binary, key=None):
+		"""Pack message to the given destination into aggregated frame. The message sent with key or not fitting
+		into the frame is sent on its own. Returns the list of items dropped on queueing the previous frame.
+		"""
+		rec_size = varint_size(len(data)) + len(data)
+		if key is not None or not (limit := self.aggr_limit()) or len(AGGR_TAG) + rec_size > limit:
+			if data[:1] == AGGR_TAG:
+				# packed alone so the receiver does not take it for aggregated frame
+				ag = Aggregator()
+				ag.add(data, None)
+				data, binary = ag.flush(), True
+			return self.send_frame(idx, data, binary, key)
+		if not (ag := self.aggr.get(idx)):
+			ag = self.aggr[idx] = Aggregator()
+		dropped = []
+		if ag and len(ag) + rec_size > limit:
+			dropped = self.send_frame(idx, ag.flush(), True)
+		ag.add(data, time.monotonic())
+		self.stats.aggr_tx += 1
+		return dropped
+
+	def flush_aggregated(self, now=None):
+		"""Send aggregated frames waiting for aggr_delay or all of them if the time is not given"""
+		for idx, ag in self.aggr.items():
+			if ag and (now is None or now >= ag.ts + self.aggr_delay):
+				self.send_frame(idx, ag.flush(), True)
+
+	def aggr_timeout(self):
+		"""Returns the time till the next aggregated frame should be sent or None if there are no one"""
+		if not self.aggr:
+			return None
+		now = time.monotonic()
+		return min((max(0, ag.ts + self.aggr_delay - now) for ag in self.aggr.values() if ag), default=None)
+
+	def unpack_data(self, data):
+		"""Returns the list of messages received in aggregated frame or None if the data are not aggregated"""
+		if not self.aggregate or data[:1] != AGGR_TAG:
+			return None
+		try:
+			msgs = unpack_aggregated(data)
+		except ValueError:
+			self.parse_errors += 1
+			self.stats.decode_errors += 1
+			return []
+		self.stats.aggr_rx += len(msgs)
+		return msgs
+
+	def use_compression(self, use = True, zdict = b'', level = 6):
+		"""Compress data messages with zlib primed with the preset dictionary. The messages are compressed
+		once the peer offered compression with the same dictionary, so the compression is negotiated
+		with every peer on every connection. The messages that do not get shorter are sent as is.
+		The other side should enable compression as well since offers are sent along with data messages.
+		"""
+		self.compressor = Compressor(zdict, level) if use else None
+		self.compr_peers.clear()
+
+	def get_compr_peer(self, idx):
+		if not (peer := self.compr_peers.get(idx)):
+			peer = self.compr_peers[idx] = ComprPeer()
+		return peer
+
+	def reset_compr_peer(self, idx):
+		"""Forget the compression negotiated with the peer so it is negotiated anew on its next connection"""
+		self.compr_peers.pop(idx, None)
+
+	def send_compr_offer(self, idx, peer, now):
+		peer.offer_ts = now
+		self.send_frame(idx, self.compressor.offer(peer.enabled), True, compress=False)
+
+	def compress_data(self, idx, data, binary):
+		"""Returns (data, binary) tuple to be sent to the given peer with data compressed if it is allowed
+		and makes the encoded data shorter. Sends compression offer if the peer did not receive it yet.
+		"""
+		peer = self.get_compr_peer(idx)
+		if not peer.acked:
+			now = time.monotonic()
+			if peer.offer_ts is None or now >= peer.offer_ts + self.compr_offer_interval:
+				self.send_compr_offer(idx, peer, now)
+		if not peer.enabled:
+			if data[:1] in (COMPR_TAG, COMPR_OFFER_TAG):
+				# the peer may interpret the tag once it enables compression so the data are escaped
+				return COMPR_TAG + self.compressor.store(data), True
+			return data, binary
+		start = time.process_time()
+		compressed = COMPR_TAG + self.compressor.compress(data)
+		self.stats.compr_time += time.process_time() - start
+		self.stats.compr_in += len(data)
+		size = self.binary_size(len(data)) if binary else len(data)
+		if self.binary_size(len(compressed)) < size or data[:1] in (COMPR_TAG, COMPR_OFFER_TAG):
+			self.stats.compr_out += len(compressed)
+			return compressed, True
+		self.stats.compr_skipped += 1
+		self.stats.compr_out += len(data)
+		return data, binary
+
+	def decompress_data(self, idx, data):
+		"""Returns decompressed data received from the given peer, the data as is if they are not compressed
+		or None if the data are malformed or consumed by compression negotiation.
+		"""
+		if (tag := data[:1]) == COMPR_OFFER_TAG and len(data) == 6:
+			self.on_compr_offer(idx, data)
+			return None
+		if tag != COMPR_TAG:
+			return data
+		peer = self.get_compr_peer(idx)
+		# the stored block does not depend on the dictionary, it is used to escape data starting with the tag
+		stored = len(data) > 1 and not data[1] & 6
+		if not peer.enabled and not stored:
+			# the peer not offering compression sends data as is
+			return data
+		if not stored:
+			# the peer compresses data once it has received our offer
+			peer.acked = True
+		start = time.process_time()
+		try:
+			data = self.compressor.decompress(data[1:])
+		except ValueError:
+			if not peer.enabled:
+				return data
+			self.parse_errors += 1
+			self.stats.decode_errors += 1
+			return None
+		finally:
+			self.stats.decompr_time += time.process_time() - start
+		return data
+
+	def on_compr_offer(self, idx, offer):
+		if len(offer) != 6 or int.from_bytes(offer[1:5], byteorder='big') != self.compressor.dict_id:
+			return
+		peer = self.get_compr_peer(idx)
+		peer.enabled = True
+		if offer[5]:
+			peer.acked = True
+		else:
+			# the peer did not receive our offer yet
+			self.send_compr_offer(idx, peer, time.monotonic())
+
+	def receive_data(self, idx, msg):
+		"""Returns the list of data messages carried by the frame received from the given peer.
+		The messages are memoryview objects if msg_views is enabled or bytes otherwise.
+		"""
+		if not msg:
+			# the empty message starts the stream on every connection of the peer
+			self.reset_compr_peer(idx)
+		if (data := self.decode_data(msg)) is None:
+			return ()
+		if self.compressor and (data := self.decompress_data(idx, data)) is None:
+			return ()
+		if self.aggregate and (msgs := self.unpack_data(data)) is not None:
+			if self.msg_views:
+				return [m if type(m) is memoryview else memoryview(m) for m in msgs]
+			return [bytes(m) if type(m) is memoryview else m for m in msgs]
+		if self.msg_views:
+			return (data if type(data) is memoryview else memoryview(data),)
+		return (bytes(data) if type(data) is memoryview else data,)
+
+	def send_frame(self, idx, data, binary=False, key=None, compress=True):
+		raise NotImplementedError()
+
+	def use_capture(self, capture = None):
+		"""Record raw data received from and written to the port by calling rx(data) and tx(data)
+		methods of the capture object (see CaptureLog in mx_capture.py) or stop recording if it is None.
+		"""
+		self.capture = capture
+
+	def use_offload(self, offload = None):
+		"""Pass the data received from peers and central to the offload object (see Offload in ble_offload.py)
+		processing them in the process pool or stop passing them if it is None. The on_offload_result callback
+		is called with the results instead of calling on_peer_msg / on_central_msg with the data.
+		"""
+		if offload:
+			offload.notify = self.offload_done
+		self.offload = offload
+
+	def offload_done(self):
+		"""Called by offload from other thread once the result is ready"""
+		self.wakeup()
+
+	def call_at(self, deadline, callback):
+		"""Schedule callback to be called by communicate at the given time of the monotonic clock.
+		Returns the timer handle having cancel() method. Should be called by the thread running communicate.
+		"""
+		return self.timers.call_at(deadline, callback)
+
+	def call_later(self, delay, callback):
+		"""Schedule callback to be called by communicate after the given delay in seconds"""
+		return self.timers.call_later(delay, callback)
+
+	def use_latency_stats(self, use = True):
+		"""Collect histograms of the time messages spent in transmit queue and the time of writing them to the port"""
+		self.latency_stats = LatencyStats() if use else None
+
+	def get_latency(self):
+		"""Returns latency percentiles per destination or None if latency statistics is not collected.
+		May be called from any thread.
+		"""
+		if not self.latency_stats:
+			return None
+		summary = self.latency_stats.summary()
+		return {kind: {self.dest_key(dest): s for dest, s in hists.items()} for kind, hists in summary.items()}
+
+	def dest_key(self, dest):
+		"""Returns the key used to report statistics for the given transmit queue"""
+		return dest
+
+	def use_tx_batch(self, use = True):
+		"""Write queued messages in batches up to tx_buf_size bytes each rather than one by one"""
+		self.tx_batch = use
+
+	def set_tx_limits(self, max_len=None, max_bytes=None, policy=DROP_OLDEST):
+		"""Limit the number of messages and the amount of data queued per destination.
+		The policy determines what to do on overflow: DROP_OLDEST, DROP_NEWEST, REJECT or COALESCE.
+		The latter replaces the queued message submitted with the same key by the new one.
+		"""
+		self.tx_queue.set_limits(max_len, max_bytes, policy)
+
+	def tx_drops(self):
+		"""Returns the dict with the number of messages dropped per overflow policy"""
+		return self.tx_queue.drop_cnt
+
 	def is_congested(self):
 		return len(self.tx_queue) > self.congest_thr
 
@@ -102,108 +990,381 @@ class AdapterConnection:
 	def get_closing_tag(open_tag, msg_len):
 		return STREAM_TAG_FIRST + (open_tag - STREAM_TAG_FIRST + msg_len) % STREAM_TAGS_MOD;
 
-	def write_msg(self, msg):
-		"""Write message to the adapter"""
+	def encode_msg(self, msg):
+		"""Returns message representation on the wire"""
 		if self.use_tags:
 			topen  = self.get_next_tag()
 			tclose = self.get_closing_tag(topen, len(msg))
-			wire_msg = b''.join((self.start_tag, 
-					bytes([topen]),
+			return b''.join((self.start_tag,
+					TAG_BYTES[topen],
 					msg,
-					bytes([tclose]),
+					TAG_BYTES[tclose],
 					self.end_tag
 				))
 		else:
-			wire_msg = b''.join((self.start_tag,
+			return b''.join((self.start_tag,
 					msg,
 					self.end_tag
 				))
+
+	def encode_msg_into(self, msg, out):
+		"""Append message representation on the wire to the given bytearray"""
+		out += self.start_tag
+		if self.use_tags:
+			topen = self.get_next_tag()
+			out += TAG_BYTES[topen]
+			out += msg
+			out += TAG_BYTES[self.get_closing_tag(topen, len(msg))]
+		else:
+			out += msg
+		out += self.end_tag
+
+	def write_msg(self, msg):
+		"""Write message to the adapter"""
+		wire_msg = self.encode_msg(msg)
+		if self.capture:
+			self.capture.tx(wire_msg)
 		self.com.write(wire_msg)
+		self.stats.tx_bytes += len(wire_msg)
+		self.stats.tx_frames += 1
 
 	def receive(self):
 		"""Receive from adapter"""
-		while rx_bytes := self.com.read(4096):
-			self.process_rx(rx_bytes)
+		read = self.read_nowait if self.nowait else self.com.read
+		chunk, end_tag, stats, offload = self.rx_chunk, self.end_tag, self.stats, self.offload
+		while not (offload and offload.is_full()):
+			if not (rx_bytes := read(chunk)):
+				break
+			self.rx_buff += rx_bytes
+			self.rx_ts = time.monotonic()
+			stats.rx_bytes += len(rx_bytes)
+			if self.capture:
+				self.capture.rx(rx_bytes)
+			if rx_bytes.find(end_tag) >= 0 or len(self.rx_buff) > self.rx_max_frame:
+				# some frames are completed or unterminated data should be dropped
+				self.parse_rx()
+
+	def rx_paused(self):
+		"""Returns True if reading the port is suspended until the offloaded messages are processed"""
+		return self.offload is not None and self.offload.is_full()
+
+	def read_nowait(self, size):
+		"""Read data available in the port without blocking. The port is opened in non-blocking mode on POSIX."""
+		try:
+			return os.read(self.com.fileno(), size)
+		except BlockingIOError:
+			return b''
 
 	def can_transmit(self):
 		return True
 
 	def communicate(self):
 		"""Communicate with adapter"""
+		self.timers.run()
+		if self.aggr:
+			self.flush_aggregated(time.monotonic())
 		self.receive()
-		if not (can_tx := self.can_transmit()):
+		if self.offload:
+			self.offload.poll(self.on_offload_result)
+		if self.tx_batch:
+			self.transmit_batch()
 			return
-		tx_queue = self.tx_queue
-		self.tx_queue, delay_queue = [], []
-		for msg in tx_queue:
-			if can_tx and self.can_transmit():
+		tx_queue, latency = self.tx_queue, self.latency_stats
+		while tx_queue and self.can_transmit() and (item := self.pop_tx()):
+			msg, _, ts = item
+			if latency:
+				write_ts = perf_counter()
 				self.write_msg(msg)
-				self.receive()
+				latency.on_written(self.tx_dest(msg), ts, write_ts, perf_counter())
 			else:
-				can_tx = False
-				delay_queue.append(msg)
-		self.tx_queue = delay_queue + self.tx_queue
+				self.write_msg(msg)
+			self.receive()
+
+	def has_work(self):
+		"""Returns True if communicate should be called without waiting for input"""
+		if self.offload and self.offload.has_work():
+			return True
+		return bool(self.tx_queue) and self.can_transmit() and self.tx_queue.has_ready(self.tx_eligible())
+
+	def next_timeout(self):
+		"""Returns the max time in seconds to wait for input before calling communicate or None to wait forever"""
+		timeout = self.timers.timeout()
+		for t in (self.aggr_timeout(), self.tx_timeout()):
+			if t is not None:
+				timeout = t if timeout is None else min(t, timeout)
+		return timeout
+
+	def tx_eligible(self):
+		"""Returns the predicate checking if the queued messages may be sent to the given destination now
+		or None if sending is not restricted
+		"""
+		return None
+
+	def tx_timeout(self):
+		"""Returns the time till the queued messages may be sent if they are held back or None"""
+		return None
 
-	def submit_msg(self, msg):
-		self.tx_queue.append(msg)
+	def pop_tx(self):
+		"""Returns the next (msg, ctx, timestamp) item allowed to be sent or None"""
+		return self.tx_queue.pop(self.tx_eligible())
+
+	def wakeup(self, force=False):
+		"""Interrupt waiting in wait_io. May be called from any thread."""
+		if (self.waiting or force) and self.wake_w is not None:
+			try:
+				os.write(self.wake_w, b'\0')
+			except BlockingIOError:
+				pass
+
+	def wait_io(self, timeout=None):
+		"""Wait for the data from adapter, the wakeup call or timeout. Returns immediately if there is work to do.
+		Does nothing if waiting on serial port is not supported (not POSIX) so communicate blocks on read instead.
+		"""
+		if self.wake_r is None:
+			return
+		# The flag is set before checking for work so the wakeup call made by other thread is not missed
+		self.waiting = True
+		if not self.has_work():
+			fds = [self.wake_r] if self.rx_paused() else [self.com.fileno(), self.wake_r]
+			rd, _, _ = select.select(fds, [], [], timeout)
+			if self.wake_r in rd:
+				try:
+					os.read(self.wake_r, 4096)
+				except BlockingIOError:
+					pass
+		self.waiting = False
+
+	def run(self):
+		"""Communicate with adapter until stop_running is called. Sleeps until there is something to do
+		or the next timer is due so the CPU is not wasted on polling. The periodic work may be scheduled
+		by call_later.
+		"""
+		self.running = True
+		# Don't block on reads since we are waiting in wait_io
+		self.nowait = self.wake_r is not None
+		try:
+			while self.running:
+				self.communicate()
+				self.wait_io(self.next_timeout())
+		finally:
+			self.nowait = False
+
+	def queue_event(self, kind, idx=None, data=None, hidden=False):
+		"""Called by the default callbacks to queue received event if events are consumed by events() or recv_many()"""
+		if self.rx_events is not None:
+			if type(data) is memoryview:
+				# the view is valid only until the callback returns
+				data = bytes(data)
+			self.rx_events.append(AdapterEvent(kind, idx, data, self.rx_ts, hidden))
+
+	def on_offload_result(self, idx, result):
+		"""Called with the value returned by the offload handler for the batch of messages received from the given peer"""
+		self.queue_event('result', idx, result)
+
+	def wait_events(self, timeout=None):
+		"""Communicate with adapter until some events are received. Returns False on timeout or stop_running call."""
+		if self.rx_events is None:
+			self.rx_events = deque()
+		deadline = None if timeout is None else time.monotonic() + timeout
+		self.nowait = self.wake_r is not None
+		try:
+			while True:
+				self.communicate()
+				if self.rx_events:
+					return True
+				if not self.running:
+					return False
+				wait = self.next_timeout()
+				if deadline is not None:
+					if (left := deadline - time.monotonic()) <= 0:
+						return False
+					wait = left if wait is None else min(wait, left)
+				self.wait_io(wait)
+		finally:
+			self.nowait = False
+
+	def events(self, timeout=None):
+		"""Communicate with adapter yielding AdapterEvent records. Returns once there were no events
+		for timeout seconds (never if it is None) or stop_running is called. Data events are queued by the
+		default callbacks so the ones redefined by subclass do not produce events.
+		"""
+		self.running = True
+		while self.running and (self.rx_events or self.wait_events(timeout)):
+			yield self.rx_events.popleft()
+
+	def recv_many(self, max_n=64, timeout=0):
+		"""Returns the list of up to max_n events received waiting up to timeout seconds for the first one
+		(forever if it is None) so the application may process them in batches.
+		"""
+		self.running = True
+		if not self.rx_events and not self.wait_events(timeout):
+			return []
+		events = self.rx_events
+		return [events.popleft() for _ in range(min(max_n, len(events)))]
+
+	def stop_running(self):
+		"""Make run return. May be called from any thread."""
+		self.running = False
+		self.wakeup(force=True)
+
+	def transmit_batch(self):
+		"""Encode queued messages into the output buffer and write them with single call.
+		The adapter output is received between batches so the stall state is checked before every one.
+		"""
+		out, tx_queue, stats, latency = self.tx_buff, self.tx_queue, self.stats, self.latency_stats
+		batch = []
+		while tx_queue and self.can_transmit():
+			while tx_queue and len(out) < self.tx_buf_size and (item := self.pop_tx()):
+				msg, _, ts = item
+				self.encode_msg_into(msg, out)
+				stats.tx_frames += 1
+				if latency:
+					batch.append((self.tx_dest(msg), ts))
+			if not out:
+				# the messages left are held back by the rate controller
+				break
+			if self.capture:
+				self.capture.tx(out)
+			write_ts = perf_counter()
+			self.com.write(out)
+			stats.tx_bytes += len(out)
+			del out[:]
+			if latency:
+				# every message in the batch takes the time of writing the whole batch
+				done_ts = perf_counter()
+				for dest, ts in batch:
+					latency.on_written(dest, ts, write_ts, done_ts)
+				del batch[:]
+			self.receive()
+
+	def tx_dest(self, msg):
+		"""Returns the destination key used to select transmit queue for the message or None for control messages"""
+		return 0
+
+	def submit_msg(self, msg, key=None):
+		"""Queue message for transmission. Returns the list of (msg, ctx) items dropped due to overflow."""
+		dropped = self.tx_queue.append(msg, self.tx_dest(msg), key=key)
+		self.wakeup()
+		return dropped
 
 	def reset(self):
-		self.tx_queue = []
+		self.tx_queue.clear()
+		self.aggr.clear()
+		self.compr_peers.clear()
 		self.last_rx_tag = 0
 
+	def cobs_enabled(self):
+		return self.cobs_encoding
+
+	def cobs_expected(self):
+		"""Check if the data received may be COBS encoded"""
+		return self.cobs_encoding
+
 	def encode_binary(self, data):
+		if self.cobs_enabled():
+			return self.cobs_tag + self.get_cobs_codec().encode(data)
 		return self.b64_tag + base64.b64encode(data)
 
+	def binary_size(self, size):
+		"""Returns the size of binary data of the given size once encoded"""
+		if self.cobs_enabled():
+			return 2 + size + size // CobsCodec.max_run
+		return 1 + (size + 2) // 3 * 4
+
 	def decode_data(self, msg):
-		if msg[:1] != self.b64_tag:
+		"""Returns decoded binary data, the text data as is or None if the data are malformed.
+		The msg may be memoryview so the binary data are decoded without copying.
+		"""
+		if not msg or (tag := msg[0]) != self.b64_tag[0] and (tag != self.cobs_tag[0] or not self.cobs_expected()):
 			return msg
+		data = memoryview(msg)[1:]
 		try:
-			return base64.b64decode(msg[1:])
-		except binascii.Error:
+			if tag == self.cobs_tag[0]:
+				return self.get_cobs_codec().decode(data)
+			return binascii.a2b_base64(data)
+		except ValueError: # binascii.Error is ValueError as well
 			self.parse_errors += 1
+			self.stats.decode_errors += 1
 			return None
 
 	def process_rx(self, rx_bytes):
+		"""Process data received from adapter"""
 		self.rx_buff += rx_bytes
+		self.rx_ts = time.monotonic()
+		self.stats.rx_bytes += len(rx_bytes)
+		self.parse_rx()
+
+	def parse_rx(self):
+		"""Split received data onto frames and drop them from the receive buffer.
+		Every byte is examined at most twice - by looking for the end tag and for the last start tag before it,
+		so the parsing time is linear in the amount of data received whatever garbage they contain.
+		"""
+		buff, rx_len = self.rx_buff, len(self.rx_buff)
+		start_tag, end_tag = self.start_tag, self.end_tag
+		process_frame, rx_view = self.process_frame_at, memoryview(buff)
+		nframes = 0
 		tail = 0
-		begin = self.rx_buff.find(self.start_tag, 0) if self.start_tag else 0
-		while 0 <= begin < len(self.rx_buff):
-			end = self.rx_buff.find(self.end_tag, begin + 1)
-			if end < 0:
-				break
-			if self.start_tag:
-				while True:
-					next_begin = self.rx_buff.find(self.start_tag, begin + 1)
-					if 0 <= next_begin < end:
-						# multiple begin bytes before end
-						begin = next_begin + 1
-						self.parse_errors += 1
-					else:
-						break
-				if begin != tail:
-					# garbage between messages
+		# the data before rx_scan position were already checked for the end and start tags,
+		# rx_begin is the position of the last start tag found there or -1
+		scan, begin = self.rx_scan, self.rx_begin
+		while (end := buff.find(end_tag, scan, rx_len)) >= 0:
+			if start_tag:
+				if (b := buff.rfind(start_tag, scan, end)) >= 0:
+					begin = b
+				if begin < 0:
+					# no start tag
 					self.parse_errors += 1
-				begin += 1 # skip start byte
-			self.process_frame(self.rx_buff[begin:end])
-			tail = end + 1
-			begin = next_begin if self.start_tag else tail
-		self.rx_buff = self.rx_buff[tail:]
+				else:
+					if begin != tail:
+						# garbage or extra start tags before message
+						self.parse_errors += 1
+					process_frame(rx_view, begin + 1, end)
+					nframes += 1
+				begin = -1
+			else:
+				process_frame(rx_view, tail, end)
+				nframes += 1
+			tail = scan = end + 1
+		rx_view.release()
+		self.stats.rx_frames += nframes
+		if start_tag and (b := buff.rfind(start_tag, scan, rx_len)) >= 0:
+			begin = b
+		if tail >= rx_len or rx_len - (begin if begin >= 0 else tail) > self.rx_max_frame:
+			if tail < rx_len:
+				# unterminated data is too long, drop it
+				self.parse_errors += 1
+			tail, begin = rx_len, -1
+		elif begin > tail:
+			# drop garbage before the start tag
+			self.parse_errors += 1
+			tail = begin
+		try:
+			del buff[:tail]
+		except BufferError:
+			# the callback keeps the view of the buffer so it may not be resized
+			self.rx_buff = buff[tail:]
+		self.rx_scan, self.rx_begin = rx_len - tail, begin - tail if begin >= 0 else -1
+
+	def process_frame(self, frame):
+		"""Process received frame given as bytes-like object without the start and end tags"""
+		self.process_frame_at(memoryview(frame), 0, len(frame))
 
-	def process_frame(self, msg):
+	def process_frame_at(self, buff, begin, end):
+		"""Process received frame occupying [begin, end) range of the buffer (the receive buffer view normally)"""
 		if not self.use_tags and not self.opt_tags:
-			self.process_msg(msg)
+			self.process_payload(buff, begin, end)
 			return
-		if not msg or not self.is_stream_tag(topen := msg[0]):
+		if begin >= end or not self.is_stream_tag(topen := buff[begin]):
 			if self.opt_tags:
-				self.process_msg(msg)
+				self.process_payload(buff, begin, end)
 				return
 			else:
 				self.parse_errors += 1
 				return
-		if len(msg) < 2:
+		if end - begin < 2:
 			self.parse_errors += 1
 			return
-		if msg[-1] != self.get_closing_tag(topen, len(msg) - 2):
+		if buff[end-1] != self.get_closing_tag(topen, end - begin - 2):
 			self.parse_errors += 1
 			return
 		if self.last_rx_tag:
@@ -211,15 +1372,98 @@ class AdapterConnection:
 			if topen != next_rx_tag:
 				self.lost_frames += topen - next_rx_tag if topen > next_rx_tag else \
 									topen + STREAM_TAGS_MOD - next_rx_tag
+				self.stats.tag_gaps.append((time.time(), next_rx_tag, topen))
 		self.last_rx_tag = topen
-		self.process_msg(msg[1:-1])
+		self.process_payload(buff, begin + 1, end - 1)
+
+	def process_payload(self, buff, begin, end):
+		"""Process the message occupying [begin, end) range of the buffer"""
+		self.process_msg(buff[begin:end] if self.msg_views else bytes(buff[begin:end]))
 
 	def process_msg(self, msg):
 		raise NotImplementedError()
 
+	def get_stats(self):
+		"""Returns the dict with communication statistics. May be called from any thread."""
+		stats = {
+			'port': self.port,
+			'parse_errors': self.parse_errors, 'lost_frames': self.lost_frames,
+			'tx_queued': len(self.tx_queue), 'tx_drops': dict(self.tx_queue.drop_cnt),
+			**self.stats.as_dict(time.monotonic())
+		}
+		if self.latency_stats:
+			stats['latency'] = self.get_latency()
+		if self.offload:
+			stats.update(self.offload.get_stats())
+		return stats
+
+class RateController:
+	"""AIMD send rate controller. The rate is increased while the sender is limited by it and there are no losses
+	and decreased multiplicatively on loss. The rate grows exponentially (slow start) until the first loss and linearly
+	after it. The rate is in bytes per second. The sender is considered limited while it has spent more than its budget.
+	"""
+	init_rate  = 4000
+	min_rate   = 250
+	max_rate   = 200000
+	incr       = 1000 # rate increase per second
+	ss_factor  = 2    # rate multiplier per second in slow start
+	decr       = .5   # rate multiplier on loss
+	hold_time  = 1    # sec, the losses reported within this interval after decrease are ignored
+	burst_time = .1   # sec, the amount of data allowed to be sent at once
+
+	def __init__(self):
+		self.rate = self.init_rate
+		self.tokens = self.rate * self.burst_time
+		self.ts = time.monotonic()
+		self.decr_ts = 0
+		self.slow_start = True
+		self.loss_cnt = 0
+		self.decr_cnt = 0
+
+	def update(self, now):
+		if (dt := now - self.ts) <= 0:
+			return
+		self.ts = now
+		if self.tokens < 0 and now > self.decr_ts + self.hold_time:
+			# the time the sender was waiting for the budget
+			t = min(dt, -self.tokens / self.rate)
+			if self.slow_start:
+				self.rate = min(self.rate * self.ss_factor ** t, self.max_rate)
+			else:
+				self.rate = min(self.rate + self.incr * t, self.max_rate)
+		self.tokens = min(self.tokens + self.rate * dt, self.rate * self.burst_time)
+
+	def get_tokens(self, now):
+		return min(self.tokens + self.rate * max(0, now - self.ts), self.rate * self.burst_time)
+
+	def can_send(self):
+		"""Check if sending is allowed now. The controller state is not changed."""
+		return self.get_tokens(time.monotonic()) >= 0
+
+	def send_delay(self):
+		"""Returns time till sending will be allowed"""
+		return max(0, -self.get_tokens(time.monotonic()) / self.rate)
+
+	def on_sent(self, size):
+		"""Spend the budget on size bytes sent"""
+		self.update(time.monotonic())
+		self.tokens -= size
+
+	def on_loss(self):
+		self.loss_cnt += 1
+		now = time.monotonic()
+		if now > self.decr_ts + self.hold_time:
+			self.update(now)
+			self.slow_start = False
+			self.rate = max(self.rate * self.decr, self.min_rate)
+			self.tokens = min(self.tokens, self.rate * self.burst_time)
+			self.decr_ts = now
+			self.decr_cnt += 1
+
 class MutliAdapter(AdapterConnection):
 	"""BLE multi-adapter interface class"""
 	stall_tout = 2 # sec
+	adaptive   = False # Use send rate controller
 
 	def __init__(self, port):
 		super().__init__(port)
@@ -227,10 +1471,87 @@ class MutliAdapter(AdapterConnection):
 		self.is_stall = True
 		self.stall_ts = None
 		self.stall_time = 0
+		self.stall_timer = None
+		self.rate_ctl = {}
+		self.last_errors = 0
+		self.cobs_supported = False
+		self.max_frame = None
+		# the handlers of received messages indexed by their first byte, the others are sent by peers
+		self.dispatch = [partial(self.on_peer_msg_, b - b'0'[0]) for b in range(256)]
+		self.dispatch[b':'[0]] = self.on_status_frame
+		self.dispatch[b'-'[0]] = self.on_debug_frame
+		self.dispatch[b'<'[0]] = self.on_central_msg_
 
-	def is_congested(self):
-		"""Client should avoid submitting new data if adapter is congested"""
-		return super().is_congested() or self.is_stall
+	def cobs_enabled(self):
+		# the adapter may be built without COBS_ENCODING option
+		return self.cobs_encoding and self.cobs_supported
+
+	def cobs_expected(self):
+		# the adapter built with COBS_ENCODING option sends binary data encoded with COBS regardless of the host setting
+		return self.cobs_supported
+
+	def use_rate_control(self, use = True):
+		"""Limit send rate to every destination adaptively based on the congestion signals"""
+		self.adaptive = use
+
+	def get_rate_ctl(self, idx):
+		"""Returns rate controller for the peer with given index or CENTRAL"""
+		if not (ctl := self.rate_ctl.get(idx)):
+			ctl = self.rate_ctl[idx] = RateController()
+		return ctl
+
+	def is_congested(self, idx=None):
+		"""Client should avoid submitting new data if adapter is congested.
+		The peer index or CENTRAL may be given to check if sending to the particular destination is allowed.
+		"""
+		if self.is_stall:
+			return True
+		if idx is None:
+			return super().is_congested()
+		if self.tx_pending(idx) > self.congest_thr:
+			return True
+		return self.adaptive and (ctl := self.rate_ctl.get(idx)) is not None and not ctl.can_send()
+
+	def tx_eligible(self):
+		return self.rate_allows if self.adaptive else None
+
+	def rate_allows(self, dest):
+		return self.get_rate_ctl(self.dest_key(dest)).can_send()
+
+	def tx_timeout(self):
+		if not self.adaptive or not self.tx_queue.active:
+			return None
+		return min(self.get_rate_ctl(self.dest_key(dest)).send_delay() for dest in self.tx_queue.active)
+
+	def pop_tx(self):
+		# the rate limit is enforced here so the messages sent by any means are accounted
+		if (item := super().pop_tx()) and self.adaptive and (dest := self.tx_dest(item[0])) is not None:
+			self.get_rate_ctl(self.dest_key(dest)).on_sent(len(item[0]))
+		return item
+
+	@staticmethod
+	def dest_tag(idx):
+		"""Returns the message tag for the peer with given index or CENTRAL"""
+		return b'>'[0] if idx == CENTRAL else b'0'[0] + idx
+
+	def tx_dest(self, msg):
+		return None if msg[:1] == b'#' else msg[0]
+
+	def dest_key(self, dest):
+		"""Report statistics by peer index, CENTRAL or 'cmd' for commands"""
+		return 'cmd' if dest is None else CENTRAL if dest == b'>'[0] else dest - b'0'[0]
+
+	def tx_pending(self, idx):
+		"""Returns the number of messages queued for the peer with given index or CENTRAL"""
+		return self.tx_queue.depth(self.dest_tag(idx))
+
+	def report_loss(self, idx=None):
+		"""Report data lost on the way to the peer with given index or CENTRAL or to all destinations if idx is None.
+		May be called by the application detecting losses on its own.
+		"""
+		for i, ctl in self.rate_ctl.items():
+			if idx is None or i == idx:
+				ctl.on_loss()
 
 	def reset(self):
 		"""Reset adapter"""
@@ -240,66 +1561,142 @@ class MutliAdapter(AdapterConnection):
 		self.stall_ts = None
 
 	def chk_stall(self):
-		"""Adapter is considered stall if its not sending status messages at expected interval (1 sec)"""
-		now = time.time()
-		if not self.is_stall and now > self.status_ts + self.stall_tout:
+		"""Adapter is considered stall if its not sending status messages at expected interval (1 sec).
+		Called by the stall timer so the adapter driven by some other event loop may call it on its own timer.
+		"""
+		now = time.monotonic()
+		if not self.is_stall and now >= self.status_ts + self.stall_tout:
 			self.is_stall = True
 			self.stall_ts = now
+			self.stats.stall_cnt += 1
+			self.report_loss()
 		return self.is_stall
 
-	def communicate(self):
-		"""Send/receive data to/from adapter"""
-		self.chk_stall()
-		super().communicate()
+	def arm_stall_timer(self):
+		self.stall_timer = self.call_at(self.status_ts + self.stall_tout, self.on_stall_timer)
+
+	def on_stall_timer(self):
+		# the timer is armed once per stall timeout rather than on every status message
+		# so it may fire before the timeout counted from the last status message expires
+		self.stall_timer = None
+		if not self.chk_stall():
+			self.arm_stall_timer()
 
 	def can_transmit(self):
 		"""Called by communicate implementation to check if we allowed to transmit data to adapter"""
-		return not self.chk_stall()
+		return not self.is_stall
+
+	def aggr_limit(self):
+		return self.aggr_frame or self.max_frame
 
 	def connect(self, peers):
 		"""Connect to the list of device addresses"""
-		self.submit_msg(b'#C' + b' '.join(peers))
+		return self.submit_msg(b'#C' + b' '.join(peers))
 
 	def advertise(self):
 		"""Turn on advertising if was hidden"""
-		self.submit_msg(b'#A')
+		return self.submit_msg(b'#A')
 
-	def send_data(self, data, binary=False):
-		"""Send data to connected central"""
-		if binary:
-			data = self.encode_binary(data)
-		self.submit_msg(b'>' + data)
+	def send_data(self, data, binary=False, key=None):
+		"""Send data to connected central. The key identifies messages to be coalesced with COALESCE policy.
+		The messages sent without key are aggregated if aggregation is enabled.
+		"""
+		if self.aggregate:
+			return self.aggr_add(CENTRAL, data, binary, key)
+		return self.send_frame(CENTRAL, data, binary, key)
+
+	def send_data_to(self, idx, data, binary=False, key=None):
+		"""Send data to peer given its index. The key identifies messages to be coalesced with COALESCE policy.
+		The messages sent without key are aggregated if aggregation is enabled.
+		"""
+		if self.aggregate:
+			return self.aggr_add(idx, data, binary, key)
+		return self.send_frame(idx, data, binary, key)
 
-	def send_data_to(self, idx, data, binary=False):
-		"""Send data to peer given its index"""
+	def send_frame(self, idx, data, binary=False, key=None, compress=True):
+		"""Send data frame to peer given its index or CENTRAL"""
+		if self.compressor and compress:
+			data, binary = self.compress_data(idx, data, binary)
 		if binary:
 			data = self.encode_binary(data)
-		self.submit_msg((b'0'[0] + idx).to_bytes(1, byteorder='big') + data)
+		self.stats.peer_tx[idx] += 1
+		tag = b'>' if idx == CENTRAL else (b'0'[0] + idx).to_bytes(1, byteorder='big')
+		return self.submit_msg(tag + data, key)
+
+	def tx_dropped(self, idx):
+		"""Returns the number of messages dropped on the way to the peer with given index or CENTRAL"""
+		return self.tx_queue.dest_drops.get(self.dest_tag(idx), 0)
+
+	def get_stats(self):
+		stats = super().get_stats()
+		now, stall_time = time.monotonic(), self.stall_time
+		if self.is_stall and self.stall_ts:
+			stall_time += now - self.stall_ts
+		stats['stalled'] = self.is_stall
+		stats['stall_time'] = stall_time
+		stats['tx_pending'] = {self.dest_key(dest): len(q) for dest, q in list(self.tx_queue.queues.items())}
+		if self.adaptive:
+			stats['tx_rate_limit'] = {idx: ctl.rate for idx, ctl in list(self.rate_ctl.items())}
+		return stats
+
+	def process_payload(self, buff, begin, end):
+		"""Dispatch the message by its first byte passing the view of the rest of it to the handler"""
+		if begin < end:
+			self.dispatch[buff[begin]](buff[begin + 1:end])
+		else:
+			self.parse_errors += 1
 
 	def process_msg(self, msg):
-		tag = msg[:1]
-		if tag == b':':
-			self.on_status_msg(msg[1:])
-		elif tag == b'-':
-			self.on_debug_msg(msg[1:])
-		elif tag == b'<':
-			self.on_central_msg_(msg[1:])
-		elif msg:
-			self.on_peer_msg_(msg[0] - b'0'[0], msg[1:])
+		if msg:
+			self.dispatch[msg[0]](memoryview(msg)[1:])
 		else:
 			self.parse_errors += 1
 
+	def on_status_frame(self, msg):
+		self.on_status_msg(bytes(msg))
+
+	def on_debug_frame(self, msg):
+		self.on_debug_msg_(bytes(msg))
+
+	def on_central_msg_(self, msg):
+		self.stats.peer_rx[CENTRAL] += 1
+		for data in self.receive_data(CENTRAL, msg):
+			if self.offload:
+				self.offload.add(CENTRAL, data)
+			else:
+				self.on_central_msg(data)
+
+	def on_peer_msg_(self, idx, msg):
+		self.stats.peer_rx[idx] += 1
+		for data in self.receive_data(idx, msg):
+			if self.offload:
+				self.offload.add(idx, data)
+			else:
+				self.on_peer_msg(idx, data)
+
 	def on_stable_status(self):
-		self.status_ts = time.time()
+		self.status_ts = time.monotonic()
+		self.stats.sample(self.status_ts)
+		if (errors := self.parse_errors + self.lost_frames) != self.last_errors:
+			# the data from adapter are lost or corrupted
+			self.last_errors = errors
+			self.report_loss()
 		if self.is_stall:
 			self.is_stall = False
 			if self.stall_ts:
-				self.stall_time += time.time() - self.stall_ts
+				self.stall_time += self.status_ts - self.stall_ts
+		if not self.stall_timer:
+			self.arm_stall_timer()
 
 	def on_status_msg(self, msg):
 		tag = msg[:1]
 		if tag == b'I':
 			self.on_stable_status()
+			# not connected, the compression is negotiated anew on the next connection
+			self.compr_peers.clear()
+			self.cobs_supported = b's' in msg.rsplit(b'-', 1)[-1]
+			if (v := msg.split(b'-')) and len(v) > 2 and v[1].isdigit():
+				self.max_frame = int(v[1])
 			if msg[1:2] == b'h':
 				self.on_idle(True, msg[2:].strip())
 			else:
@@ -312,33 +1709,43 @@ class MutliAdapter(AdapterConnection):
 		else:
 			self.parse_errors += 1
 
-	def on_central_msg_(self, msg):
-		data = self.decode_data(msg)
-		if data is not None:
-			self.on_central_msg(data)
+	def on_debug_msg_(self, msg):
+		if self.adaptive:
+			self.chk_congestion_msg(msg)
+		self.on_debug_msg(msg)
 
-	def on_peer_msg_(self, idx, msg):
-		data = self.decode_data(msg)
-		if data is not None:
-			self.on_peer_msg(idx, data)
+	def chk_congestion_msg(self, msg):
+		"""Check for adapter error message signaling congestion"""
+		if msg.startswith(b'tx queue ['):
+			# the rx queue overflow is the peer to host direction so it does not affect our send rate
+			tag, sep, _ = msg[10:].partition(b']')
+			if sep and tag:
+				# the tag is '0' + peer index, the decimal index is accepted as well
+				idx = int(tag) if len(tag) > 1 and tag.isdigit() else tag[0] - b'0'[0]
+				if idx >= 0:
+					self.report_loss(idx)
+		elif msg.startswith(b'notify failed'):
+			self.report_loss(CENTRAL)
+		elif msg.startswith((b'write failed', b'serial frame lost', b'parse error')):
+			self.report_loss()
 
 	def on_idle(self, hidden, version):
-		pass
+		self.queue_event('idle', data=version, hidden=hidden)
 
 	def on_connecting(self, idx):
-		pass
+		self.queue_event('connecting', idx)
 
 	def on_connected(self, hidden):
-		pass
+		self.queue_event('connected', hidden=hidden)
 
 	def on_debug_msg(self, msg):
-		pass
+		self.queue_event('debug', data=msg)
 
 	def on_central_msg(self, msg):
-		pass
+		self.queue_event('central', CENTRAL, msg)
 
 	def on_peer_msg(self, idx, msg):
-		pass
+		self.queue_event('peer', idx, msg)
 
 class SimpleAdapter(AdapterConnection):
 	"""BLE simple link adapter interface class"""
@@ -347,18 +1754,40 @@ class SimpleAdapter(AdapterConnection):
 
 	def __init__(self, port):
 		super().__init__(port)
+		self.call_later(1, self.sample_stats)
+
+	def sample_stats(self):
+		self.call_later(1, self.sample_stats)
+		self.stats.sample(time.monotonic())
 
-	def send_data(self, data, binary=False):
-		"""Send data frame to connected peer device"""
+	def send_data(self, data, binary=False, key=None):
+		"""Send data frame to connected peer device. The messages sent without key are aggregated
+		if aggregation is enabled. The max frame size should be given to use_aggregation in such case.
+		"""
+		if self.aggregate:
+			return self.aggr_add(0, data, binary, key)
+		return self.send_frame(0, data, binary, key)
+
+	def send_frame(self, idx, data, binary=False, key=None, compress=True):
+		if self.compressor and compress:
+			data, binary = self.compress_data(idx, data, binary)
 		if binary:
 			data = self.encode_binary(data)
-		self.submit_msg(data)
+		self.stats.peer_tx[0] += 1
+		return self.submit_msg(data, key)
+
+	def process_payload(self, buff, begin, end):
+		# the data are copied by receive_data unless msg_views is enabled
+		self.process_msg(buff[begin:end])
 
 	def process_msg(self, msg):
-		data = self.decode_data(msg)
-		if data is not None:
-			self.on_data_received(data)
+		self.stats.peer_rx[0] += 1
+		for data in self.receive_data(0, msg):
+			if self.offload:
+				self.offload.add(0, data)
+			else:
+				self.on_data_received(data)
 
 	def on_data_received(self, data):
-		pass
+		self.queue_event('data', 0, data)
 
@@ -0,0 +1,186 @@
+"""
+BLE multi adapter (ble_uart_mx) received messages processing offloaded to the process pool.
+The heavy message handlers (decoding, validation) may not keep up with several peers streaming
+at once if they are called in the adapter loop. Then the serial port buffer gets full, the flow
+control stops the adapter and its watchdog fires eventually. The Offload object attached to the
+adapter by use_offload() method passes the messages received from peers and central to the handler
+running in the process pool in batches while the adapter loop keeps draining the port. If the pool
+can't keep up for long the messages are either dropped or the adapter stops reading the port so the
+flow control slows down the peers.
+
+Expects serial port name as a parameter followed by the peer device addresses to connect to
+if started as script. The script echo all data received from peers back to them after passing
+them through the process pool.
+"""
+
+import os
+import sys
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, defaultdict
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, CENTRAL, DROP_OLDEST, DROP_NEWEST
+
+def ignore_sigint():
+	# the workers are stopped by the pool shutdown rather than by Ctrl-C sent to the process group
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class Offload:
+	"""Passes received messages to the handler running in the process pool in batches.
+	The handler(idx, msgs) is called with the peer index (CENTRAL for central) and the list of messages
+	received from it. It should be the module level function so it may be pickled. The value it returns
+	is passed to on_offload_result callback of the adapter in the adapter loop. The batches of every peer
+	are processed one at a time unless peer_batches is greater than 1, the results are delivered in order anyway.
+	At most max_batches are submitted to the pool at once. The messages are kept pending while the pool
+	is saturated and then submitted in larger batches. Once max_pending messages are pending the oldest
+	(or the newest depending on policy) ones are dropped so the memory used is bounded. If pause_rx is set
+	the messages are not dropped, the adapter stops reading the port instead until the pool catches up.
+	The peers are slowed down by the flow control then, but the adapter watchdog may fire if the pool
+	is stuck for long.
+	"""
+	batch_len    = 256       # max messages per batch
+	peer_batches = 1         # max batches of the same peer being processed at once
+	max_pending  = 64*1024   # max messages waiting for the pool
+	policy       = DROP_OLDEST # the messages to drop once max_pending are pending
+	pause_rx     = False     # stop reading the port rather than dropping messages
+
+	def __init__(self, handler, executor=None, workers=None, max_batches=None):
+		self.handler = handler
+		self.own_executor = executor is None
+		self.executor = executor or ProcessPoolExecutor(workers, initializer=ignore_sigint)
+		self.max_batches = max_batches or 2 * (workers or os.cpu_count() or 1)
+		self.pending = defaultdict(deque)  # peer index -> messages
+		self.inflight = defaultdict(deque) # peer index -> futures in submission order
+		self.npending = 0
+		self.ninflight = 0
+		self.ready = False
+		self.notify = None
+		self.batches = 0
+		self.msgs = 0
+		self.drops = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.close()
+
+	def close(self):
+		"""Shutdown the pool unless it was created by the caller. The messages pending are dropped."""
+		if self.own_executor:
+			self.executor.shutdown(cancel_futures=True)
+		self.pending.clear()
+		self.inflight.clear()
+		self.npending = self.ninflight = 0
+
+	def add(self, idx, msg):
+		"""Queue message received from the peer with the given index"""
+		pending = self.pending[idx]
+		if self.npending >= self.max_pending and not self.pause_rx:
+			self.drops += 1
+			if self.policy == DROP_NEWEST or not pending:
+				return
+			pending.popleft()
+			self.npending -= 1
+		pending.append(msg if type(msg) is bytes else bytes(msg))
+		self.npending += 1
+
+	def on_done(self, fut):
+		# called by the pool management thread
+		self.ready = True
+		if self.notify:
+			self.notify()
+
+	def submit(self):
+		"""Submit pending messages to the pool while it is not saturated"""
+		for idx, msgs in self.pending.items():
+			inflight = self.inflight[idx]
+			while msgs and self.ninflight < self.max_batches and len(inflight) < self.peer_batches:
+				batch = [msgs.popleft() for _ in range(min(self.batch_len, len(msgs)))]
+				self.npending -= len(batch)
+				fut = self.executor.submit(self.handler, idx, batch)
+				inflight.append(fut)
+				self.ninflight += 1
+				self.batches += 1
+				self.msgs += len(batch)
+				fut.add_done_callback(self.on_done)
+
+	def poll(self, on_result):
+		"""Pass the results of the batches processed to on_result(idx, result) in submission order and
+		submit pending messages. The exception raised by the handler is propagated to the caller.
+		"""
+		if self.ready:
+			# the flag is cleared first so the batches completed while scanning are not missed
+			self.ready = False
+			for idx, inflight in list(self.inflight.items()):
+				while inflight and inflight[0].done():
+					fut = inflight.popleft()
+					self.ninflight -= 1
+					on_result(idx, fut.result())
+		if self.npending:
+			self.submit()
+
+	def can_submit(self):
+		"""Returns True if some pending messages may be submitted to the pool"""
+		if not self.npending or self.ninflight >= self.max_batches:
+			return False
+		return any(msgs and len(self.inflight[idx]) < self.peer_batches for idx, msgs in self.pending.items())
+
+	def has_work(self):
+		"""Returns True if poll should be called without waiting for input"""
+		return self.ready or self.can_submit()
+
+	def is_saturated(self):
+		"""Returns True if the messages are waiting for the pool"""
+		return self.npending > 0
+
+	def is_full(self):
+		"""Returns True if the adapter should stop reading the port until the pool catches up"""
+		return self.pause_rx and self.npending >= self.max_pending
+
+	def get_stats(self):
+		return {
+			'offload_pending'  : self.npending,
+			'offload_inflight' : self.ninflight,
+			'offload_batches'  : self.batches,
+			'offload_msgs'     : self.msgs,
+			'offload_drops'    : self.drops,
+		}
+
+def echo_handler(idx, msgs):
+	return msgs
+
+class Echo(MutliAdapter):
+	def __init__(self, port, peers):
+		super().__init__(port)
+		self.peers = peers
+
+	def on_idle(self, hidden, version):
+		print('Idle, version ' + version.decode())
+		if self.peers:
+			self.connect(self.peers)
+
+	def on_debug_msg(self, msg):
+		print('    ' + msg.decode())
+
+	def on_offload_result(self, idx, msgs):
+		for msg in msgs:
+			if not msg:
+				continue
+			if idx == CENTRAL:
+				self.send_data(msg)
+			else:
+				self.send_data_to(idx, msg)
+
+if __name__ == '__main__':
+	port  = sys.argv[1]
+	peers = [addr.encode() for addr in sys.argv[2:]]
+	with Offload(echo_handler) as off, Echo(port, peers) as ad:
+		ad.use_offload(off)
+		ad.reset()
+		try:
+			ad.run()
+		except KeyboardInterrupt:
+			pass
+		print(ad.get_stats())
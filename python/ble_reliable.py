@@ -0,0 +1,404 @@
+"""
+Reliable delivery layer over BLE multi adapter (ble_uart_mx) data messages.
+The BLE data frames may be lost, duplicated or reordered on their way, so the channel
+numbers messages and retransmits the lost ones using selective repeat scheme. Up to window
+messages may be sent without waiting for acknowledgement so the data are sent at nearly the
+link rate while the receiver acknowledges all messages it has got at once with the cumulative
+sequence number and the bitmap of the messages received out of order. The lost message is
+retransmitted as soon as the message sent after it is acknowledged or on timeout.
+Both sides of the link should use reliable channel, the ReliableAdapter may talk to the peers
+and to the connected central while ReliableSimpleAdapter serves the simple link.
+
+Expects serial port name as a parameter followed by the peer device addresses to connect to
+if started as script. The script sends the numbered messages to every peer through the reliable
+channel and checks that the data echoed back arrive in order. The peers may be the adapters
+built with ECHO option or this script started with --echo option on the other side of the link.
+"""
+
+import sys
+import time
+import random
+from collections import deque
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, SimpleAdapter, CENTRAL
+
+DATA_TAG = b'D'[0]
+ACK_TAG  = b'A'[0]
+
+# The data message header: tag, session, sequence number, the first sequence number not acknowledged
+DATA_HDR_SIZE = 6
+# The acknowledgement header: tag, session, the next sequence number expected
+ACK_HDR_SIZE = 4
+
+SEQ_MOD = 1 << 16
+
+def seq_diff(a, b):
+	"""Returns signed difference of the sequence numbers a - b"""
+	d = (a - b) % SEQ_MOD
+	return d - SEQ_MOD if d >= SEQ_MOD // 2 else d
+
+class ReliableChannel:
+	"""Selective repeat reliable channel endpoint. The transmit callback sends the message to the other side,
+	the deliver callback receives the data in order they were sent. The session identifier changes on every
+	reset so the receiver knows when the sender starts numbering messages from the beginning. Every data
+	message carries the first sequence number not acknowledged so the receiver starting the session in the
+	middle of the stream (after restart for example) knows where it should start receiving.
+	The retransmission timeout is calculated from the round trip time as the TCP does.
+	"""
+	window   = 32   # max messages sent but not acknowledged, the acknowledgement bitmap has window bits
+	rto_init = 1    # sec
+	rto_min  = .1   # sec
+	rto_max  = 8    # sec
+
+	def __init__(self, transmit, deliver):
+		self.transmit = transmit
+		self.deliver  = deliver
+		self.backlog  = deque()
+		self.inflight = {}    # seq -> [data, sent_ts, retransmitted]
+		self.sent_cnt = self.retx_cnt = self.timeout_cnt = self.dup_cnt = 0
+		self.srtt = None
+		self.rttvar = 0
+		self.rto = self.rto_init
+		# random initial session makes the restarted process unlikely to reuse the session the receiver has seen
+		self.session = random.randrange(256)
+		self.reset()
+
+	def reset(self):
+		"""Start new session. The data sent but not acknowledged will be sent again
+		so they may be delivered twice if the other side has already got them.
+		"""
+		# the new session always differs from the previous one
+		self.session = (self.session + 1) % 256
+		self.backlog.extendleft(reversed([data for data, _, _ in self.inflight.values()]))
+		self.inflight.clear()
+		self.next_seq = 0
+		self.una = 0          # the first sequence number not acknowledged
+		self.last_acked_ts = 0
+		self.timer_ts = 0     # the time of the last retransmission on timeout
+		self.rx_session = None
+		self.rx_next = 0
+		self.rx_buff = {}
+		self.ack_pending = False
+
+	def send(self, data):
+		"""Queue data for reliable transmission"""
+		self.backlog.append(data)
+
+	def pending(self):
+		"""Returns the number of messages not acknowledged yet including the ones not sent"""
+		return len(self.backlog) + len(self.inflight)
+
+	def can_send(self):
+		return self.backlog and seq_diff(self.next_seq, self.una) < self.window
+
+	def has_work(self, congested=False):
+		"""Returns True if poll has something to send. The new messages are not sent if the link is congested."""
+		return self.ack_pending or (not congested and self.can_send())
+
+	def send_msg(self, seq, data, now, retransmit=False):
+		self.transmit(bytes((DATA_TAG, self.session)) + seq.to_bytes(2, byteorder='big') +
+			self.una.to_bytes(2, byteorder='big') + data)
+		self.inflight[seq] = [data, now, retransmit]
+		if retransmit:
+			self.retx_cnt += 1
+		else:
+			self.sent_cnt += 1
+
+	def send_ack(self):
+		bitmap = 0
+		for seq in self.rx_buff:
+			bitmap |= 1 << (seq_diff(seq, self.rx_next) - 1)
+		self.transmit(bytes((ACK_TAG, self.rx_session)) + self.rx_next.to_bytes(2, byteorder='big') +
+			bitmap.to_bytes(self.window // 8, byteorder='big'))
+		self.ack_pending = False
+
+	def poll(self, now, congested=False):
+		"""Send acknowledgement, retransmit messages on timeout and send new ones while the window allows.
+		The new messages are not sent if the link is congested.
+		"""
+		if self.ack_pending:
+			self.send_ack()
+		if self.inflight and (t := self.next_timeout(now)) is not None and t <= 0:
+			# retransmit the oldest message only, the others will be retransmitted
+			# once it is acknowledged unless they are acknowledged as well
+			self.timeout_cnt += 1
+			self.rto = min(2 * self.rto, self.rto_max)
+			self.timer_ts = now
+			seq = min(self.inflight, key=lambda seq: self.inflight[seq][1])
+			self.send_msg(seq, self.inflight[seq][0], now, True)
+		while not congested and self.can_send():
+			self.send_msg(self.next_seq, self.backlog.popleft(), now)
+			self.next_seq = (self.next_seq + 1) % SEQ_MOD
+
+	def next_timeout(self, now):
+		"""Returns the time till the next retransmission or None if there is nothing to retransmit"""
+		if not self.inflight:
+			return None
+		return max(0, max(min(ts for _, ts, _ in self.inflight.values()), self.timer_ts) + self.rto - now)
+
+	def on_msg(self, msg, now):
+		"""Process the message received from the other side. Returns False if it is malformed."""
+		if len(msg) < ACK_HDR_SIZE:
+			return False
+		tag, session, seq = msg[0], msg[1], int.from_bytes(msg[2:4], byteorder='big')
+		if tag == DATA_TAG and len(msg) >= DATA_HDR_SIZE:
+			self.on_data(session, seq, int.from_bytes(msg[4:6], byteorder='big'), msg[DATA_HDR_SIZE:])
+		elif tag == ACK_TAG and len(msg) == ACK_HDR_SIZE + self.window // 8:
+			if session == self.session:
+				self.on_ack(seq, int.from_bytes(msg[ACK_HDR_SIZE:], byteorder='big'), now)
+		else:
+			return False
+		return True
+
+	def on_data(self, session, seq, una, data):
+		if session != self.rx_session:
+			# the sender started new session or we did not see it before, the messages
+			# sent before una were acknowledged so they will not be sent again
+			self.rx_session, self.rx_next = session, una
+			self.rx_buff.clear()
+		self.ack_pending = True
+		off = seq_diff(seq, self.rx_next)
+		if off < 0 or seq in self.rx_buff:
+			self.dup_cnt += 1
+			return
+		if off >= self.window:
+			# out of window, the sender will retransmit it
+			return
+		if off:
+			# the data may be memoryview valid only until return
+			self.rx_buff[seq] = bytes(data)
+			return
+		self.deliver(data)
+		self.rx_next = (self.rx_next + 1) % SEQ_MOD
+		while (data := self.rx_buff.pop(self.rx_next, None)) is not None:
+			self.deliver(data)
+			self.rx_next = (self.rx_next + 1) % SEQ_MOD
+
+	def on_ack(self, rx_next, bitmap, now):
+		if not 0 <= seq_diff(rx_next, self.una) <= seq_diff(self.next_seq, self.una):
+			# stale acknowledgement
+			return
+		acked = [seq for seq in self.inflight if seq_diff(seq, rx_next) < 0 or
+					(seq_diff(seq, rx_next) > 0 and bitmap >> (seq_diff(seq, rx_next) - 1) & 1)]
+		for seq in acked:
+			_, ts, retransmitted = self.inflight.pop(seq)
+			if not retransmitted:
+				# the round trip time of retransmitted message is ambiguous
+				self.update_rtt(now - ts)
+			self.last_acked_ts = max(self.last_acked_ts, ts)
+		self.una = rx_next
+		# the messages sent before the acknowledged one are lost unless reordered
+		reorder_wnd = self.srtt / 4 if self.srtt else 0
+		for seq, (data, ts, _) in list(self.inflight.items()):
+			if ts + reorder_wnd < self.last_acked_ts:
+				self.send_msg(seq, data, now, True)
+
+	def update_rtt(self, rtt):
+		if self.srtt is None:
+			self.srtt, self.rttvar = rtt, rtt / 2
+		else:
+			self.rttvar = .75 * self.rttvar + .25 * abs(self.srtt - rtt)
+			self.srtt = .875 * self.srtt + .125 * rtt
+		self.rto = min(max(self.srtt + 4 * self.rttvar, self.rto_min), self.rto_max)
+
+	def get_stats(self):
+		return {
+			'sent': self.sent_cnt,
+			'retransmitted': self.retx_cnt,
+			'timeouts': self.timeout_cnt,
+			'duplicates': self.dup_cnt,
+			'pending': self.pending(),
+			'srtt': self.srtt,
+			'rto': self.rto,
+		}
+
+class ReliableAdapter(MutliAdapter):
+	"""Multi adapter delivering data to peers and connected central through reliable channels.
+	The data are passed to on_reliable_msg callback in the order they were sent. The channels
+	are reset when the adapter is reset or becomes idle after losing connections.
+	"""
+	def __init__(self, port):
+		super().__init__(port)
+		self.channels = {}
+		self.link_idle = True
+
+	def get_channel(self, idx):
+		"""Returns the reliable channel for the peer with given index or CENTRAL"""
+		if not (ch := self.channels.get(idx)):
+			if idx == CENTRAL:
+				transmit = lambda msg: self.send_data(msg, True)
+			else:
+				transmit = lambda msg: self.send_data_to(idx, msg, True)
+			ch = self.channels[idx] = ReliableChannel(transmit, lambda data: self.on_reliable_msg(idx, data))
+		return ch
+
+	def send_reliable(self, idx, data):
+		"""Send data to the peer with given index or CENTRAL. The data size should not exceed max frame size
+		less DATA_HDR_SIZE bytes.
+		"""
+		self.get_channel(idx).send(data)
+		self.wakeup()
+
+	def reset_channels(self):
+		for ch in self.channels.values():
+			ch.reset()
+
+	def reset(self):
+		super().reset()
+		self.reset_channels()
+		self.link_idle = True
+
+	def on_status_msg(self, msg):
+		# the idle status is repeated periodically, the channels are reset once the connections are lost
+		if msg[:1] == b'I':
+			if not self.link_idle:
+				self.reset_channels()
+				self.link_idle = True
+		elif msg[:1] in (b'C', b'D'):
+			self.link_idle = False
+		super().on_status_msg(msg)
+
+	def communicate(self):
+		super().communicate()
+		now = time.monotonic()
+		for idx, ch in self.channels.items():
+			ch.poll(now, self.is_congested(idx))
+
+	def has_work(self):
+		# the channels having messages to send to the congested destination wait for the next communicate call
+		return super().has_work() or any(ch.has_work(self.is_congested(idx)) for idx, ch in self.channels.items())
+
+	def next_timeout(self):
+		now = time.monotonic()
+		timeouts = [t for ch in self.channels.values() if (t := ch.next_timeout(now)) is not None]
+		if (t := super().next_timeout()) is not None:
+			timeouts.append(t)
+		return min(timeouts, default=None)
+
+	def get_stats(self):
+		stats = super().get_stats()
+		stats['reliable'] = {idx: ch.get_stats() for idx, ch in self.channels.items()}
+		return stats
+
+	def on_central_msg(self, msg):
+		if not self.get_channel(CENTRAL).on_msg(msg, time.monotonic()):
+			self.parse_errors += 1
+
+	def on_peer_msg(self, idx, msg):
+		if not self.get_channel(idx).on_msg(msg, time.monotonic()):
+			self.parse_errors += 1
+
+	def on_reliable_msg(self, idx, data):
+		pass
+
+class ReliableSimpleAdapter(SimpleAdapter):
+	"""Simple link adapter delivering data to the peer through reliable channel.
+	The data are passed to on_reliable_msg callback in the order they were sent.
+	"""
+	def __init__(self, port):
+		super().__init__(port)
+		self.channel = ReliableChannel(lambda msg: self.send_data(msg, True), lambda data: self.on_reliable_msg(data))
+
+	def send_reliable(self, data):
+		self.channel.send(data)
+		self.wakeup()
+
+	def communicate(self):
+		super().communicate()
+		self.channel.poll(time.monotonic(), self.is_congested())
+
+	def has_work(self):
+		return super().has_work() or self.channel.has_work(self.is_congested())
+
+	def next_timeout(self):
+		timeouts = [t for t in (self.channel.next_timeout(time.monotonic()), super().next_timeout()) if t is not None]
+		return min(timeouts, default=None)
+
+	def get_stats(self):
+		stats = super().get_stats()
+		stats['reliable'] = self.channel.get_stats()
+		return stats
+
+	def on_data_received(self, data):
+		if not self.channel.on_msg(data, time.monotonic()):
+			self.parse_errors += 1
+
+	def on_reliable_msg(self, data):
+		pass
+
+class ReliableTest(ReliableAdapter):
+	"""Sends numbered messages to every peer and checks they are echoed back in order"""
+	msg_size = 200
+	report_interval = 5 # sec
+
+	def __init__(self, port, peers, echo=False):
+		super().__init__(port)
+		self.peers = peers
+		self.echo = echo
+		self.tx_sn = {}
+		self.rx_sn = {}
+		self.rx_bytes = 0
+		self.errors = 0
+		self.start_ts = time.monotonic()
+		self.call_later(self.report_interval, self.on_report_timer)
+
+	def on_idle(self, hidden, version):
+		print('Idle, version ' + version.decode())
+		if self.peers:
+			self.connect(self.peers)
+
+	def on_connecting(self, idx):
+		print('Connecting to #%u' % idx)
+
+	def on_connected(self, hidden):
+		print('Connected')
+		if not self.echo:
+			for idx in range(len(self.peers)):
+				self.fill_window(idx)
+
+	def on_debug_msg(self, msg):
+		print('    ' + msg.decode())
+
+	def fill_window(self, idx):
+		ch = self.get_channel(idx)
+		while ch.pending() < 2 * ch.window:
+			sn = self.tx_sn.get(idx, 0)
+			self.tx_sn[idx] = sn + 1
+			self.send_reliable(idx, b'%08u' % sn + bytes(random.randrange(256) for _ in range(self.msg_size - 8)))
+
+	def on_reliable_msg(self, idx, data):
+		if self.echo:
+			self.send_reliable(idx, data)
+			return
+		sn, expected = int(data[:8]), self.rx_sn.get(idx, 0)
+		if sn != expected:
+			self.errors += 1
+		self.rx_sn[idx] = sn + 1
+		self.rx_bytes += len(data)
+		self.fill_window(idx)
+
+	def on_report_timer(self):
+		self.call_later(self.report_interval, self.on_report_timer)
+		self.print_stat()
+
+	def print_stat(self):
+		elapsed = time.monotonic() - self.start_ts
+		print('%u bytes received in order (%u B/s), %u sequence errors' % (self.rx_bytes, self.rx_bytes / elapsed, self.errors))
+		for idx, ch in self.channels.items():
+			s = ch.get_stats()
+			print('[%d] sent %u, retransmitted %u, timeouts %u, duplicates %u, pending %u, srtt %s msec' % (
+				idx, s['sent'], s['retransmitted'], s['timeouts'], s['duplicates'], s['pending'],
+				'%.1f' % (1000 * s['srtt']) if s['srtt'] is not None else '-'
+			))
+
+if __name__ == '__main__':
+	echo = '--echo' in sys.argv
+	if echo:
+		sys.argv.remove('--echo')
+	with ReliableTest(sys.argv[1], [addr.encode() for addr in sys.argv[2:]], echo) as ad:
+		ad.reset()
+		try:
+			ad.run()
+		except KeyboardInterrupt:
+			ad.print_stat()
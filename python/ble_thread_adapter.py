@@ -0,0 +1,183 @@
+"""
+BLE multi adapter (ble_uart_mx) host interface running communications in the dedicated thread.
+Any number of producer threads may submit messages while received messages are passed
+to consumers via the queue so slow message handlers never block serial port draining.
+The messages submitted are encoded and queued by the communication thread so the adapter
+state is never accessed by several threads at once.
+
+Expects serial port name as a parameter followed by the peer device addresses to connect to
+if started as script. The script echo all data received from any connected peer back to it.
+"""
+
+import sys
+import time
+import queue
+import threading
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, SimpleAdapter, AdapterEvent
+
+class ThreadedIO:
+	"""Mixin running adapter communications in the dedicated thread.
+	The received messages are put to rx_events queue as AdapterEvent records.
+	The communication errors are passed as events of 'error' kind with exception as data.
+	"""
+	def __init__(self, port):
+		super().__init__(port)
+		self.submitted = queue.SimpleQueue()
+		self.rx_events = queue.SimpleQueue()
+		self.io_thread = None
+		self.stopping = False
+
+	def __enter__(self):
+		self.open()
+		self.start()
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.stop()
+		self.close()
+
+	def start(self):
+		"""Start communication thread"""
+		assert self.io_thread is None
+		self.stopping = False
+		self.io_thread = threading.Thread(target=self.io_worker, name='adapter %s' % self.port, daemon=True)
+		self.io_thread.start()
+
+	def stop(self):
+		"""Stop communication thread"""
+		if self.io_thread:
+			self.stopping = True
+			self.wakeup(force=True)
+			self.io_thread.join()
+			self.io_thread = None
+
+	def io_worker(self):
+		# Don't block on reads since we are waiting in wait_io
+		self.nowait = self.wake_r is not None
+		try:
+			while not self.stopping:
+				self.take_submitted()
+				self.communicate()
+				self.wait_io(self.next_timeout())
+		except Exception as e:
+			self.rx_events.put(AdapterEvent('error', None, e, time.monotonic()))
+
+	def take_submitted(self):
+		"""Perform the calls submitted by other threads"""
+		while True:
+			try:
+				func, args = self.submitted.get_nowait()
+			except queue.Empty:
+				return
+			func(*args)
+
+	def in_io_thread(self):
+		return self.io_thread is None or threading.current_thread() is self.io_thread
+
+	def call_in_io_thread(self, func, *args):
+		"""Pass the call to the communication thread"""
+		self.submitted.put((func, args))
+		self.wakeup()
+
+	def submit_msg(self, msg, key=None):
+		"""Thread safe message submission. The transmit queue limits are applied once the message is taken by the communication thread."""
+		if self.in_io_thread():
+			return super().submit_msg(msg, key)
+		self.call_in_io_thread(super().submit_msg, msg, key)
+
+	def send_frame(self, idx, data, binary=False, key=None, compress=True):
+		"""Thread safe data frame submission. The frame is compressed and encoded by the communication thread."""
+		if self.in_io_thread():
+			return super().send_frame(idx, data, binary, key, compress)
+		# the caller may reuse its buffer once we return
+		self.call_in_io_thread(super().send_frame, idx, bytes(data), binary, key, compress)
+
+	def has_work(self):
+		return not self.submitted.empty() or self.stopping or super().has_work()
+
+	def use_msg_views(self, use = True):
+		"""Not supported since the messages are passed to other threads"""
+		raise NotImplementedError()
+
+	def use_aggregation(self, use = True, max_frame = None, delay = None):
+		"""Not supported since the messages are submitted from other threads"""
+		raise NotImplementedError()
+
+	def reset(self):
+		"""Reset adapter. May be called from any thread."""
+		if self.in_io_thread():
+			super().reset()
+		else:
+			self.call_in_io_thread(super().reset)
+
+	def is_congested(self, idx=None):
+		"""Client should avoid submitting new data if adapter is congested. The adapter state is not changed
+		so it may be called from any thread.
+		"""
+		if idx is None and len(self.tx_queue) + self.submitted.qsize() > self.congest_thr:
+			return True
+		return super().is_congested(idx)
+
+	def get_stats(self):
+		stats = super().get_stats()
+		stats['tx_submitted'] = self.submitted.qsize()
+		return stats
+
+	def queue_event(self, kind, idx=None, data=None, hidden=False):
+		self.rx_events.put(AdapterEvent(kind, idx, data, self.rx_ts, hidden))
+
+	def get_event(self, timeout=None):
+		"""Returns the next received event or None on timeout"""
+		try:
+			ev = self.rx_events.get(timeout=timeout)
+		except queue.Empty:
+			return None
+		if ev.kind == 'error':
+			raise ev.data
+		return ev
+
+	def events(self, timeout=None):
+		"""Yields received events. Returns once there were no events for timeout seconds (never if it is None)."""
+		while (ev := self.get_event(timeout)) is not None:
+			yield ev
+
+	def recv_many(self, max_n=64, timeout=0):
+		"""Returns the list of up to max_n events received waiting up to timeout seconds for the first one
+		(forever if it is None).
+		"""
+		if (ev := self.get_event(timeout)) is None:
+			return []
+		events = [ev]
+		while len(events) < max_n and (ev := self.get_event(0)) is not None:
+			events.append(ev)
+		return events
+
+class ThreadedMutliAdapter(ThreadedIO, MutliAdapter):
+	"""BLE multi-adapter interface running communications in the dedicated thread.
+	The events of 'idle', 'connecting', 'connected', 'debug', 'central' and 'peer' kinds are put to rx_events queue.
+	"""
+
+class ThreadedSimpleAdapter(ThreadedIO, SimpleAdapter):
+	"""BLE simple link adapter interface running communications in the dedicated thread.
+	The data received are put to rx_events queue as events of 'data' kind.
+	"""
+
+if __name__ == '__main__':
+	port  = sys.argv[1]
+	peers = [addr.encode() for addr in sys.argv[2:]]
+	with ThreadedMutliAdapter(port) as ad:
+		ad.reset()
+		for ev in ad.events():
+			if ev.kind == 'idle':
+				print('Idle, version ' + ev.data.decode())
+				ad.connect(peers)
+			elif ev.kind == 'connecting':
+				print('Connecting to #%d' % ev.idx)
+			elif ev.kind == 'debug':
+				print('    ' + ev.data.decode())
+			elif ev.kind == 'peer':
+				print(('[%d] ' % ev.idx) + ev.data.decode())
+				if ev.data:
+					ad.send_data_to(ev.idx, ev.data)
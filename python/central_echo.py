@@ -35,6 +35,5 @@ if __name__ == '__main__':
 	peers = [addr.encode() for addr in sys.argv[2:]]
 	with Echo(port, peers) as ad:
 		ad.reset()
-		while True:
-			ad.communicate()
+		ad.run()
 
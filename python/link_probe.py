@@ -0,0 +1,340 @@
+"""
+BLE multi adapter link capacity probe.
+Expects serial port name as a parameter followed by the addresses of the peers echoing data back.
+With --peripheral option the link to the connected central is probed as well (the central should
+echo data back too). The script sends the stream of echo test messages of the given frame size to
+every link at the given rate in bytes per second for some time and measures goodput, loss,
+duplication, reordering, stall time and echo round trip time. The rate is multiplied by the step
+factor until the load is no longer sustained, then the maximum sustainable rate is found by binary
+search between the last passed and the first failed rate. Then the next frame size is probed.
+The load is sustained if the loss does not exceed the given threshold, the adapter does not stall
+and at least 90% of the rate offered is echoed back on every link. The goodput is the amount of data
+echoed back divided by the time since the step start till the last echo received. The round trip time
+is limited as well since it grows with the amount of data queued if the link is close to saturation.
+The load is not sustained if the round trip time 99th percentile exceeds the one measured at the first
+step of the same frame size by the growth factor given.
+
+Options:
+ --sizes S1,S2,..    frame sizes to probe (64,256,1024 and the max frame size by default)
+ --rate R            the initial rate in bytes per second per link (2000 by default)
+ --step F            the rate multiplier (2 by default)
+ --max-rate R        the rate limit (1000000 by default)
+ --bisect N          the number of binary search steps (4 by default, 0 for stepped load only)
+ --duration T        the step duration in seconds (5 by default)
+ --settle T          the max time to wait for echo after each step in seconds (2 by default)
+ --max-loss P        the max fraction of messages lost (.001 by default)
+ --max-rtt T         the max echo round trip time 99th percentile in seconds (not limited by default)
+ --rtt-growth F      the max round trip time 99th percentile growth since the first step (4 by default, 0 to disable)
+ --csv FILE          write the max sustainable rate per frame size as CSV
+ --steps FILE        write the results of every step per link as CSV
+ --peripheral        probe the link to connected central as well
+ --cobs              send binary data with COBS encoding if supported by the adapter
+ -n                  use new line terminated messages as with USB CDC
+ -b                  write queued messages in batches
+"""
+
+import sys
+import csv
+import time
+
+sys.path.append('.')
+from ble_multi_adapter import LatencyHistogram, CENTRAL
+import multi_echo_long as echo
+
+# The fraction of the rate offered that should be echoed back
+min_goodput = .9
+
+step_fields = ('size', 'rate', 'link', 'sent', 'valid', 'goodput', 'loss', 'dup', 'reorder', 'corrupt', 'stall_time', 'rtt_p50', 'rtt_p99', 'passed')
+summary_fields = ('size', 'max_rate', 'frames_rate', 'goodput', 'rtt_p50', 'rtt_p99', 'steps')
+
+class ProbePlan:
+	"""Chooses the next (frame size, rate) step given the result of the previous one"""
+	def __init__(self, sizes, rate, factor=2, max_rate=1e6, bisect=4):
+		self.sizes = list(sizes)
+		self.start_rate = rate
+		self.factor = factor
+		self.max_rate = max_rate
+		self.bisect = bisect
+		self.best = {} # frame size -> the result of the step with max sustained rate
+		self.steps = {} # frame size -> the number of steps
+		self.size = None
+
+	def start(self, size):
+		self.size = size
+		self.rate = min(self.start_rate, self.max_rate)
+		self.lo, self.hi = 0, None
+		self.bisect_left = self.bisect
+		self.steps[size] = 0
+		return size, self.rate
+
+	def first(self):
+		return self.start(self.sizes.pop(0)) if self.sizes else None
+
+	def next(self, result):
+		"""Returns the next (frame size, rate) step or None if probing is completed"""
+		self.steps[self.size] += 1
+		if result['passed']:
+			self.lo = self.rate
+			self.best[self.size] = result
+		else:
+			self.hi = self.rate
+		if self.hi is None:
+			if self.rate < self.max_rate:
+				self.rate = min(self.rate * self.factor, self.max_rate)
+				return self.size, self.rate
+		elif self.bisect_left > 0:
+			self.bisect_left -= 1
+			self.rate = (self.lo + self.hi) / 2
+			return self.size, self.rate
+		return self.first()
+
+class LinkProbe(echo.EchoTest):
+	"""Echo test applying the load of the given frame size and rate to every link"""
+	tick = .01 # sec, send timer interval
+	duration = 5
+	settle = 2
+	max_loss = .001
+	max_rtt  = None
+	rtt_growth = 4
+
+	def __init__(self, port, targets, peripheral, plan, sizes=None):
+		super().__init__(port, targets, None, True if peripheral else None)
+		self.plan = plan
+		self.sizes = sizes
+		self.links = ([(CENTRAL, self.pstream)] if self.pstream else []) + [(i, self.tstream[i]) for i in self.active]
+		self.size = self.rate = None
+		self.sending = False
+		self.credit = {}
+		self.tick_ts = 0
+		self.step_ts = 0
+		self.settle_ts = 0
+		self.snapshot = None
+		self.step_stall = 0
+		self.last_echo = {}
+		self.base_rtt = {} # frame size -> the round trip time 99th percentile at the first step
+		self.results = []
+		self.started = False
+		self.call_later(.5, self.chk_ready)
+
+	def send_msgs(self, connected):
+		pass
+
+	def send_to(self, idx, msg):
+		if idx == CENTRAL:
+			self.send_data(msg, echo.binary_data)
+		else:
+			self.send_data_to(idx, msg, echo.binary_data)
+
+	def on_debug_msg(self, msg):
+		self.dbg_msgs[msg.decode(errors='replace')] += 1
+
+	def on_central_msg(self, msg):
+		if self.pstream:
+			self.pstream.chunk_received(msg)
+			self.last_echo[CENTRAL] = self.rx_ts
+
+	def on_peer_msg(self, idx, msg):
+		if 0 <= idx < len(self.tstream):
+			self.tstream[idx].chunk_received(msg)
+			self.last_echo[idx] = self.rx_ts
+
+	def total_stall_time(self):
+		if self.is_stall and self.stall_ts:
+			return self.stall_time + time.monotonic() - self.stall_ts
+		return self.stall_time
+
+	def chk_ready(self):
+		"""Start probing once all links are streaming"""
+		if self.max_frame is None or self.is_stall or not all(s.is_started for _, s in self.links):
+			self.call_later(.5, self.chk_ready)
+			return
+		self.started = True
+		if self.sizes is None:
+			self.sizes = [64, 256, 1024, self.max_frame]
+		self.plan.sizes = sorted(set(min(max(s, 16), self.max_frame) for s in self.sizes))
+		if (step := self.plan.first()) is not None:
+			self.start_step(*step)
+		else:
+			self.stop_running()
+
+	def start_step(self, size, rate):
+		self.size, self.rate = size, rate
+		self.snapshot = [(s.last_tx_sn, s.valid_cnt, s.dup_cnt, s.reorder_cnt, s.corrupt_cnt) for _, s in self.links]
+		self.step_stall = self.total_stall_time()
+		self.last_echo.clear()
+		for idx, s in self.links:
+			s.rtt = LatencyHistogram()
+			# the first message is sent right away
+			self.credit[idx] = size
+		self.sending = True
+		self.tick_ts = self.step_ts = time.monotonic()
+		self.call_later(0, self.on_tick)
+		self.call_later(self.duration, self.end_send)
+
+	def on_tick(self):
+		if not self.sending:
+			return
+		self.call_later(self.tick, self.on_tick)
+		now = time.monotonic()
+		budget, self.tick_ts = self.rate * (now - self.tick_ts), now
+		for idx, s in self.links:
+			credit = self.credit[idx] + budget
+			while credit >= self.size and not self.is_congested(idx):
+				self.send_to(idx, s.mk_msg(self.size))
+				credit -= self.size
+			# the credit not used due to congestion is not accumulated
+			self.credit[idx] = min(credit, self.size + self.rate * self.tick)
+
+	def is_drained(self):
+		"""Returns True if all messages sent are echoed back"""
+		return not self.tx_queue and all(s.last_rx_sn == s.last_tx_sn for _, s in self.links)
+
+	def wait_drained(self, callback, deadline):
+		"""Call back once all messages sent are echoed or the deadline expires"""
+		if self.is_drained() or time.monotonic() >= deadline:
+			callback()
+		else:
+			self.call_later(.05, lambda: self.wait_drained(callback, deadline))
+
+	def end_send(self):
+		self.sending = False
+		self.wait_drained(self.finish_step, time.monotonic() + self.settle)
+
+	def finish_step(self):
+		stall_time = self.total_stall_time() - self.step_stall
+		links, passed = [], stall_time == 0
+		for (idx, s), (sn, valid, dup, reorder, corrupt) in zip(self.links, self.snapshot):
+			sent, valid = s.last_tx_sn - sn, min(s.valid_cnt - valid, s.last_tx_sn - sn)
+			# the echoes received while settling are accounted along with the time they took
+			duration = max(self.duration, self.last_echo.get(idx, 0) - self.step_ts)
+			rtt = s.rtt.summary()
+			link = {
+				'size': self.size, 'rate': round(self.rate), 'link': '.' if idx == CENTRAL else idx,
+				'sent': sent, 'valid': valid, 'goodput': round(valid * self.size / duration),
+				'loss': (sent - valid) / sent if sent > valid else 0.,
+				'dup': s.dup_cnt - dup, 'reorder': s.reorder_cnt - reorder, 'corrupt': s.corrupt_cnt - corrupt,
+				'stall_time': round(stall_time, 3), 'rtt_p50': rtt['p50'], 'rtt_p99': rtt['p99'],
+			}
+			passed = passed and link['loss'] <= self.max_loss and link['goodput'] >= min_goodput * self.rate
+			if self.max_rtt is not None and (rtt['p99'] is None or rtt['p99'] > self.max_rtt):
+				passed = False
+			links.append(link)
+		rtt_p99 = links_max(links, 'rtt_p99')
+		if self.size not in self.base_rtt:
+			self.base_rtt[self.size] = rtt_p99
+		elif self.rtt_growth and (base := self.base_rtt[self.size]) is not None:
+			if rtt_p99 is None or rtt_p99 > self.rtt_growth * base:
+				passed = False
+		for link in links:
+			link['passed'] = passed
+		result = {
+			'size': self.size, 'rate': round(self.rate), 'passed': passed, 'links': links,
+			'goodput': min(link['goodput'] for link in links), 'loss': max(link['loss'] for link in links),
+			'rtt_p50': links_max(links, 'rtt_p50'), 'rtt_p99': rtt_p99,
+		}
+		self.results.append(result)
+		print_step(result)
+		if (step := self.plan.next(result)) is not None:
+			# the messages still queued on overload would be accounted in the next step otherwise
+			self.wait_drained(lambda: self.start_step(*step), time.monotonic() + 2 * self.settle)
+		else:
+			self.stop_running()
+
+	def summary(self):
+		"""Returns the list of max sustainable rates per frame size"""
+		res = []
+		for size, steps in self.plan.steps.items():
+			best = self.plan.best.get(size)
+			res.append({
+				'size': size, 'max_rate': best['rate'] if best else 0,
+				'frames_rate': round(best['rate'] / size, 1) if best else 0,
+				'goodput': best['goodput'] if best else 0,
+				'rtt_p50': best['rtt_p50'] if best else None,
+				'rtt_p99': best['rtt_p99'] if best else None,
+				'steps': steps,
+			})
+		return res
+
+def links_max(links, key):
+	return max((link[key] for link in links if link[key] is not None), default=None)
+
+def fmt_msec(t):
+	return '%.1f' % (t * 1e3) if t is not None else '-'
+
+def print_step(r):
+	print('size %5u rate %8u: goodput %8u, loss %5.2f%%, dup %u, reorder %u, stall %.2f sec, rtt p50 %s p99 %s msec %s' % (
+			r['size'], r['rate'], r['goodput'], r['loss'] * 100,
+			sum(link['dup'] for link in r['links']), sum(link['reorder'] for link in r['links']),
+			r['links'][0]['stall_time'], fmt_msec(r['rtt_p50']), fmt_msec(r['rtt_p99']),
+			'passed' if r['passed'] else 'FAILED'
+		))
+
+def print_summary(summary):
+	hline = '-' * 72
+	print(hline)
+	print('%10s %12s %12s %12s %10s %10s' % ('frame size', 'max rate', 'frames/sec', 'goodput', 'rtt p50', 'rtt p99'))
+	print(hline)
+	for r in summary:
+		print('%10u %12u %12.1f %12u %10s %10s' % (
+				r['size'], r['max_rate'], r['frames_rate'], r['goodput'], fmt_msec(r['rtt_p50']), fmt_msec(r['rtt_p99'])
+			))
+	print(hline)
+	print('The rates are in bytes per second per link, the round trip time is in msec')
+
+def write_csv(path, fields, rows):
+	with open(path, 'w', newline='') as f:
+		w = csv.DictWriter(f, fields, extrasaction='ignore')
+		w.writeheader()
+		w.writerows(rows)
+
+def get_opt(name, conv=str, default=None):
+	if name not in sys.argv:
+		return default
+	i = sys.argv.index(name)
+	val = conv(sys.argv[i+1])
+	del sys.argv[i:i+2]
+	return val
+
+if __name__ == '__main__':
+	sizes = get_opt('--sizes', lambda s: [int(v) for v in s.split(',')])
+	plan = ProbePlan((),
+		rate     = get_opt('--rate', float, 2000),
+		factor   = get_opt('--step', float, 2),
+		max_rate = get_opt('--max-rate', float, 1e6),
+		bisect   = get_opt('--bisect', int, 4)
+	)
+	duration = get_opt('--duration', float, LinkProbe.duration)
+	settle   = get_opt('--settle', float, LinkProbe.settle)
+	max_loss = get_opt('--max-loss', float, LinkProbe.max_loss)
+	max_rtt  = get_opt('--max-rtt', float, LinkProbe.max_rtt)
+	rtt_growth = get_opt('--rtt-growth', float, LinkProbe.rtt_growth)
+	csv_file   = get_opt('--csv')
+	steps_file = get_opt('--steps')
+	nl_term    = echo.chk_opt('-n')
+	tx_batch   = echo.chk_opt('-b')
+	cobs       = echo.chk_opt('--cobs')
+	peripheral = echo.chk_opt('--peripheral')
+	targets = [addr.encode() for addr in sys.argv[2:]]
+	# every message should have exactly the frame size being probed
+	echo.random_size = False
+	echo.max_size = None
+	echo.TestStream.verbose = False
+	with LinkProbe(sys.argv[1], targets, peripheral, plan, sizes) as ad:
+		ad.duration, ad.settle, ad.max_loss, ad.max_rtt, ad.rtt_growth = duration, settle, max_loss, max_rtt, rtt_growth
+		if nl_term:
+			ad.selt_nl_terminator()
+		if tx_batch:
+			ad.use_tx_batch()
+		if cobs:
+			ad.use_cobs_encoding()
+		ad.reset()
+		try:
+			ad.run()
+		except KeyboardInterrupt:
+			pass
+		summary = ad.summary()
+		print_summary(summary)
+		if csv_file:
+			write_csv(csv_file, summary_fields, summary)
+		if steps_file:
+			write_csv(steps_file, step_fields, [link for r in ad.results for link in r['links']])
@@ -45,7 +45,6 @@ if __name__ == '__main__':
 			ad.selt_nl_terminator()
 		ad.reset()
 		try:
-			while True:
-				ad.communicate()
+			ad.run()
 		except KeyboardInterrupt:
 			print('%u parse errors' % ad.parse_errors)
@@ -69,8 +69,7 @@ if __name__ == '__main__':
 	with EchoTest(sys.argv[1]) as ad:
 		ad.reset()
 		try:
-			while True:
-				ad.communicate()
+			ad.run()
 		except KeyboardInterrupt:
 			print('%u messages, %u errors (%u lost, %u dup, %u reorder, %u corrupt), parse errors %u' % (
 				ad.msg_cnt, ad.errors, ad.lost, ad.dup, ad.reorder, ad.corrupt, ad.parse_errors
@@ -3,7 +3,11 @@ BLE multi adapter test script.
 Expects serial port name as a parameter.
 The script periodically transmits one or more messages
 with ever incremented sequence number followed by random data
-and expects them to be echoed back.
+and expects them to be echoed back. With --adaptive option
+the messages are sent as fast as the rate controller allows.
+With --cobs option the binary data are sent with COBS encoding
+if the adapter supports it. The --seed N option makes the data
+sent reproducible.
 
 Author: Oleg Volkov
 """
@@ -11,10 +15,12 @@ Author: Oleg Volkov
 import sys
 import time
 import random
-from collections import defaultdict
+from time import perf_counter
+from collections import defaultdict, deque
 
 sys.path.append('.')
-from ble_multi_adapter import MutliAdapter, SimpleAdapter
+from ble_multi_adapter import MutliAdapter, SimpleAdapter, LatencyHistogram, CENTRAL
+from mx_loadgen import PayloadPool
 
 # If false all messages will have maximum allowed size
 random_size = True
@@ -31,17 +37,26 @@ binary_data = True
 # Limit maximum message size
 max_size = 2160
 
+# The data consist of the bytes other than delimiter
 if binary_data:
 	data_delimiter = b'\xff'
+	data_alphabet = bytes(range(0, 255))
 else:
 	data_delimiter = b'#'
+	data_alphabet = bytes(range(ord('0'), ord('z')+1))
+
+# The random data the messages are sliced from, created on first use
+payload_pool = None
 
 def random_bytes(len):
-	return bytes((
-		 random.randrange(0, 255) if binary_data else random.randrange(ord('0'), ord('z')+1) for _ in range(len)
-	))
+	global payload_pool
+	if payload_pool is None:
+		payload_pool = PayloadPool(alphabet=data_alphabet)
+	return payload_pool.take(len)
 
 class TestStream:
+	verbose = True # print errors detected
+
 	def __init__(self, no_wait=False):
 		self.created_ts = time.time()
 		self.is_started = no_wait
@@ -55,38 +70,46 @@ class TestStream:
 		self.dup_cnt = 0
 		self.reorder_cnt = 0
 		self.corrupt_cnt = 0
+		self.sent_ts = deque() # (sn, timestamp) of messages not yet echoed
+		self.rtt = LatencyHistogram()
 
 	def mk_msg(self, max_frame):
 		if max_size is not None and max_frame > max_size:
 			max_frame = max_size
 		self.last_tx_sn += 1
+		self.sent_ts.append((self.last_tx_sn, perf_counter()))
 		sn = b'%u' % self.last_tx_sn
 		max_data_size = (max_frame - len(sn) - 4) // 2 # takes into account separators (sn#data#data)
 		data = random_bytes(max_data_size if not random_size else random.randrange(1, max_data_size+1))
 		return b'(' + sn + data_delimiter + data + data_delimiter + data + b')'
 
+	def log(self, msg):
+		if self.verbose:
+			print(msg, end='')
+
 	def msg_received(self, msg):
 		if msg[:1] != b'(' or msg[-1:] != b')':
-			print(' corrupt brackets', end='')
+			self.log(' corrupt brackets')
 			self.corrupt_cnt += 1
 			return False
 		m = msg[1:-1].split(data_delimiter)
 		self.byte_cnt += len(msg)
 		if len(m) != 3:
-			print(' corrupt delimiters', end='')
+			self.log(' corrupt delimiters')
 			self.corrupt_cnt += 1
 			return False
 		try:
 			sn = int(m[0])
 		except ValueError:
-			print(' corrupt sn', end='')
+			self.log(' corrupt sn')
 			self.corrupt_cnt += 1
 			return False
+		self.echo_received(sn)
 		if not (valid := (m[1] == m[2])):
-			print(' corrupt data', end='')
+			self.log(' corrupt data')
 			self.corrupt_cnt += 1
 		if self.last_rx_sn is not None and sn != self.last_rx_sn + 1:
-			print(' bad sn: %u %u' % (self.last_rx_sn, sn), end='')
+			self.log(' bad sn: %u %u' % (self.last_rx_sn, sn))
 			if sn > self.last_rx_sn + 1:
 				self.lost_cnt += sn - self.last_rx_sn - 1
 			elif sn == self.last_rx_sn:
@@ -98,6 +121,14 @@ class TestStream:
 		self.last_rx_sn = sn
 		return valid
 
+	def echo_received(self, sn):
+		"""Record round trip time of the message with given sequence number"""
+		sent_ts = self.sent_ts
+		while sent_ts and sent_ts[0][0] < sn:
+			sent_ts.popleft()
+		if sent_ts and sent_ts[0][0] == sn:
+			self.rtt.record(perf_counter() - sent_ts.popleft()[1])
+
 	def chunk_received(self, msg):
 		if not msg:
 			# stream start tag
@@ -111,12 +142,27 @@ class TestStream:
 		if self.msg_received(msg):
 			self.valid_cnt += 1
 
+	def err_cnt(self):
+		return self.lost_cnt + self.corrupt_cnt
+
 	def print_stat(self, prefix):
 		print('%sconnected %u time(s)' % (prefix, self.conn_cnt))
 		print('%s%u msgs sent, %u received (%u bytes, %u/sec)' % (prefix, self.last_tx_sn, self.msg_cnt, self.byte_cnt, self.byte_cnt / (time.time() - self.created_ts + .001)))
 		print('%s%u valid, %u lost, %u dup, %u reorder, %u corrupt)' % (
 				prefix, self.valid_cnt, self.lost_cnt, self.dup_cnt, self.reorder_cnt, self.corrupt_cnt
 			))
+		print_latency(prefix + 'echo rtt', self.rtt.summary())
+
+def print_latency(prefix, s):
+	if s['count']:
+		print('%s: p50 %.1f, p99 %.1f, p999 %.1f, max %.1f msec (%u samples)' % (
+				prefix, s['p50'] * 1e3, s['p99'] * 1e3, s['p999'] * 1e3, s['max'] * 1e3, s['count']
+			))
+
+def print_adapter_latency(ad):
+	for kind, hists in ad.get_latency().items():
+		for key, s in hists.items():
+			print_latency('[%s] %s' % ('.' if key == CENTRAL else key, kind.replace('_', ' ')), s)
 
 class EchoTest(MutliAdapter):
 	def __init__(self, port, targets = None, active = None, peripheral = None):
@@ -131,10 +177,12 @@ class EchoTest(MutliAdapter):
 		self.active = active
 		self.peripheral = peripheral
 		self.max_frame = None
+		self.connected = False
 		self.dbg_msgs = defaultdict(int)
 		self.pstream = TestStream() if peripheral else None
 		self.tstream = [TestStream() for _ in targets]
 		self.created_ts = time.time()
+		self.use_latency_stats()
 
 	def send_msg(self, connected):
 		if self.pstream is not None:
@@ -144,13 +192,37 @@ class EchoTest(MutliAdapter):
 				self.send_data_to(i, self.tstream[i].mk_msg(self.max_frame), binary_data)
 
 	def send_msgs(self, connected):
-		if self.max_frame is None:
+		if self.max_frame is None or self.adaptive:
 			return
 		for _ in range(tx_burst):
 			if not self.is_congested():
 				self.send_msg(connected)
 
+	def send_adaptive(self):
+		"""Send messages as fast as rate controller allows"""
+		if self.pstream is not None and not self.is_congested(CENTRAL):
+			self.send_data(self.pstream.mk_msg(self.max_frame), binary_data)
+		if self.connected:
+			for i in self.active:
+				if not self.is_congested(i):
+					self.send_data_to(i, self.tstream[i].mk_msg(self.max_frame), binary_data)
+
+	def communicate(self):
+		if self.adaptive and self.max_frame is not None:
+			self.send_adaptive()
+		super().communicate()
+
+	def next_timeout(self):
+		timeout = super().next_timeout()
+		if self.adaptive and self.max_frame is not None and not self.is_stall:
+			# wake up once the rate controller allows sending
+			delay = min((ctl.send_delay() for ctl in self.rate_ctl.values()), default=None)
+			if delay is not None:
+				timeout = delay if timeout is None else min(timeout, delay)
+		return timeout
+
 	def on_idle(self, hidden, version):
+		self.connected = False
 		try:
 			v = version.split(b'-')
 			self.max_frame = int(v[1])
@@ -163,6 +235,7 @@ class EchoTest(MutliAdapter):
 			self.connect(self.targets)
 
 	def on_connected(self, hidden):
+		self.connected = True
 		self.send_msgs(True)
 
 	def on_debug_msg(self, msg):
@@ -176,13 +249,19 @@ class EchoTest(MutliAdapter):
 	def on_central_msg(self, msg):
 		print('[.] %r' % msg, end='')
 		if self.pstream:
+			err_cnt = self.pstream.err_cnt()
 			self.pstream.chunk_received(msg)
+			if self.adaptive and self.pstream.err_cnt() > err_cnt:
+				self.report_loss(CENTRAL)
 		print()
 
 	def on_peer_msg(self, idx, msg):
 		print('[%d] %r' % (idx, msg), end='')
 		if 0 <= idx < len(self.tstream):
+			err_cnt = self.tstream[idx].err_cnt()
 			self.tstream[idx].chunk_received(msg)
+			if self.adaptive and self.tstream[idx].err_cnt() > err_cnt:
+				self.report_loss(idx)
 		print()
 
 	def print_stat(self):
@@ -196,6 +275,11 @@ class EchoTest(MutliAdapter):
 			print(hline)
 		print('test duration: %.2f sec, stall time: %.2f sec' % (time.time() - self.created_ts, self.stall_time))
 		print('parse errors: %u, lost frames: %u' % (self.parse_errors, self.lost_frames))
+		for idx, ctl in self.rate_ctl.items():
+			print('[%s] rate %u bytes/sec, %u losses, %u decreases' % (
+					'.' if idx == CENTRAL else idx, ctl.rate, ctl.loss_cnt, ctl.decr_cnt
+				))
+		print_adapter_latency(self)
 		print('debug messages:')
 		for msg, cnt in self.dbg_msgs.items():
 			print('%u: %s' % (cnt, msg))
@@ -204,7 +288,8 @@ class SimpleEchoTest(SimpleAdapter):
 	def __init__(self, port):
 		super().__init__(port)
 		self.stream = TestStream(no_wait=True)
-		self.last_tx = 0
+		self.use_latency_stats()
+		self.call_later(0, self.on_tx_timer)
 
 	def send_msg(self):
 		self.send_data(self.stream.mk_msg(max_size), binary_data)
@@ -214,18 +299,16 @@ class SimpleEchoTest(SimpleAdapter):
 		self.stream.chunk_received(data)
 		print()
 
-	def communicate(self):
+	def on_tx_timer(self):
+		self.call_later(simple_tx_interval, self.on_tx_timer)
 		if not self.is_congested():
-			now = time.time()
-			if now >= self.last_tx + simple_tx_interval:
-				self.last_tx = now
-				self.send_msg()
-		super().communicate()
+			self.send_msg()
 
 	def print_stat(self):
 		print('-' * 64)
 		self.stream.print_stat('')
 		print('parse errors: %u, lost frames: %u' % (self.parse_errors, self.lost_frames))
+		print_adapter_latency(self)
 
 def chk_opt(name):
 	if opt := name in sys.argv:
@@ -235,19 +318,27 @@ def chk_opt(name):
 def test_simple():
 	nl_term = chk_opt('-n')
 	stream_tags = chk_opt('-s')
+	tx_batch = chk_opt('-b')
+	cobs = chk_opt('--cobs')
 	with SimpleEchoTest(sys.argv[1]) as ad:
 		if nl_term:
 			ad.selt_nl_terminator()
 		if stream_tags:
 			ad.use_stream_tags()
+		if tx_batch:
+			ad.use_tx_batch()
+		if cobs:
+			ad.use_cobs_encoding()
 		try:
-			while True:
-				ad.communicate()
+			ad.run()
 		except KeyboardInterrupt:
 			ad.print_stat()
 
 def test_multi():
 	nl_term = chk_opt('-n')
+	tx_batch = chk_opt('-b')
+	adaptive = chk_opt('--adaptive')
+	cobs = chk_opt('--cobs')
 	first_only = chk_opt('--first-only')
 	last_only  = chk_opt('--last-only')
 	peripheral = chk_opt('--peripheral')
@@ -256,14 +347,30 @@ def test_multi():
 	with EchoTest(sys.argv[1], targets, active, True if peripheral else None) as ad:
 		if nl_term:
 			ad.selt_nl_terminator()
+		if tx_batch:
+			ad.use_tx_batch()
+		if adaptive:
+			ad.use_rate_control()
+		if cobs:
+			ad.use_cobs_encoding()
 		ad.reset()
 		try:
-			while True:
-				ad.communicate()
+			ad.run()
 		except KeyboardInterrupt:
 			ad.print_stat()
 
+def get_opt(name, conv=str, default=None):
+	if name not in sys.argv:
+		return default
+	i = sys.argv.index(name)
+	val = conv(sys.argv[i+1])
+	del sys.argv[i:i+2]
+	return val
+
 if __name__ == '__main__':
+	if (seed := get_opt('--seed', int)) is not None:
+		random.seed(seed)
+		payload_pool = PayloadPool(seed, alphabet=data_alphabet)
 	if chk_opt('--simple'):
 		test_simple()
 	else:
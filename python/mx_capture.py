@@ -0,0 +1,271 @@
+"""
+BLE multi adapter (ble_uart_mx) raw serial stream capture, replay and offline analysis.
+
+The CaptureLog records timestamped chunks of raw data received from and written to the port
+into memory mapped file. It is attached to the adapter by use_capture() method. Every record is
+committed by updating the file header so the log remains usable even if the process crashes.
+The log may be replayed through the adapter receive path at recorded or maximum speed.
+The analyzer finds frames, stream tag gaps, frame size distribution and inter-arrival times
+in the captured receive stream with vectorized operations (requires numpy).
+
+Usage as script:
+ mx_capture.py capture port file [peer address ...]   capture echoing data received from peers
+ mx_capture.py replay file [--speed factor]            replay capture printing messages received
+ mx_capture.py analyze file [-n]                       analyze capture (-n for new line terminated frames)
+"""
+
+import sys
+import time
+import mmap
+import struct
+
+sys.path.append('.')
+from ble_multi_adapter import MutliAdapter, STREAM_TAG_FIRST, STREAM_TAGS_MOD
+
+CAPTURE_RX = 0
+CAPTURE_TX = 1
+
+class CaptureLog:
+	"""Memory mapped log of raw data chunks. The file starts with the header holding magic,
+	the capture start time and the size of the data recorded followed by the records each one
+	consisting of the timestamp, the data length, the direction (CAPTURE_RX / CAPTURE_TX) and the data.
+	The file is grown twice once it is full unless max_size is reached in which case the records are dropped.
+	"""
+	magic  = b'MXCAP\0\1\0'
+	header = struct.Struct('<8sdQ')
+	record = struct.Struct('<dIB')
+
+	def __init__(self, path, size=1024*1024, max_size=None):
+		self.path = path
+		self.max_size = max_size
+		self.dropped = 0
+		self.file = open(path, 'w+b')
+		self.file.truncate(max(size, self.header.size))
+		self.mm = mmap.mmap(self.file.fileno(), 0)
+		self.start_ts = time.time()
+		self.used = self.header.size
+		self.header.pack_into(self.mm, 0, self.magic, self.start_ts, self.used)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.close()
+
+	def close(self):
+		"""Close log truncating the file to the size of data recorded"""
+		if self.mm is not None:
+			self.mm.flush()
+			self.mm.close()
+			self.mm = None
+			self.file.truncate(self.used)
+			self.file.close()
+
+	def grow(self, size):
+		new_size = len(self.mm)
+		while new_size < size:
+			new_size *= 2
+		if self.max_size and new_size > self.max_size:
+			if size > self.max_size:
+				return False
+			new_size = self.max_size
+		self.mm.close()
+		self.file.truncate(new_size)
+		self.mm = mmap.mmap(self.file.fileno(), 0)
+		return True
+
+	def append(self, direction, data):
+		"""Record data chunk with the current timestamp"""
+		pos = self.used
+		end = pos + self.record.size + len(data)
+		if end > len(self.mm) and not self.grow(end):
+			self.dropped += 1
+			return
+		self.record.pack_into(self.mm, pos, time.time(), len(data), direction)
+		self.mm[pos + self.record.size:end] = data
+		self.used = end
+		struct.pack_into('<Q', self.mm, 16, end)
+
+	def rx(self, data):
+		self.append(CAPTURE_RX, data)
+
+	def tx(self, data):
+		self.append(CAPTURE_TX, data)
+
+class CaptureReader:
+	"""Iterates over the (timestamp, direction, data) records of the capture log"""
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.start_ts, self.used = CaptureLog.header.unpack_from(self.mm, 0)
+		if magic != CaptureLog.magic:
+			raise ValueError('not a capture log')
+		self.used = min(self.used, len(self.mm))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.mm.close()
+
+	def __iter__(self):
+		mm, rec = self.mm, CaptureLog.record
+		pos, used = CaptureLog.header.size, self.used
+		while pos + rec.size <= used:
+			ts, size, direction = rec.unpack_from(mm, pos)
+			pos += rec.size
+			if pos + size > used:
+				break
+			yield ts, direction, mm[pos:pos + size]
+			pos += size
+
+	def chunks(self, direction=CAPTURE_RX):
+		"""Returns the (timestamps, data) tuple with the lists of timestamps and data chunks in given direction"""
+		ts, data = [], []
+		for t, d, chunk in self:
+			if d == direction:
+				ts.append(t)
+				data.append(chunk)
+		return ts, data
+
+def replay(path, adapter, speed=None):
+	"""Push the data received in the capture through the adapter receive path. The speed is the factor
+	the recorded timing is scaled by (1 to replay in real time) or None to replay at maximum speed.
+	"""
+	with CaptureReader(path) as cap:
+		first_ts, start = None, time.time()
+		for ts, direction, data in cap:
+			if direction != CAPTURE_RX:
+				continue
+			if speed:
+				if first_ts is None:
+					first_ts = ts
+				if (delay := start + (ts - first_ts) / speed - time.time()) > 0:
+					time.sleep(delay)
+			adapter.process_rx(data)
+
+def analyze(path, start_tag=b'\1', end_tag=b'\0', use_tags=True):
+	"""Returns the dict with statistics of the frames received in the capture. The frames are found
+	with vectorized operations so millions of frames are analyzed without the loop per frame.
+	"""
+	import numpy as np
+	with CaptureReader(path) as cap:
+		ts, chunks = cap.chunks(CAPTURE_RX)
+	buff = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+	chunk_end = np.cumsum([len(c) for c in chunks])
+	ends = np.flatnonzero(buff == end_tag[0])
+	prev_ends = np.concatenate(([-1], ends[:-1]))
+	if start_tag:
+		# the frame starts after the last start tag preceding its end tag
+		starts = np.flatnonzero(buff == start_tag[0])
+		i = np.searchsorted(starts, ends) - 1
+		begins = np.where(i >= 0, starts[np.maximum(i, 0)], -1)
+		valid = begins > prev_ends
+		# frames without start tag and the ones with garbage before it
+		errors = int(np.count_nonzero(~valid) + np.count_nonzero(begins[valid] != prev_ends[valid] + 1))
+		ends, begins = ends[valid], begins[valid] + 1
+	else:
+		begins, errors = prev_ends + 1, 0
+	sizes = ends - begins
+	frame_ts = np.asarray(ts)[np.searchsorted(chunk_end, ends, side='right')] if len(ends) else np.zeros(0)
+	res = {
+		'bytes': len(buff), 'chunks': len(chunks), 'frames': len(ends), 'parse_errors': errors,
+		'duration': float(frame_ts[-1] - frame_ts[0]) if len(ends) else 0.,
+	}
+	if use_tags:
+		# frames having valid stream tags
+		topen = buff[np.minimum(begins, len(buff) - 1)].astype(np.int64)
+		tclose = buff[np.maximum(ends - 1, 0)].astype(np.int64)
+		tagged = (sizes >= 2) & (topen >= STREAM_TAG_FIRST) & (topen < STREAM_TAG_FIRST + STREAM_TAGS_MOD)
+		tagged &= tclose == STREAM_TAG_FIRST + (topen - STREAM_TAG_FIRST + sizes - 2) % STREAM_TAGS_MOD
+		tags, tags_ts = topen[tagged], frame_ts[tagged]
+		gaps = (tags[1:] - STREAM_TAG_FIRST - (tags[:-1] - STREAM_TAG_FIRST + 1)) % STREAM_TAGS_MOD
+		gap_idx = np.flatnonzero(gaps)
+		res['untagged_frames'] = int(np.count_nonzero(~tagged))
+		res['lost_frames'] = int(gaps.sum())
+		res['tag_gaps'] = [(float(tags_ts[i + 1]), int(gaps[i])) for i in gap_idx[:64]]
+		# strip tags
+		begins, sizes = np.where(tagged, begins + 1, begins), np.where(tagged, sizes - 2, sizes)
+	if len(sizes):
+		pcts = (50, 90, 99, 100)
+		res['frame_size'] = {'p%u' % p: float(v) for p, v in zip(pcts, np.percentile(sizes, pcts))}
+		# frame sizes histogram by power of 2 buckets
+		hist = np.bincount(np.ceil(np.log2(np.maximum(sizes, 1))).astype(np.int64))
+		res['frame_size_hist'] = {1 << b: int(n) for b, n in enumerate(hist) if n}
+		# frames count by the first byte telling the message kind
+		kinds = np.bincount(np.where(sizes > 0, buff[np.minimum(begins, len(buff) - 1)], 0), minlength=256)
+		res['frame_kinds'] = {chr(k) if k else '': int(n) for k, n in enumerate(kinds) if n}
+	if len(frame_ts) > 1:
+		iat = np.diff(frame_ts)
+		res['inter_arrival'] = {'mean': float(iat.mean()), 'p50': float(np.percentile(iat, 50)),
+			'p99': float(np.percentile(iat, 99)), 'max': float(iat.max())}
+	return res
+
+class Printer(MutliAdapter):
+	def on_status_msg(self, msg):
+		print(':' + msg.decode(errors='replace'))
+		super().on_status_msg(msg)
+
+	def on_debug_msg(self, msg):
+		print('    ' + msg.decode(errors='replace'))
+
+	def on_central_msg(self, msg):
+		print('< %s' % msg)
+
+	def on_peer_msg(self, idx, msg):
+		print('%u %s' % (idx, msg))
+
+class Echo(MutliAdapter):
+	def __init__(self, port, peers):
+		super().__init__(port)
+		self.peers = peers
+
+	def on_idle(self, hidden, version):
+		if self.peers:
+			self.connect(self.peers)
+
+	def on_central_msg(self, msg):
+		if msg:
+			self.send_data(msg)
+
+	def on_peer_msg(self, idx, msg):
+		if msg:
+			self.send_data_to(idx, msg)
+
+def chk_opt(name):
+	if name in sys.argv:
+		sys.argv.remove(name)
+		return True
+	return False
+
+def get_opt(name, conv=str, default=None):
+	if name not in sys.argv:
+		return default
+	i = sys.argv.index(name)
+	val = conv(sys.argv[i+1])
+	del sys.argv[i:i+2]
+	return val
+
+if __name__ == '__main__':
+	speed = get_opt('--speed', float)
+	nl_term = chk_opt('-n')
+	cmd = sys.argv[1] if len(sys.argv) > 1 else None
+	if cmd == 'capture':
+		with CaptureLog(sys.argv[3]) as cap, Echo(sys.argv[2], [addr.encode() for addr in sys.argv[4:]]) as ad:
+			ad.use_capture(cap)
+			ad.reset()
+			try:
+				ad.run()
+			except KeyboardInterrupt:
+				pass
+	elif cmd == 'replay':
+		ad = Printer(None)
+		if nl_term:
+			ad.selt_nl_terminator()
+		replay(sys.argv[2], ad, speed)
+		print(ad.get_stats())
+	elif cmd == 'analyze':
+		for k, v in analyze(sys.argv[2], *((b'', b'\n') if nl_term else ())).items():
+			print('%s: %s' % (k, v))
+	else:
+		print(__doc__)
@@ -0,0 +1,533 @@
+"""
+BLE multi adapter (ble_uart_mx) firmware emulator.
+Opens pseudo terminal and speaks the adapter serial protocol on it so the host side
+scripts may be run and benchmarked without ESP32 hardware. The remote peers and the
+central echo all data received back like the adapters built with ECHO option.
+The BLE links may be impaired by the frame loss, duplication, reordering, corruption
+and bandwidth limit.
+
+If started as script prints the pseudo terminal name to be passed to the host side script.
+Options:
+ -n                   use new line terminated messages as with USB CDC
+ --simple             emulate SIMPLE_LINK adapter connected to the single peer
+ --stream-tags        use stream tags in simple link mode
+ --text               no binary data support (no EXT_FRAMES) with BLE frame size limit
+ --central            emulate connected central
+ --hidden             start hidden
+ --loss P             chunk loss probability
+ --dup P              frame duplication probability
+ --reorder P          frame reordering probability
+ --corrupt P          frame corruption probability
+ --bandwidth B        the link bandwidth limit in bytes per second
+ --latency T          the round trip time in seconds
+ --cobs               output binary data with COBS encoding as the adapter built with COBS_ENCODING option
+ --seed N             random generator seed
+"""
+
+import os
+import sys
+import tty
+import time
+import errno
+import termios
+import heapq
+import base64
+import random
+import select
+import binascii
+import threading
+
+sys.path.append('.')
+from ble_multi_adapter import AdapterConnection, STREAM_TAG_FIRST
+
+class PtyPort:
+	"""Master side of the pseudo terminal with serial port like interface.
+	The slave side is not kept open so the host closing the port is detected by reads failing with EIO.
+	The terminal settings are restored then since the pty driver ignores parity and rejects the settings
+	of the next host session if enabling parity is the only change they make.
+	"""
+	# The output exceeding this limit is dropped as if host does not read it
+	max_pending = 64*1024
+
+	def __init__(self, fd, name, attrs):
+		self.fd = fd
+		self.name = name
+		self.attrs = attrs
+		self.connected = False
+		self.tx_buff = bytearray()
+		os.set_blocking(fd, False)
+
+	def fileno(self):
+		return self.fd
+
+	def read(self, size):
+		try:
+			data = os.read(self.fd, size)
+		except BlockingIOError:
+			data = b''
+		except OSError as e:
+			if e.errno != errno.EIO:
+				raise
+			# slave side is closed
+			if self.connected:
+				self.on_hangup()
+			return b''
+		self.connected = True
+		return data
+
+	def on_hangup(self):
+		self.connected = False
+		fd = os.open(self.name, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		try:
+			termios.tcsetattr(fd, termios.TCSANOW, self.attrs)
+		finally:
+			os.close(fd)
+
+	def write(self, data):
+		if len(self.tx_buff) < self.max_pending:
+			self.tx_buff += data
+			self.flush()
+		return len(data)
+
+	def flush(self):
+		if self.tx_buff:
+			try:
+				written = os.write(self.fd, self.tx_buff)
+			except BlockingIOError:
+				written = 0
+			del self.tx_buff[:written]
+
+	def discard_input(self):
+		while self.read(4096):
+			pass
+
+	def close(self):
+		os.close(self.fd)
+
+class BleLink:
+	"""Emulated BLE connection to the remote device echoing all data received back"""
+	def __init__(self, emu, tag):
+		self.emu = emu
+		self.tag = tag
+		self.pending = []
+		self.tx_done = []
+		self.busy_until = 0
+		self.sn = 0
+		self.tx_cnt = 0
+		self.lost_cnt = 0
+		self.dup_cnt = 0
+		self.reorder_cnt = 0
+		self.corrupt_cnt = 0
+		self.queue_full = 0
+		self.last_queue_full = 0
+
+	def is_congested(self, now):
+		"""The link is congested if transmit queue is full"""
+		while self.tx_done and self.tx_done[0] <= now:
+			heapq.heappop(self.tx_done)
+		return len(self.tx_done) >= self.emu.link_queue
+
+	def transmit(self, data, binary, now):
+		"""Send data frame to the remote device"""
+		emu, rnd = self.emu, self.emu.rnd
+		self.tx_cnt += 1
+		start = max(now, self.busy_until)
+		self.busy_until = start + len(data) / emu.bandwidth if emu.bandwidth else start
+		heapq.heappush(self.tx_done, self.busy_until)
+		if len(self.tx_done) >= emu.link_queue:
+			# the next frame will not fit into the queue
+			self.queue_full += 1
+		nchunks = (len(data) + emu.max_chunk - 1) // emu.max_chunk
+		if emu.loss and any(rnd.random() < emu.loss for _ in range(2 * nchunks)):
+			# lost either on the way to the remote device or back
+			self.lost_cnt += 1
+			return
+		if emu.corrupt and rnd.random() < emu.corrupt:
+			self.corrupt_cnt += 1
+			if emu.ext_frames:
+				# dropped by checksum validation
+				emu.debug_msg(b'-invalid checksum from [' + self.tag + b']')
+				return
+			data = bytearray(data)
+			data[rnd.randrange(len(data))] ^= 1 << rnd.randrange(8)
+			data = bytes(data)
+		ts = self.busy_until + emu.latency
+		if emu.reorder and rnd.random() < emu.reorder:
+			self.reorder_cnt += 1
+			ts += emu.reorder_delay
+		self.deliver_at(ts, data, binary)
+		if emu.dup and rnd.random() < emu.dup:
+			self.dup_cnt += 1
+			self.deliver_at(ts, data, binary)
+
+	def deliver_at(self, ts, data, binary):
+		self.sn += 1
+		heapq.heappush(self.pending, (ts, self.sn, data, binary))
+
+	def poll(self, now):
+		"""Deliver data echoed by the remote device"""
+		while self.pending and self.pending[0][0] <= now:
+			_, _, data, binary = heapq.heappop(self.pending)
+			self.emu.print_data(self.tag, data, binary)
+
+	def next_event_ts(self):
+		ts = [self.pending[0][0]] if self.pending else []
+		if self.tx_done:
+			ts.append(self.tx_done[0])
+		return min(ts, default=None)
+
+class MxEmulator(AdapterConnection):
+	"""BLE multi-adapter firmware emulator class"""
+	version      = b'1.0'
+	ext_frames   = True
+	max_size     = 244  # BLE characteristic size
+	max_chunks   = 9
+	max_peers    = 4
+	simple       = False
+	hidden       = False
+	central      = False
+	status_interval = 1 # sec
+	boot_time    = .1   # sec
+	connect_time = .1   # sec
+	link_queue   = 4    # the number of frames the link may queue before congestion
+	# Link impairments
+	loss         = 0    # chunk loss probability
+	dup          = 0    # frame duplication probability
+	reorder      = 0    # frame reordering probability
+	reorder_delay = .05 # sec
+	corrupt      = 0    # frame corruption probability
+	bandwidth    = None # bytes per second
+	latency      = .01  # round trip time, sec
+
+	def __init__(self, seed=None):
+		super().__init__(None)
+		self.rnd = random.Random(seed)
+		self.io_thread = None
+		self.stopping = False
+		self.reset_state()
+
+	def __enter__(self):
+		self.open()
+		self.start()
+		return self
+
+	def __exit__(self, ex_type, ex_value, traceback):
+		self.stop()
+		self.close()
+
+	@property
+	def max_chunk(self):
+		return self.max_size - 4 if self.ext_frames else self.max_size
+
+	@property
+	def max_frame(self):
+		return self.max_chunk * self.max_chunks if self.ext_frames else self.max_chunk
+
+	@property
+	def variant(self):
+		return ('X' if self.ext_frames else 'B') + ('H' if self.hidden else '') + ('s' if self.cobs_encoding else '')
+
+	def open(self):
+		"""Create pseudo terminal. The host should open the port given by the port attribute."""
+		assert self.com is None
+		master_fd, slave_fd = os.openpty()
+		# Otherwise the data written to the master side will be echoed back
+		tty.setraw(slave_fd)
+		self.port = os.ttyname(slave_fd)
+		self.com = PtyPort(master_fd, self.port, termios.tcgetattr(slave_fd))
+		os.close(slave_fd)
+		self.boot(time.monotonic())
+
+	def start(self):
+		"""Start emulation in the dedicated thread"""
+		assert self.io_thread is None
+		self.stopping = False
+		self.io_thread = threading.Thread(target=self.run, name='emulator %s' % self.port, daemon=True)
+		self.io_thread.start()
+
+	def stop(self):
+		"""Stop emulation thread"""
+		if self.io_thread:
+			self.stopping = True
+			self.io_thread.join()
+			self.io_thread = None
+
+	def use_simple_link(self, stream_tags=False):
+		"""Emulate simple link adapter connected to the single peer"""
+		self.simple = True
+		self.use_tags = stream_tags
+		self.opt_tags = False
+
+	def reset_state(self):
+		self.peers = []
+		self.links = {}
+		self.connected_peers = 0
+		self.connect_ts = None
+		self.advertising = not self.hidden
+		self.booting_until = 0
+		self.last_status_ts = None
+		self.last_parse_errors = self.parse_errors
+		self.last_lost_frames = self.lost_frames
+		self.last_tx_tag = STREAM_TAG_FIRST - 1
+		self.last_rx_tag = 0
+		self.rx_buff = bytearray()
+		self.rx_scan = 0
+		self.rx_begin = -1
+
+	def boot(self, now):
+		"""Emulate adapter restart"""
+		self.reset_state()
+		self.booting_until = now + self.boot_time
+
+	def on_booted(self, now):
+		self.booting_until = 0
+		if self.simple:
+			self.peers = [b'00:00:00:00:00:00']
+			self.connect_ts = now
+		else:
+			self.debug_msg(b'-BT device Mx-EMU at 00:00:00:00:00:00 on emulator')
+			if self.central:
+				self.connect_central()
+
+	def connect_central(self):
+		self.links[b'<'] = BleLink(self, b'<')
+		# stream start
+		self.print_data(b'<', b'', False)
+
+	def is_idle(self):
+		return not self.peers
+
+	def is_connected(self):
+		return self.peers and self.connected_peers >= len(self.peers)
+
+	def is_congested(self, now=None):
+		now = now or time.monotonic()
+		return any(link.is_congested(now) for link in self.links.values())
+
+	def debug_msg(self, msg):
+		if not self.simple:
+			self.write_msg(msg)
+
+	def print_data(self, tag, data, binary):
+		if not self.ext_frames:
+			binary = self.is_data_binary(data)
+		if binary:
+			data = self.encode_binary(data)
+		self.write_msg(data if self.simple else tag + data)
+
+	def is_data_binary(self, data):
+		return self.end_tag in data or self.b64_tag in data or self.cobs_tag in data or (self.start_tag and self.start_tag in data)
+
+	def report_status(self):
+		if self.is_idle():
+			self.write_msg(b':I%s %s-%u-%s' % (
+					b'' if self.advertising else b'h', self.version, self.max_frame, self.variant.encode()
+				))
+		elif self.is_connected():
+			self.write_msg(b':D' if self.advertising else b':Dh')
+
+	def connect_next(self, now):
+		"""Complete connection to the next peer. Then start connecting the next one."""
+		idx = self.connected_peers
+		addr = self.peers[idx]
+		self.debug_msg(b'-connected to %s in %u msec, writable' % (addr, self.connect_time * 1000))
+		self.links[b'%u' % idx] = BleLink(self, b'%u' % idx)
+		self.connected_peers += 1
+		self.debug_msg(b'-peripheral [%u] %s connected' % (idx, addr))
+		if self.is_connected():
+			self.connect_ts = None
+			# the stream start tokens are output once all peers are connected
+			for i in range(len(self.peers)):
+				self.print_data(b'%u' % i, b'', False)
+		else:
+			self.start_connecting(now)
+
+	def start_connecting(self, now):
+		idx = self.connected_peers
+		if not self.simple:
+			self.write_msg(b':C%u' % idx)
+		self.debug_msg(b'-connecting to %s' % self.peers[idx])
+		self.connect_ts = now + self.connect_time
+
+	def process_msg(self, msg):
+		if self.booting_until:
+			return
+		if not msg:
+			self.parse_errors += 1
+			return
+		if self.simple:
+			self.transmit_to(b'0', msg)
+			return
+		tag = msg[:1]
+		if tag == b'#':
+			self.process_cmd(msg[1:])
+		elif tag == b'>':
+			if not self.advertising:
+				self.debug_msg(b"-can't transmit while hidden")
+			else:
+				self.transmit_to(b'<', msg[1:])
+		elif not 0 <= msg[0] - ord('0') < self.max_peers:
+			self.debug_msg(b'-bad peripheral index')
+		else:
+			self.transmit_to(tag, msg[1:])
+
+	def process_cmd(self, cmd):
+		tag = cmd[:1]
+		if tag == b'R' and len(cmd) == 1:
+			self.boot(time.monotonic())
+		elif tag == b'C':
+			if self.peers:
+				self.debug_msg(b'-already connected')
+				return
+			peers = cmd[1:].split()
+			if len(peers) > self.max_peers:
+				self.debug_msg(b'-fatal: Bad peripheral index')
+				self.boot(time.monotonic())
+				return
+			for i, addr in enumerate(peers):
+				self.debug_msg(b'-connection [%u] initialized, 200000 bytes free' % i)
+			if peers:
+				self.peers = peers
+				self.start_connecting(time.monotonic())
+		elif tag == b'A' and len(cmd) == 1 and self.hidden:
+			self.advertising = True
+		else:
+			self.debug_msg(b'-unrecognized command')
+			self.parse_errors += 1
+
+	def transmit_to(self, tag, data):
+		"""Decode data and send it over the BLE link"""
+		if not (link := self.links.get(tag)):
+			# not connected, ignore silently
+			return
+		binary = data[:1] == self.b64_tag
+		if binary:
+			if len(data) % 4 != 1:
+				self.debug_msg(b'-invalid encoded data size')
+				return
+			try:
+				data = base64.b64decode(data[1:])
+			except binascii.Error:
+				return
+		elif self.cobs_encoding and (binary := data[:1] == self.cobs_tag):
+			try:
+				data = self.get_cobs_codec().decode(data[1:])
+			except ValueError:
+				return
+		if not data:
+			self.debug_msg(b'-bad data to transmit')
+			return
+		if len(data) > self.max_frame:
+			self.debug_msg(b'-data size exceeds limit')
+			return
+		link.transmit(data, binary, time.monotonic())
+
+	def chk_errors(self):
+		for tag, link in self.links.items():
+			if link.queue_full != link.last_queue_full:
+				cnt = link.queue_full - link.last_queue_full
+				link.last_queue_full = link.queue_full
+				if tag == b'<':
+					self.debug_msg(b'-notify failed %u times' % cnt)
+				else:
+					self.debug_msg(b'-tx queue [%s] full %u times' % (tag, cnt))
+		if self.parse_errors != self.last_parse_errors:
+			self.debug_msg(b'-parse error %u times' % (self.parse_errors - self.last_parse_errors))
+			self.last_parse_errors = self.parse_errors
+		if self.lost_frames != self.last_lost_frames:
+			self.debug_msg(b'-serial frame lost %u times' % (self.lost_frames - self.last_lost_frames))
+			self.last_lost_frames = self.lost_frames
+
+	def next_timeout(self, now):
+		"""Returns time to wait till the next scheduled event"""
+		deadlines = [now + .1]
+		if self.booting_until:
+			deadlines.append(self.booting_until)
+		if self.connect_ts:
+			deadlines.append(self.connect_ts)
+		if not self.simple and self.last_status_ts is not None:
+			deadlines.append(self.last_status_ts + self.status_interval)
+		for link in self.links.values():
+			if (ts := link.next_event_ts()) is not None:
+				deadlines.append(ts)
+		return max(0, min(deadlines) - now)
+
+	def poll(self, timeout):
+		"""Wait for the next event up to the given timeout, then process it"""
+		com = self.com
+		now = time.monotonic()
+		congested = self.is_congested(now)
+		# the port is not readable while the host is not connected, the reads are retried on timeout
+		select.select([] if congested or not com.connected else [com.fileno()], [com.fileno()] if com.tx_buff else [], [], timeout)
+		now = time.monotonic()
+		if self.booting_until:
+			# the data sent to the adapter being restarted are lost
+			com.discard_input()
+			if now >= self.booting_until:
+				self.on_booted(now)
+		else:
+			if not congested:
+				self.receive()
+			for link in list(self.links.values()):
+				link.poll(now)
+			if self.connect_ts and now >= self.connect_ts:
+				self.connect_next(now)
+			if not self.simple and not congested and (
+					self.last_status_ts is None or now >= self.last_status_ts + self.status_interval
+				):
+				self.report_status()
+				self.last_status_ts = now
+			self.chk_errors()
+		com.flush()
+
+	def run(self):
+		"""Run emulation until stopped"""
+		while not self.stopping:
+			self.poll(self.next_timeout(time.monotonic()))
+
+	def print_stat(self):
+		for tag, link in self.links.items():
+			print('[%s] %u frames sent, %u lost, %u dup, %u reorder, %u corrupt' % (
+					tag.decode(), link.tx_cnt, link.lost_cnt, link.dup_cnt, link.reorder_cnt, link.corrupt_cnt
+				))
+		print('parse errors: %u, lost frames: %u' % (self.parse_errors, self.lost_frames))
+
+def chk_opt(name):
+	if opt := name in sys.argv:
+		sys.argv.remove(name)
+	return opt
+
+def get_opt(name, conv=float, default=None):
+	if name not in sys.argv:
+		return default
+	i = sys.argv.index(name)
+	val = conv(sys.argv[i+1])
+	del sys.argv[i:i+2]
+	return val
+
+if __name__ == '__main__':
+	nl_term     = chk_opt('-n')
+	simple      = chk_opt('--simple')
+	stream_tags = chk_opt('--stream-tags')
+	MxEmulator.ext_frames = not chk_opt('--text')
+	MxEmulator.central    = chk_opt('--central')
+	MxEmulator.hidden     = chk_opt('--hidden')
+	MxEmulator.loss       = get_opt('--loss', default=0)
+	MxEmulator.dup        = get_opt('--dup', default=0)
+	MxEmulator.reorder    = get_opt('--reorder', default=0)
+	MxEmulator.corrupt    = get_opt('--corrupt', default=0)
+	MxEmulator.bandwidth  = get_opt('--bandwidth')
+	MxEmulator.latency    = get_opt('--latency', default=MxEmulator.latency)
+	MxEmulator.cobs_encoding = chk_opt('--cobs')
+	emu = MxEmulator(get_opt('--seed', int))
+	if simple:
+		emu.use_simple_link(stream_tags)
+	if nl_term:
+		emu.selt_nl_terminator()
+	emu.open()
+	print('Listening on ' + emu.port)
+	try:
+		emu.run()
+	except KeyboardInterrupt:
+		emu.print_stat()
+	emu.close()
@@ -0,0 +1,350 @@
+"""
+BLE multi adapter (ble_uart_mx) traffic generator.
+Generates the load for one or more adapters driven by the single selector loop of the adapter pool
+so the harness may saturate the adapters rather than the host CPU. The payloads are sliced from
+the pool of random data generated once at startup. The messages are sent to every peer according
+to the rate profile: constant, Poisson, bursty or diurnal. All random choices are made by the
+generators seeded by the given seed so the load is reproducible.
+
+Every message starts with the header sn:offset:timestamp: followed by the payload taken from
+the given offset of the pool. So the data echoed back by peers are validated without sending
+them twice. The loss, duplication, reordering, corruption and echo round trip time are reported
+per peer.
+
+Expects comma separated list of serial port names as a parameter followed by the peer device
+addresses if started as script. Options:
+ --profile P      the rate profile (constant:100 by default) as one of
+                    constant:R                  R messages per second per peer
+                    poisson:R                   Poisson process with the mean rate R
+                    bursty:R:B                  bursts of B messages back to back with the mean rate R
+                    diurnal:R:PERIOD:DEPTH      Poisson process with the rate varying as R * (1 + DEPTH * sin(2 pi t / PERIOD))
+ --size N|MIN:MAX  the payload size or range (16:1024 by default)
+ --seed N         random generators seed (random by default, printed on start)
+ --text           send text payloads
+ --cobs           send binary data with COBS encoding if supported by the adapter
+ --duration T     stop after T seconds
+ --report T       report interval in seconds (5 by default)
+"""
+
+import sys
+import math
+import time
+import random
+
+sys.path.append('.')
+from ble_multi_adapter import LatencyHistogram
+from ble_adapter_pool import AdapterPool
+
+# The characters the text payloads consist of
+TEXT_ALPHABET = bytes(range(ord('0'), ord('z') + 1))
+
+class PayloadPool:
+	"""The block of random data the payloads are sliced from so generating them costs a single copy.
+	The alphabet may be given to restrict the bytes used (to exclude delimiters for example).
+	"""
+	def __init__(self, seed=None, size=1024*1024, alphabet=None):
+		self.rng = random.Random(seed)
+		if alphabet is not None:
+			# every byte of the alphabet is equally likely
+			data = bytes(self.rng.choices(alphabet, k=size))
+		else:
+			data = self.rng.randbytes(size)
+		self.data = data
+		self.view = memoryview(data)
+
+	def offset(self, size, rng=None):
+		"""Returns random offset of the payload of the given size drawn from the given generator
+		or the pool own one if it is not given
+		"""
+		return (rng or self.rng).randrange(len(self.data) - size + 1)
+
+	def take(self, size):
+		"""Returns random payload of the given size"""
+		off = self.offset(size)
+		return self.data[off:off + size]
+
+	def matches(self, off, data):
+		"""Check the data against the pool content at the given offset"""
+		return 0 <= off and off + len(data) <= len(self.data) and self.view[off:off + len(data)] == data
+
+class ConstantRate:
+	"""Sends messages at constant rate in messages per second"""
+	def __init__(self, rate, rng):
+		self.rate = rate
+		self.rng = rng
+
+	def interval(self, t):
+		"""Returns the interval till the next message given the time passed since the start"""
+		return 1 / self.rate
+
+class PoissonRate(ConstantRate):
+	"""Sends messages at random exponentially distributed intervals with the given mean rate"""
+	def interval(self, t):
+		return self.rng.expovariate(self.rate)
+
+class BurstyRate(ConstantRate):
+	"""Sends bursts of messages back to back keeping the given mean rate"""
+	def __init__(self, rate, rng, burst=10):
+		super().__init__(rate, rng)
+		self.burst = int(burst)
+		self.left = self.burst
+
+	def interval(self, t):
+		if (left := self.left - 1) > 0:
+			self.left = left
+			return 0
+		self.left = self.burst
+		return self.burst / self.rate
+
+class DiurnalRate(ConstantRate):
+	"""Poisson process with the rate following the sine wave with the given period (a day by default)"""
+	min_rate = .01 # relative to the mean rate
+
+	def __init__(self, rate, rng, period=24*3600, depth=.8):
+		super().__init__(rate, rng)
+		self.period = period
+		self.depth = depth
+
+	def rate_at(self, t):
+		return self.rate * max(1 + self.depth * math.sin(2 * math.pi * t / self.period), self.min_rate)
+
+	def interval(self, t):
+		return self.rng.expovariate(self.rate_at(t))
+
+rate_profiles = {
+	'constant' : ConstantRate,
+	'poisson'  : PoissonRate,
+	'bursty'   : BurstyRate,
+	'diurnal'  : DiurnalRate,
+}
+
+def make_profile(spec, rng):
+	"""Create rate profile given its specification like 'poisson:100'"""
+	name, *params = spec.split(':')
+	if name not in rate_profiles or not params:
+		raise ValueError('invalid rate profile: %s' % spec)
+	rate, *params = (float(p) for p in params)
+	return rate_profiles[name](rate, rng, *params)
+
+class LoadStream:
+	"""The stream of messages sent to the peer. Keeps the schedule and the statistics of the data echoed back."""
+	max_due = 1000 # the max number of messages sent at once if the sender is late
+
+	def __init__(self, profile, payloads, sizes, rng):
+		self.profile = profile
+		self.payloads = payloads
+		self.min_size, self.max_size = sizes
+		self.rng = rng
+		self.active = False
+		self.start_ts = self.next_ts = 0
+		self.last_tx_sn = 0
+		self.last_rx_sn = None
+		self.sent = self.sent_bytes = self.skipped = 0
+		self.echoed = self.echoed_bytes = 0
+		self.lost = self.dup = self.reorder = self.corrupt = 0
+		self.rtt = LatencyHistogram()
+
+	def start(self, now):
+		"""Start sending. Called once the peer has opened the stream."""
+		if not self.active:
+			self.active = True
+			self.start_ts = self.next_ts = now
+		self.last_rx_sn = None
+
+	def stop(self):
+		self.active = False
+
+	def due(self, now):
+		"""Returns the number of messages that should be sent by now"""
+		n = 0
+		while self.next_ts <= now:
+			if n >= self.max_due:
+				# don't try to catch up
+				self.next_ts = now
+				break
+			n += 1
+			self.next_ts += self.profile.interval(self.next_ts - self.start_ts)
+		return n
+
+	def mk_msg(self, now, max_frame=None):
+		self.last_tx_sn += 1
+		size = self.rng.randint(self.min_size, self.max_size)
+		hdr = b'%u:' % self.last_tx_sn
+		# the offset is drawn from the stream own generator so the stream does not depend on the others
+		off = self.payloads.offset(size, self.rng)
+		hdr += b'%u:%u:' % (off, int(now * 1e6))
+		if max_frame and len(hdr) + size > max_frame:
+			size = max(max_frame - len(hdr), 0)
+		msg = hdr + self.payloads.data[off:off + size]
+		self.sent += 1
+		self.sent_bytes += len(msg)
+		return msg
+
+	def on_echo(self, msg, now):
+		try:
+			sn, off, ts, data = msg.split(b':', 3)
+			sn, off, ts = int(sn), int(off), int(ts)
+		except ValueError:
+			self.corrupt += 1
+			return
+		if not self.payloads.matches(off, data):
+			self.corrupt += 1
+			return
+		self.echoed += 1
+		self.echoed_bytes += len(msg)
+		self.rtt.record(now - ts / 1e6)
+		if self.last_rx_sn is not None and sn != self.last_rx_sn + 1:
+			if sn > self.last_rx_sn + 1:
+				self.lost += sn - self.last_rx_sn - 1
+			elif sn == self.last_rx_sn:
+				self.dup += 1
+				return
+			else:
+				self.reorder += 1
+				return
+		self.last_rx_sn = sn
+
+	def counters(self):
+		return self.sent, self.sent_bytes, self.echoed, self.echoed_bytes
+
+class LoadPool(AdapterPool):
+	"""Adapter pool sending generated load to every connected peer and validating the data echoed back"""
+	report_interval = 5
+
+	def __init__(self, ports, peers, profile, sizes, seed, binary=True):
+		super().__init__(ports, peers)
+		self.binary = binary
+		self.payloads = PayloadPool(seed, alphabet=None if binary else TEXT_ALPHABET)
+		# every stream has its own generator so the load does not depend on the order peers are connected
+		self.streams = {}
+		for addr in peers:
+			rng = random.Random('%s:%s' % (seed, addr.decode()))
+			self.streams[addr] = LoadStream(make_profile(profile, rng), self.payloads, sizes, rng)
+		self.start_ts = self.report_ts = time.monotonic()
+		self.last_counters = {addr: s.counters() for addr, s in self.streams.items()}
+
+	def poll(self, timeout=None):
+		now = time.monotonic()
+		self.generate(now)
+		if now >= self.report_ts + self.report_interval:
+			self.report(now)
+		super().poll(timeout)
+
+	def generate(self, now):
+		"""Send the messages being due"""
+		for addr, s in self.streams.items():
+			if not s.active or not (n := s.due(now)):
+				continue
+			if not (r := self.get_adapter(addr)):
+				continue
+			ad, idx = r
+			for _ in range(n):
+				if ad.is_congested(idx):
+					s.skipped += 1
+				else:
+					ad.send_data_to(idx, s.mk_msg(time.time(), ad.max_frame), self.binary)
+
+	def next_timeout(self):
+		timeout = super().next_timeout()
+		if (due := min((s.next_ts for s in self.streams.values() if s.active), default=None)) is not None:
+			due = max(due - time.monotonic(), 0)
+			timeout = due if timeout is None else min(timeout, due)
+		return min(timeout, self.report_interval) if timeout is not None else self.report_interval
+
+	def on_idle(self, port, version):
+		print('%s idle, version %s' % (port, version.decode()))
+		for ad in self.adapters:
+			if ad.port == port:
+				for addr in ad.peers:
+					self.streams[addr].stop()
+
+	def on_connecting(self, addr):
+		print('Connecting to %s' % addr.decode())
+
+	def on_rehomed(self, addr, from_port, to_port):
+		print('%s moved from %s to %s' % (addr.decode(), from_port, to_port))
+		self.streams[addr].stop()
+
+	def on_debug_msg(self, port, msg):
+		print('    %s: %s' % (port, msg.decode(errors='replace')))
+
+	def on_peer_msg(self, addr, msg):
+		if not (s := self.streams.get(addr)):
+			return
+		if not msg:
+			# stream start tag
+			s.start(time.monotonic())
+		else:
+			s.on_echo(msg, time.time())
+
+	def report(self, now):
+		elapsed, self.report_ts = now - self.report_ts, now
+		for addr, s in self.streams.items():
+			counters = s.counters()
+			sent, sent_bytes, echoed, echoed_bytes = (c - l for c, l in zip(counters, self.last_counters[addr]))
+			self.last_counters[addr] = counters
+			rtt = s.rtt.summary()
+			print('[%s] tx %u msg/s %u bytes/s, echo %u msg/s %u bytes/s, %u skipped, %u lost, %u dup, %u reorder, %u corrupt%s' % (
+					addr.decode(), sent / elapsed, sent_bytes / elapsed, echoed / elapsed, echoed_bytes / elapsed,
+					s.skipped, s.lost, s.dup, s.reorder, s.corrupt,
+					', rtt p50 %.1f p99 %.1f msec' % (rtt['p50'] * 1e3, rtt['p99'] * 1e3) if rtt['count'] else ''
+				))
+
+	def print_stat(self):
+		elapsed = time.monotonic() - self.start_ts
+		print('-' * 64)
+		for addr, s in self.streams.items():
+			rtt = s.rtt.summary()
+			print('[%s] %u msgs sent (%u bytes, %u/sec), %u skipped, %u echoed (%u bytes, %u/sec)' % (
+					addr.decode(), s.sent, s.sent_bytes, s.sent_bytes / elapsed, s.skipped, s.echoed, s.echoed_bytes, s.echoed_bytes / elapsed
+				))
+			print('[%s] %u lost, %u dup, %u reorder, %u corrupt' % (addr.decode(), s.lost, s.dup, s.reorder, s.corrupt))
+			if rtt['count']:
+				print('[%s] echo rtt: p50 %.1f, p99 %.1f, p999 %.1f, max %.1f msec' % (
+						addr.decode(), rtt['p50'] * 1e3, rtt['p99'] * 1e3, rtt['p999'] * 1e3, rtt['max'] * 1e3
+					))
+		for ad in self.adapters:
+			stats = ad.get_stats()
+			print('%s: %u bytes/sec sent, %u bytes/sec received, %u parse errors, %u lost frames, stall time %.2f sec' % (
+					ad.port, stats['tx_bytes'] / elapsed, stats['rx_bytes'] / elapsed, stats['parse_errors'], stats['lost_frames'], stats['stall_time']
+				))
+
+def chk_opt(name):
+	if opt := name in sys.argv:
+		sys.argv.remove(name)
+	return opt
+
+def get_opt(name, conv=str, default=None):
+	if name not in sys.argv:
+		return default
+	i = sys.argv.index(name)
+	val = conv(sys.argv[i+1])
+	del sys.argv[i:i+2]
+	return val
+
+def parse_sizes(s):
+	sizes = [int(v) for v in s.split(':')]
+	return sizes[0], sizes[-1]
+
+if __name__ == '__main__':
+	profile  = get_opt('--profile', str, 'constant:100')
+	sizes    = get_opt('--size', parse_sizes, (16, 1024))
+	seed     = get_opt('--seed', int, random.randrange(1 << 32))
+	duration = get_opt('--duration', float)
+	LoadPool.report_interval = get_opt('--report', float, LoadPool.report_interval)
+	text = chk_opt('--text')
+	cobs = chk_opt('--cobs')
+	ports = sys.argv[1].split(',')
+	peers = [addr.encode() for addr in sys.argv[2:]]
+	print('Using seed %u' % seed)
+	with LoadPool(ports, peers, profile, sizes, seed, not text) as pool:
+		if cobs:
+			for ad in pool.adapters:
+				ad.use_cobs_encoding()
+		deadline = time.monotonic() + duration if duration else None
+		try:
+			while deadline is None or time.monotonic() < deadline:
+				pool.poll(deadline - time.monotonic() if deadline else None)
+		except KeyboardInterrupt:
+			pass
+		pool.print_stat()
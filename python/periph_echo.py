@@ -10,21 +10,14 @@ import sys
 sys.path.append('.')
 from ble_multi_adapter import MutliAdapter
 
-class Echo(MutliAdapter):
-	def __init__(self, port):
-		super().__init__(port)
-
-	def on_debug_msg(self, msg):
-		print('    ' + msg.decode())
-
-	def on_central_msg(self, msg):
-		print('[.] ' + msg.decode())
-		if msg:
-			self.send_data(msg)
-
 if __name__ == '__main__':
-	with Echo(sys.argv[1]) as ad:
+	with MutliAdapter(sys.argv[1]) as ad:
 		ad.reset()
-		while True:
-			ad.communicate()
+		for ev in ad.events():
+			if ev.kind == 'debug':
+				print('    ' + ev.data.decode())
+			elif ev.kind == 'central':
+				print('[.] ' + ev.data.decode())
+				if ev.data:
+					ad.send_data(ev.data)
 
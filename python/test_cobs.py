@@ -0,0 +1,69 @@
+"""
+COBS binary data codec tests. Run with pytest from the python directory.
+"""
+
+import random
+import pytest
+
+from ble_multi_adapter import MutliAdapter, CobsCodec
+
+codecs = {
+	'tags'  : CobsCodec.for_tags(b'\1', b'\0'),
+	'nl'    : CobsCodec.for_tags(None, b'\n'),
+}
+
+# The run lengths around the code boundaries of the codec and of the classic COBS
+boundary_sizes = sorted({
+	n + d for n in (CobsCodec.max_run, 2*CobsCodec.max_run, 254, 255, 3*CobsCodec.max_run) for d in (-2, -1, 0, 1, 2)
+})
+
+def chk_encoded(codec, data):
+	enc = codec.encode(data)
+	assert codec.r0 not in enc and codec.r1 not in enc
+	assert len(enc) <= len(data) + len(data) // CobsCodec.max_run + 1
+	assert codec.decode(enc) == data
+
+@pytest.mark.parametrize('name', codecs)
+def test_round_trip(name):
+	codec, rnd = codecs[name], random.Random(1)
+	chk_encoded(codec, b'')
+	for size in range(1, 600):
+		chk_encoded(codec, rnd.randbytes(size))
+		# the reserved symbols dominate
+		chk_encoded(codec, bytes(rnd.choice((codec.r0[0], codec.r1[0], 0x41)) for _ in range(size)))
+
+@pytest.mark.parametrize('name', codecs)
+@pytest.mark.parametrize('size', boundary_sizes)
+def test_run_boundaries(name, size):
+	codec = codecs[name]
+	run = bytes(0x41 + i % 26 for i in range(size))
+	chk_encoded(codec, run)
+	for r in (codec.r0, codec.r1):
+		chk_encoded(codec, run + r)
+		chk_encoded(codec, r + run)
+		chk_encoded(codec, run + r + run)
+		chk_encoded(codec, run + r + r)
+
+@pytest.mark.parametrize('name', codecs)
+def test_malformed(name):
+	codec = codecs[name]
+	enc = codec.encode(bytes(range(256)) * 3)
+	for bad in (
+		codec.r0 + enc,                 # reserved symbol as code
+		enc[:1] + codec.r1 + enc[2:],   # reserved symbol inside data
+		enc[:-1],                       # truncated last run
+		enc[:len(enc) // 2],            # truncated in the middle
+		codec.encode(b'x' * 2*CobsCodec.max_run)[:-2], # long run without the terminating code
+	):
+		with pytest.raises(ValueError):
+			codec.decode(bad)
+
+def test_adapter_decoding():
+	ad = MutliAdapter(None)
+	msg = ad.cobs_tag + ad.get_cobs_codec().encode(b'\0\1data\3')
+	# the adapter not reporting COBS support sends such data as text
+	assert ad.decode_data(msg) == msg
+	ad.cobs_supported = True
+	assert ad.decode_data(msg) == b'\0\1data\3'
+	assert ad.decode_data(ad.cobs_tag + ad.start_tag) is None
+	assert ad.stats.decode_errors == 1
@@ -0,0 +1,20 @@
+"""
+Compression negotiation tests. Run with pytest from the python directory.
+"""
+
+from ble_multi_adapter import MutliAdapter
+
+def test_reset_on_stream_start():
+	ad = MutliAdapter(None)
+	ad.use_compression(zdict=b'telemetry')
+	for idx in (0, 1):
+		assert ad.receive_data(idx, ad.compressor.offer(True)) == ()
+		assert ad.compr_peers[idx].enabled and ad.compr_peers[idx].acked
+	# the peer 0 reconnects while the peer 1 stays connected
+	assert ad.receive_data(0, b'') == (b'',)
+	assert 0 not in ad.compr_peers
+	assert ad.compr_peers[1].enabled
+	# the data compressed by the previous connection are not expected any more
+	data = b'\x1e' + ad.compressor.compress(b'telemetry record')
+	assert ad.receive_data(0, data) == (data,)
+	assert ad.receive_data(1, data) == (b'telemetry record',)
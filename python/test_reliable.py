@@ -0,0 +1,78 @@
+"""
+Reliable channel tests. Run with pytest from the python directory.
+"""
+
+from ble_reliable import ReliableChannel, ReliableAdapter
+
+class Link:
+	"""Pair of channels passing messages to each other through the lists"""
+	def __init__(self):
+		self.wire = {'a': [], 'b': []}
+		self.got = []
+		self.a = self.new_channel('a', None)
+		self.b = self.new_channel('b', self.got.append)
+
+	def new_channel(self, name, deliver):
+		return ReliableChannel(self.wire[name].append, deliver or (lambda data: None))
+
+	def pump(self, now, drop=lambda msg: False):
+		self.a.poll(now)
+		self.b.poll(now)
+		for name, dst in (('a', self.b), ('b', self.a)):
+			msgs, self.wire[name][:] = list(self.wire[name]), []
+			for msg in msgs:
+				if not drop(msg):
+					assert dst.on_msg(msg, now)
+
+def run(link, now, steps, dt=.01):
+	for _ in range(steps):
+		link.pump(now)
+		now += dt
+	return now
+
+def test_in_order():
+	link, n = Link(), 200
+	for i in range(n):
+		link.a.send(b'%u' % i)
+	lost = iter(range(1000))
+	now = 0
+	for _ in range(500):
+		# every 7th message is lost
+		link.pump(now, lambda msg: next(lost) % 7 == 3)
+		now += .05
+	assert link.got == [b'%u' % i for i in range(n)]
+
+def test_receiver_restart():
+	link, n = Link(), 100
+	for i in range(n):
+		link.a.send(b'%u' % i)
+	now = run(link, 0, 3)
+	got = len(link.got)
+	assert 0 < got < n
+	# the receiver restarts while the sender keeps its session, the messages
+	# not acknowledged yet are delivered again
+	link.b = link.new_channel('b', link.got.append)
+	run(link, now, 300)
+	first = int(link.got[got])
+	assert first <= got
+	assert link.got[got:] == [b'%u' % i for i in range(first, n)]
+	assert not link.a.inflight and link.a.rto < ReliableChannel.rto_max
+
+def test_sender_reset():
+	link = Link()
+	for i in range(10):
+		link.a.send(b'%u' % i)
+	now = run(link, 0, 5)
+	link.a.reset()
+	link.a.send(b'next')
+	run(link, now, 5)
+	assert link.got == [b'%u' % i for i in range(10)] + [b'next']
+
+def test_no_work_while_stalled():
+	ad = ReliableAdapter(None)
+	ad.is_stall = False
+	for i in range(100):
+		ad.send_reliable(0, b'%u' % i)
+	assert ad.has_work()
+	ad.is_stall = True
+	assert not ad.has_work()
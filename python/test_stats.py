@@ -0,0 +1,23 @@
+"""
+Communication statistics tests. Run with pytest from the python directory.
+"""
+
+from ble_multi_adapter import AdapterStats
+
+def test_rates_over_window():
+	st = AdapterStats()
+	for t in range(20):
+		st.sample(t)
+		st.rx_bytes += 100
+	assert st.rates(20)['rx_bytes_rate'] == 100
+
+def test_rates_drop_on_stall():
+	st = AdapterStats()
+	for t in range(20):
+		st.sample(t)
+		st.rx_bytes += 100
+	# no samples are taken while stalled
+	rates = st.rates(20 + 2 * st.window)
+	assert rates['rx_bytes_rate'] < 10
+	st.rx_bytes += 1000
+	assert st.rates(20 + 3 * st.window)['rx_bytes_rate'] == 1100 / (20 + 3 * st.window - 19)
@@ -0,0 +1,35 @@
+"""
+Transmit scheduler tests. Run with pytest from the python directory.
+"""
+
+from collections import Counter
+from ble_multi_adapter import TxScheduler, DROP_OLDEST, COALESCE
+
+def test_drops_keep_share():
+	q = TxScheduler()
+	q.set_limits(max_len=2, policy=DROP_OLDEST)
+	sent = Counter()
+	for _ in range(1000):
+		# the destination a overflows on every round
+		q.append(b'a' * 100, 'a')
+		q.append(b'a' * 100, 'a')
+		q.append(b'b' * 100, 'b')
+		sent[q.pop()[0][:1]] += 1
+	assert abs(sent[b'a'] - sent[b'b']) <= 2
+	assert q.drop_cnt[DROP_OLDEST] > 0
+
+def test_coalesce_limits():
+	q = TxScheduler()
+	q.set_limits(max_bytes=300, policy=COALESCE)
+	assert q.append(b'x' * 100, 'a', 1, key='x') == []
+	assert q.append(b'y' * 100, 'a', 2, key='y') == []
+	# the bigger replacement pushes the oldest message out
+	dropped = q.append(b'y' * 250, 'a', 3, key='y')
+	assert dropped == [(b'y' * 100, 2), (b'x' * 100, 1)]
+	assert q.nbytes['a'] == 250 and q.depth('a') == 1
+	# the replacement not fitting even alone is dropped
+	assert q.append(b'y' * 400, 'a', 4, key='y') == [(b'y' * 250, 3), (b'y' * 400, 4)]
+	assert q.nbytes['a'] == 0 and len(q) == 0 and q.pop() is None
+	# the key is free again
+	assert q.append(b'y' * 10, 'a', 5, key='y') == []
+	assert q.pop()[:2] == (b'y' * 10, 5)
@@ -4,7 +4,8 @@ Should be paired with ble_uart_rx + receive.py
 
 Every message is enclosed between begin / end markers. The message consists of the
 sequence number followed by random data repeated twice. So the receiver may validate
-data integrity and detect missed messages.
+data integrity and detect missed messages. The random data are sliced from the pool
+generated at startup. Use --seed N option to make them reproducible.
 
 Author: Oleg Volkov
 """
@@ -18,6 +19,7 @@ from serial.tools.list_ports import comports
 baud_rate = 115200
 max_len  = 1024
 tx_interval = .5
+pool_size = 1024*1024
 
 sn = 1
 total_bytes = 0
@@ -31,11 +33,20 @@ def find_ports():
 		if p.vid == usb_vid and p.pid == usb_pid:
 			yield p.name
 
-random.seed()
+seed = None
+if '--seed' in sys.argv:
+	i = sys.argv.index('--seed')
+	seed = int(sys.argv[i+1])
+	del sys.argv[i:i+2]
+
+rng = random.Random(seed)
+alphabet = bytes(range(ord('0'), ord('z') + 1))
+pool = bytes(rng.choices(alphabet, k=pool_size))
 
 def random_bytes():
-	n = random.randrange(1, max_len)
-	return bytes((random.randrange(ord('0'), ord('z') + 1) for _ in range(n)))
+	n = rng.randrange(1, max_len)
+	off = rng.randrange(pool_size - n)
+	return pool[off:off+n]
 
 if len(sys.argv) > 1:
 	port = sys.argv[1]